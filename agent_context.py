@@ -0,0 +1,85 @@
+# agent_context.py
+import streamlit as st
+
+import metrics
+from budget import estimate_tokens
+from prompt import HP_model
+from visualization import ARROW_MAP
+
+# エージェントに渡す文脈を HP モデルのグラフ（ARROW_MAP）上の近傍だけに絞る
+
+# 文脈のおおよそのトークン上限（secrets.toml の [agent_context] max_tokens で上書き可）
+AGENT_CONTEXT_TOKENS = 400
+# 1ノードあたりの最大文字数（長い検索結果が予算を独占しないように）
+NODE_LINE_CHARS = 120
+
+_USER_INPUT_LABELS = {
+    "q1_ux": "Q1 体験",
+    "q2_product": "Q2 製品",
+    "q3_meaning": "Q3 目的",
+    "q4_value": "Q4 ありたい自分",
+}
+
+
+def _build_neighbours() -> dict:
+    # ノード: 接続する矢印とその先のノード / 矢印: 両端のノード
+    graph = {nid: set() for nid in HP_model}
+    for rule in ARROW_MAP:
+        src, arr, tgt = rule["src"], rule["arr"], rule["tgt"]
+        graph[src] |= {arr, tgt}
+        graph[tgt] |= {arr, src}
+        graph[arr] |= {src, tgt}
+    return graph
+
+
+NEIGHBOURS = _build_neighbours()
+
+
+def max_tokens() -> int:
+    return int(st.secrets.get("agent_context", {}).get("max_tokens", AGENT_CONTEXT_TOKENS))
+
+
+def _clip(text: str, limit: int = NODE_LINE_CHARS) -> str:
+    text = " ".join(str(text).split())
+    return text if len(text) <= limit else text[:limit - 1] + "…"
+
+
+def _fit(lines: list, budget: int) -> list:
+    """先頭（優先度の高い順）から予算内に収まるだけ残す。最後の1行は切り詰めて入れる"""
+    kept, used = [], 0
+    for line in lines:
+        cost = estimate_tokens(line)
+        if used + cost <= budget:
+            kept.append(line)
+            used += cost
+            continue
+        rest = budget - used
+        if rest > 8:
+            kept.append(line[:rest - 1] + "…")
+        break
+    return kept
+
+
+def build_agent_context(target_id: int, present: dict, future: dict, user_inputs: dict,
+                        extra: str = "", budget: int = None) -> str:
+    """
+    target_id の要素を予測するための文脈。
+    優先度: ユーザー入力 > 具体的な文脈 > 未来(Mt+1)の近傍 > 現在(Mt)の同要素と近傍
+    """
+    budget = max_tokens() if budget is None else budget
+    near = sorted(NEIGHBOURS[target_id])
+
+    lines = [f"{_USER_INPUT_LABELS[k]}: {v}" for k, v in user_inputs.items() if v]
+    if extra.strip():
+        lines.append(f"文脈: {extra.strip()}")
+    lines += [f"Mt+1 {HP_model[n]}: {_clip(future[HP_model[n]])}" for n in near if future.get(HP_model[n])]
+    lines += [f"Mt {HP_model[n]}: {_clip(present[HP_model[n]])}" for n in [target_id] + near if present.get(HP_model[n])]
+    return "\n".join(_fit(lines, budget))
+
+
+def record_reduction(element: str, full_context: str, pruned_context: str):
+    """全量の文脈と比べたトークン削減量を要素ごとに記録する"""
+    full, pruned = estimate_tokens(full_context), estimate_tokens(pruned_context)
+    metrics.incr(f"agent_context.{element}.full_tokens", full)
+    metrics.incr(f"agent_context.{element}.pruned_tokens", pruned)
+    metrics.incr(f"agent_context.{element}.runs")
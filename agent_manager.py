@@ -1,45 +1,37 @@
 import concurrent.futures
-from utils import parse_json_response
-from prompt import client, SYSTEM_PROMPT 
-
-class AgentManager:
-    def __init__(self):
-        self.client = client
-        self.agents = []
-
-    def generate_agents(self, topic: str) -> list:
-        """
-        基于话题生成 3 个不同的专家 Agent。
-        """
-        prompt = f"""
-テーマ「{topic}」に関するHPモデル（アーキオロジカル・プロトタイピング）の要素を生成するために、全く異なる3人の専門家エージェントを生成してください。
+import streamlit as st
+import budget
+import deadline
+import prompt_registry
+from prompt import SYSTEM_PROMPT
+from llm import chat, structured, StructuredOutputError
+from schemas import AgentRoster, Judgment, Ranking
+from transport import DEBATE_WORKERS
+
+# 全セッション共有のディベート用ワーカー（数は transport.py で接続プールと一緒に決める）
+_debate_executor = concurrent.futures.ThreadPoolExecutor(max_workers=DEBATE_WORKERS, thread_name_prefix="hp-debate")
+
+# ディベートの進め方（secrets.toml の [debate] mode で上書き可）
+#   final_rank: 各エージェントが自分の履歴だけで全ラウンドを進め、最後に1回だけ全提案を順位付けする
+#   per_round : ラウンドごとに審査して1件ずつ選ぶ（従来方式）
+DEBATE_MODE = "final_rank"
+DEBATE_ROUNDS = 3
+
+def debate_mode() -> str:
+    return st.secrets.get("debate", {}).get("mode", DEBATE_MODE)
+
+# ============ Prompt templates (static instructions first, variable data last) ============
+
+prompt_registry.register("agent_gen", SYSTEM_PROMPT, """
+末尾の「テーマ」に関するHPモデル（アーキオロジカル・プロトタイピング）の要素を生成するために、全く異なる3人の専門家エージェントを生成してください。
 各エージェントは異なる視点と専門知識を持ち、未来（Mt+1）に対して創造的かつ革新的な予測を提供できる必要があります。
 以下のJSON形式で出力してください：
-{{ "agents": [ {{ "name": "エージェント名", "expertise": "専門分野", "personality": "性格/特徴", "perspective": "独自の視点" }} ] }}
-"""
-        response = self.client.chat.completions.create(
-            model="gpt-4o",
-            messages=[{"role": "system", "content": SYSTEM_PROMPT}, {"role": "user", "content": prompt}],
-            temperature=1.0,
-            response_format={"type": "json_object"}
-        )
-        result = parse_json_response(response.choices[0].message.content)
-        self.agents = result.get("agents", [])
-        return self.agents
-
-    def _agent_think(self, agent, element_type, context_str, history):
-        """单个 Agent 生成提案 - 50字以内限制"""
-        history_text = "\n".join([f"- {h}" for h in history]) if history else "なし"
-        
-        prompt = f"""
-あなたは{agent['name']}です（専門：{agent['expertise']}）。
-{agent['perspective']}の視点で、未来（Mt+1）の要素「{element_type}」を予測してください。
-
-## 文脈
-{context_str}
+{ "agents": [ { "name": "エージェント名", "expertise": "専門分野", "personality": "性格/特徴", "perspective": "独自の視点" } ] }
+""", [("topic", "テーマ")])
 
-## 過去の提案
-{history_text}
+prompt_registry.register("agent_think", SYSTEM_PROMPT, """
+あなたは末尾の「あなた」に書かれた専門家です。
+その視点（perspective）で、「文脈」と「過去の提案」を踏まえ、未来（Mt+1）の「予測する要素」を予測してください。
 
 【重要：出力ルール】
 1. **50文字以内**で出力してください。これは絶対条件です。
@@ -51,11 +43,56 @@ class AgentManager:
 （悪い）：未来の社会ではAIが発達し、人間が労働から解放されることで、生きがいを喪失する問題。（45文字）
 （良い）：AIによる労働解放が招く「全人類的虚無感」と「生きがい喪失」。（30文字）
 
-あなたの予測（テキストのみ、日本語、50文字以内）：
-"""
-        response = self.client.chat.completions.create(
-            model="gpt-4o",
-            messages=[{"role": "system", "content": SYSTEM_PROMPT}, {"role": "user", "content": prompt}],
+あなたの予測（テキストのみ、日本語、50文字以内）を出力してください。
+""", [("element", "予測する要素"), ("context", "文脈"), ("agent", "あなた"), ("history", "過去の提案")])
+
+prompt_registry.register("judge", SYSTEM_PROMPT, """
+末尾の「トピック」と「要素」（未来 Mt+1）について、「提案」を評価してください。
+
+最も創造的かつ簡潔な提案を1つ選択してください。
+以下のJSON形式で出力してください:
+{ "selected_agent": "エージェント名", "selected_content": "提案内容（そのまま）", "reason": "選定理由（日本語）" }
+""", [("topic", "トピック"), ("element", "要素"), ("proposals", "提案")])
+
+prompt_registry.register("rank", SYSTEM_PROMPT, """
+末尾の「トピック」と「要素」（未来 Mt+1）について、「提案」を評価してください。
+
+創造的かつ簡潔で、互いに重複しない提案を良い順に「選ぶ件数」だけ選び、提案番号で答えてください。
+以下のJSON形式で出力してください:
+{ "ranked": [提案番号, ...], "reason": "選定理由（日本語）" }
+""", [("topic", "トピック"), ("element", "要素"), ("top_k", "選ぶ件数"), ("proposals", "提案")])
+
+class AgentManager:
+    """
+    専門家エージェントの生成とディベート。状態を持たないため全セッションで共有できる。
+    """
+
+    def generate_agents(self, topic: str) -> list:
+        """
+        基于话题生成 3 个不同的专家 Agent。
+        """
+        roster = structured(
+            "agent_gen",
+            prompt_registry.render("agent_gen", topic=topic),
+            AgentRoster,
+            temperature=1.0,
+        )
+        return [a.model_dump() for a in roster.agents]
+
+    def _agent_think(self, agent, element_type, context_str, history):
+        """单个 Agent 生成提案 - 50字以内限制"""
+        history_text = "\n".join([f"- {h}" for h in history]) if history else "なし"
+        
+        # 同じディベート内の呼び出しは「文脈」まで一致する
+        response = chat(
+            "agent_think",
+            prompt_registry.render(
+                "agent_think",
+                element=element_type,
+                context=context_str,
+                agent={"name": agent['name'], "expertise": agent['expertise'], "perspective": agent['perspective']},
+                history=history_text,
+            ),
             temperature=1.2 # 高创造性
         )
         return response.choices[0].message.content.strip()
@@ -63,57 +100,119 @@ class AgentManager:
     def _judge_proposals(self, proposals, element_type, topic):
         """裁判选择最佳提案"""
         proposals_text = "\n".join([f"提案 {i+1} ({p['agent']}): {p['content']}" for i, p in enumerate(proposals)])
-        prompt = f"""
-トピック: {topic}
-要素: {element_type} (未来 Mt+1)
-
-以下の提案を評価してください。
-{proposals_text}
-
-最も創造的かつ簡潔な提案を1つ選択してください。
-以下のJSON形式で出力してください:
-{{ "selected_agent": "エージェント名", "selected_content": "提案内容（そのまま）", "reason": "選定理由（日本語）" }}
-"""
-        response = self.client.chat.completions.create(
-            model="gpt-4o",
-            messages=[{"role": "system", "content": SYSTEM_PROMPT}, {"role": "user", "content": prompt}],
+        # selected_content が揃った時点で打ち切る（reason の生成を待たない）
+        judgment = structured(
+            "judge",
+            prompt_registry.render("judge", topic=topic, element=element_type, proposals=proposals_text),
+            Judgment,
+            stop_after="selected_content",
             temperature=0,
-            response_format={"type": "json_object"}
         )
-        return parse_json_response(response.choices[0].message.content)
+        return judgment.model_dump()
 
-    def run_multi_agent_generation(self, element_type, element_desc, topic, full_context_str) -> list[str]:
+    def _rank_proposals(self, proposals, element_type, topic, top_k):
+        """全ラウンドの提案をまとめて1回で順位付けし、上位 top_k 件の内容を返す"""
+        proposals_text = "\n".join([f"提案 {i+1} ({p['agent']}): {p['content']}" for i, p in enumerate(proposals)])
+        # ranked が揃った時点で打ち切る（reason の生成を待たない）
+        ranking = structured(
+            "judge",
+            prompt_registry.render("rank", topic=topic, element=element_type, top_k=f"{top_k}件", proposals=proposals_text),
+            Ranking,
+            stop_after="ranked",
+            temperature=0,
+        )
+        picked = []
+        for n in ranking.ranked:
+            if 1 <= n <= len(proposals) and n - 1 not in picked:
+                picked.append(n - 1)
+        return [proposals[i]["content"] for i in picked[:top_k]]
+
+    def _agent_rounds(self, agent, element_type, context_str, rounds, history):
+        """1人のエージェントが自分の過去の提案だけを見ながら rounds 回提案する（history に追記）"""
+        for _ in range(rounds):
+            try:
+                history.append(self._agent_think(agent, element_type, context_str, history))
+            except Exception as e:
+                print(f"Agent failed: {e}")
+        return history
+
+    def run_multi_agent_generation(self, agents, element_type, element_desc, topic, full_context_str,
+                                   rounds: int = DEBATE_ROUNDS) -> list[str]:
         """
-        运行 3 轮迭代
+        rounds 回の提案を行い、候補を返す（final_rank: 上位 rounds 件 / per_round: 各ラウンドの勝者）
         """
-        if not self.agents:
-            self.generate_agents(topic)
+        if debate_mode() == "final_rank":
+            return self._run_final_rank(agents, element_type, element_desc, topic, full_context_str, rounds)
 
         candidates = []
-        agent_history = {agent['name']: [] for agent in self.agents}
+        agent_history = {agent['name']: [] for agent in agents}
 
-        for i in range(1, 4):
+        for i in range(1, rounds + 1):
             proposals = []
-            with concurrent.futures.ThreadPoolExecutor(max_workers=3) as executor:
-                future_to_agent = {
-                    executor.submit(self._agent_think, agent, f"{element_type} ({element_desc})", full_context_str, agent_history[agent['name']]): agent 
-                    for agent in self.agents
-                }
-                for future in concurrent.futures.as_completed(future_to_agent):
-                    agent = future_to_agent[future]
-                    try:
-                        content = future.result()
-                        proposals.append({"agent": agent['name'], "content": content})
-                        agent_history[agent['name']].append(content)
-                    except Exception as e:
-                        print(f"Agent failed: {e}")
+            future_to_agent = {
+                budget.submit(_debate_executor, self._agent_think, agent, f"{element_type} ({element_desc})", full_context_str, agent_history[agent['name']]): agent 
+                for agent in agents
+            }
+            for future in concurrent.futures.as_completed(future_to_agent):
+                agent = future_to_agent[future]
+                try:
+                    content = future.result()
+                    proposals.append({"agent": agent['name'], "content": content})
+                    agent_history[agent['name']].append(content)
+                except Exception as e:
+                    print(f"Agent failed: {e}")
 
             if not proposals:
                 continue
 
-            judgment = self._judge_proposals(proposals, element_type, topic)
+            if deadline.near():
+                # 締め切り間際は審査を省略して最初の提案を採用する
+                deadline.record_timeout("judge")
+                candidates.append(proposals[0]["content"])
+                continue
+            try:
+                judgment = self._judge_proposals(proposals, element_type, topic)
+            except (StructuredOutputError, deadline.CallTimeout) as e:
+                print(f"Judge failed: {e}")
+                continue
             winner_content = judgment.get('selected_content', "")
             if winner_content:
                 candidates.append(winner_content)
 
-        return candidates if candidates else ["生成失敗"]
\ No newline at end of file
+        return candidates if candidates else ["生成失敗"]
+
+    def _run_final_rank(self, agents, element_type, element_desc, topic, full_context_str, rounds) -> list[str]:
+        # 審査はラウンド間のクリティカルパスに入れず、エージェントごとに独立して進める
+        histories = [(agent['name'], []) for agent in agents]
+        futures = [
+            budget.submit(_debate_executor, self._agent_rounds, agent, f"{element_type} ({element_desc})", full_context_str, rounds, history)
+            for agent, (_, history) in zip(agents, histories)
+        ]
+        # 締め切りまでに揃った分だけで進める（残りのエージェントは締め切り切れで止まる）
+        _, not_done = concurrent.futures.wait(futures, timeout=deadline.remaining())
+        if not_done:
+            deadline.record_timeout("debate")
+        # ラウンド順に並べる（各ラウンド内はエージェント順）
+        histories = [(name, list(history)) for name, history in histories]
+        proposals = [
+            {"agent": name, "content": history[r]}
+            for r in range(rounds) for name, history in histories if r < len(history)
+        ]
+        if not proposals:
+            return ["生成失敗"]
+
+        candidates = []
+        if deadline.near():
+            deadline.record_timeout("judge")
+        else:
+            try:
+                candidates = self._rank_proposals(proposals, element_type, topic, top_k=rounds)
+            except (StructuredOutputError, deadline.CallTimeout) as e:
+                print(f"Judge failed: {e}")
+        # 順位付けに失敗した・件数が足りない場合は提案順で補う
+        for p in proposals:
+            if len(candidates) >= rounds:
+                break
+            if p["content"] not in candidates:
+                candidates.append(p["content"])
+        return candidates
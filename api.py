@@ -0,0 +1,295 @@
+# api.py
+"""
+生成エンジンの HTTP/JSON API（Streamlit の UI を経由せずに HP モデルとストーリーを作る）。
+
+    python api.py --port 8600
+
+    POST /sessions                          新規セッション → {"session_id"}
+    GET  /sessions/<sid>                    入力・候補・HP モデル・生成状況
+    GET  /sessions/<sid>/candidates         Step 2 の候補（adv / goals / values / habits / ux_future）
+    POST /sessions/<sid>/q1 〜 /q4           {"text"}（q4 は "draft_mode", "warm_start" も可）
+    POST /sessions/<sid>/goals              選んだ前衛的社会問題 {"text"} → Goals の候補
+    POST /sessions/<sid>/values             選んだ Goal {"text"} → Values の候補
+    POST /sessions/<sid>/habits             選んだ Value {"text"} → Habits の候補
+    POST /sessions/<sid>/ux                 選んだ Habit {"text"} → UX の候補
+    POST /sessions/<sid>/finalize           選んだ UX {"text"} → HP モデルの JSON
+    POST /sessions/<sid>/story              HP モデル（省略時はセッションのもの）→ ストーリー概要
+    GET  /sessions/<sid>/events             ノードの状態変化を SSE で流す（バックグラウンドの生成が終わるまで）
+    GET  /metrics                           メトリクス・接続プールの状態・呼び出しの共有率・プロンプトキャッシュの割合
+
+POST に "Accept: text/event-stream"（または ?stream=1）を付けると、完了を待たずに
+node（ノードの状態変化）/ progress（ストーリーの途中経過）/ result / error のイベントを流す。
+"""
+import argparse
+import json
+import queue
+import re
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import deadline
+import engine
+import job_queue
+import llm
+import metrics
+import prompt_registry
+import session_store
+import similarity_index
+import singleflight
+import transport
+
+# SSE でノードの状態変化を確認する間隔
+EVENT_POLL_SECONDS = 0.5
+# 何も送らない時間がこれを超えたらコメント行を送って接続を保つ
+KEEPALIVE_SECONDS = 15.0
+
+_PATH = re.compile(r"^/sessions(?:/([0-9a-f]{32})(?:/([a-z0-9_]+))?)?$")
+
+# 同じセッションへの操作は1つずつ実行する（UI と同じく前のステップの結果に依存するため）
+_session_locks: dict = {}
+_session_locks_guard = threading.Lock()
+
+
+def _session_lock(sid: str) -> threading.Lock:
+    with _session_locks_guard:
+        return _session_locks.setdefault(sid, threading.Lock())
+
+
+def _adv_candidates(session) -> list:
+    f = session.future_candidates_adv
+    if f is not None and f.done() and not f.exception():
+        return f.result()
+    return []
+
+
+def _candidates(session) -> dict:
+    return {"adv": _adv_candidates(session), **session.mtplus1_candidates}
+
+
+def _describe(sid: str, session) -> dict:
+    return {
+        "session_id": sid,
+        "user_inputs": dict(session.user_inputs),
+        "candidates": _candidates(session),
+        "hp_model": session.to_dict(),
+        "pending_jobs": session.pending_refinements(),
+        "draft_nodes": session.draft_node_count(),
+        "warm_source": session.warm_source,
+        "budget": session.budget.to_snapshot(),
+    }
+
+
+def _payload(kind: str, sid: str, session, body: dict) -> dict:
+    if kind == "story":
+        return {"hp_json": body.get("hp_json") or session.to_dict()}
+    text = str(body.get("text", "")).strip()
+    if not text:
+        raise ValueError("text is required")
+    if kind == "q4":
+        return {
+            "text": text,
+            "draft_mode": bool(body.get("draft_mode", False)),
+            "warm_start": bool(body.get("warm_start", True)),
+            "sid": sid,
+        }
+    return {"text": text}
+
+
+def run_action(sid: str, kind: str, payload: dict, progress=lambda text: None):
+    """app.py と同じ締め切りで操作を実行し、状態を保存して結果を返す"""
+    session, _ = session_store.get_session(sid)
+    key = engine.DEADLINE_KEYS.get(kind)
+    with _session_lock(sid):
+        if key is None:
+            result = engine.run(session, sid, kind, payload, progress)
+        else:
+            with deadline.scope(engine.ACTION_DEADLINES[key]):
+                result = engine.run(session, sid, kind, payload, progress)
+        if kind == "finalize" and result is None:
+            result = session.to_dict()
+        session_store.persist(sid)
+    return result
+
+
+class Handler(BaseHTTPRequestHandler):
+    server_version = "HPModelAPI/1.0"
+
+    # ============ Helpers ============
+
+    def _send_json(self, status: int, data):
+        body = json.dumps(data, ensure_ascii=False).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _read_body(self) -> dict:
+        length = int(self.headers.get("Content-Length") or 0)
+        if not length:
+            return {}
+        data = json.loads(self.rfile.read(length).decode("utf-8"))
+        if not isinstance(data, dict):
+            raise ValueError("body must be a JSON object")
+        return data
+
+    def _wants_stream(self, query: dict) -> bool:
+        return "text/event-stream" in self.headers.get("Accept", "") or query.get("stream") == ["1"]
+
+    def _start_stream(self):
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream; charset=utf-8")
+        self.send_header("Cache-Control", "no-cache")
+        self.send_header("Connection", "close")
+        self.end_headers()
+
+    def _event(self, event: str, data):
+        msg = f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+        self.wfile.write(msg.encode("utf-8"))
+        self.wfile.flush()
+
+    def _stream_nodes(self, session, since: int, done) -> int:
+        """done() が真になるまでノードの状態変化を node イベントとして送る。送った位置を返す"""
+        last_sent = time.monotonic()
+        while True:
+            finished = done()
+            deltas = session.node_deltas(since)
+            for d in deltas:
+                self._event("node", d)
+            if deltas:
+                since = deltas[-1]["seq"]
+                last_sent = time.monotonic()
+            if finished:
+                return since
+            if time.monotonic() - last_sent > KEEPALIVE_SECONDS:
+                self.wfile.write(b": keepalive\n\n")
+                self.wfile.flush()
+                last_sent = time.monotonic()
+            time.sleep(EVENT_POLL_SECONDS)
+
+    # ============ Routes ============
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        if url.path == "/metrics":
+            return self._send_json(200, {
+                **metrics.snapshot(),
+                "pools": transport.pool_stats(),
+                "coalescing_rate": singleflight.coalescing_rate(),
+                "prompt_cache_rate": prompt_registry.cache_hit_rate(),
+            })
+        m = _PATH.match(url.path)
+        if not m or not m.group(1):
+            return self._send_json(404, {"error": "not found"})
+        sid, action = m.group(1), m.group(2)
+        if session_store.load_snapshot(sid) is None:
+            return self._send_json(404, {"error": "unknown session"})
+        session, _ = session_store.get_session(sid)
+        if engine.mode() == "queue":
+            session_store.reload(sid)
+
+        if action is None:
+            return self._send_json(200, _describe(sid, session))
+        if action == "candidates":
+            return self._send_json(200, _candidates(session))
+        if action == "events":
+            since = int(parse_qs(url.query).get("since", ["0"])[0])
+            self._start_stream()
+            try:
+                if engine.mode() == "queue":
+                    def done():
+                        # バックグラウンドの生成はワーカー側で進むので、キューの状態で終わりを判断する
+                        finished = not job_queue.active(sid)
+                        session_store.reload(sid)
+                        return finished
+                else:
+                    done = lambda: not session.has_pending_jobs()
+                self._stream_nodes(session, since, done)
+                self._event("done", _describe(sid, session))
+            except (BrokenPipeError, ConnectionResetError):
+                pass
+            return
+        return self._send_json(404, {"error": "not found"})
+
+    def do_POST(self):
+        url = urlparse(self.path)
+        m = _PATH.match(url.path)
+        if not m:
+            return self._send_json(404, {"error": "not found"})
+        sid, kind = m.group(1), m.group(2)
+
+        if sid is None:
+            sid = uuid.uuid4().hex
+            session, _ = session_store.get_session(sid)
+            session.query_mode = engine.query_mode()
+            session_store.persist(sid, {})
+            return self._send_json(201, {"session_id": sid})
+
+        if kind not in engine.HANDLERS:
+            return self._send_json(404, {"error": f"unknown action: {kind}"})
+        if session_store.load_snapshot(sid) is None:
+            return self._send_json(404, {"error": "unknown session"})
+        session, _ = session_store.get_session(sid)
+        try:
+            payload = _payload(kind, sid, session, self._read_body())
+        except ValueError as e:
+            return self._send_json(400, {"error": str(e)})
+
+        if not self._wants_stream(parse_qs(url.query)):
+            try:
+                result = run_action(sid, kind, payload)
+            except Exception as e:
+                return self._send_json(500, {"error": str(e)})
+            return self._send_json(200, {"result": result})
+
+        # SSE: 別スレッドで実行し、ノードの状態変化と途中経過を流す
+        progress_q = queue.Queue()
+        outcome = {}
+
+        def target():
+            try:
+                outcome["result"] = run_action(sid, kind, payload, progress_q.put)
+            except Exception as e:
+                outcome["error"] = str(e)
+
+        worker = threading.Thread(target=target, daemon=True)
+        since = session.node_seq()
+        worker.start()
+        self._start_stream()
+        try:
+            def done():
+                while not progress_q.empty():
+                    self._event("progress", {"text": progress_q.get()})
+                return not worker.is_alive()
+            self._stream_nodes(session, since, done)
+            done()
+            if "error" in outcome:
+                self._event("error", {"error": outcome["error"]})
+            else:
+                self._event("result", {"result": outcome.get("result"), "candidates": _candidates(session)})
+        except (BrokenPipeError, ConnectionResetError):
+            # クライアントが切断しても操作自体は最後まで実行して保存する
+            pass
+
+    def log_message(self, format, *args):
+        pass
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8600)
+    args = parser.parse_args()
+    server = ThreadingHTTPServer((args.host, args.port), Handler)
+    server.daemon_threads = True
+    transport.warm_up_async(llm.endpoints())
+    similarity_index.refresh_async()
+    print(f"listening on http://{args.host}:{args.port}")
+    server.serve_forever()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,11 +1,18 @@
 # app.py
 import json
+import uuid
 import streamlit as st
 
-from generate import HPGenerationSession
-from outline import modify_outline
-from visualization import render_hp_visualization
-from story_generator import StoryGenerator # New Story Generator
+from outline import modify_outline_stream
+from visualization import render_hp_visualization, render_hp_live
+import budget
+import deadline
+import engine
+import llm
+import session_store
+import similarity_index
+import transport
+from engine import ACTION_DEADLINES
 
 # ===== ページ設定 =====
 # ===============================
@@ -99,10 +106,32 @@ st.markdown('<div class="sub-title">マルチエージェント討論 (Step 2) 
 # ============================================================
 #   🧠 セッション初期化
 # ============================================================
+# 再接続時に復元するための UI 状態のキー
+UI_KEYS = [
+    "adv_candidates", "mtplus1", "hp_json", "outline", "final_confirmed",
+    "show_q2", "show_q3", "show_q4",
+    "step2", "s2_adv", "s2_goal", "s2_value", "s2_habit", "s2_ux", "step4",
+    "text_adv", "text_goal", "text_value", "text_habit", "text_ux",
+    "input_q1", "input_q2", "input_q3", "input_q4",
+]
+
+# セッションID は URL (?sid=...) に保持し、リロードや再接続でも同じスナップショットに戻れるようにする
+sid = st.query_params.get("sid")
+if not sid:
+    sid = uuid.uuid4().hex
+    st.query_params["sid"] = sid
+
+@st.cache_resource
+def warm_up_connections():
+    # プロセスごとに1回、OpenAI / Tavily への接続とウォームスタートの索引を先に用意しておく
+    transport.warm_up_async(llm.endpoints())
+    similarity_index.refresh_async()
+    return True
+
+warm_up_connections()
+
 def init_state():
     defaults = {
-        "hp_session": HPGenerationSession(),
-        "story_gen": StoryGenerator(), # Initialize Story Generator
         "adv_candidates": None,
         "mtplus1": {},
         "hp_json": None,
@@ -133,9 +162,26 @@ def init_state():
         if k not in st.session_state:
             st.session_state[k] = v
 
+hp_session, ui_snapshot = session_store.get_session(sid)
+if st.session_state.get("restored_sid") != sid:
+    # スナップショットから UI 状態を復元（LLM の再実行なし）
+    for k, v in ui_snapshot.items():
+        st.session_state[k] = v
+    if not ui_snapshot:
+        hp_session.query_mode = engine.query_mode()
+    st.session_state.restored_sid = sid
+
 init_state()
 state = st.session_state
-hp_session: HPGenerationSession = state.hp_session
+session_store.evict_idle()
+if engine.mode() == "queue":
+    # ワーカーが進めたバックグラウンドのノード生成を取り込む
+    session_store.reload(sid)
+# このスクリプト実行中の LLM / Tavily 呼び出しをセッションの予算に計上する
+budget.activate(hp_session.budget)
+
+def persist():
+    session_store.persist(sid, {k: state[k] for k in UI_KEYS if k in state})
 
 # ============================================================
 #   Utilities
@@ -159,6 +205,15 @@ def go_back():
         state.s2_adv = False
         state.text_adv = None
 
+def render_budget_status():
+    b = hp_session.budget
+    used = b.used()
+    with st.expander(f"💰 コスト予算: {used:.0%} 使用", expanded=bool(b.decisions)):
+        st.progress(min(1.0, used))
+        st.caption(f"トークン {b.tokens:,} / {b.max_tokens:,}・Tavily {b.tavily_calls} / {b.max_tavily_calls} 回")
+        for d in b.decisions:
+            st.warning(f"予算の {d['used']:.0%} を消費したため、{d['message']}。")
+
 # ============================================================
 #   🟦 ステップ1：Q1〜Q4 (No Change)
 # ============================================================
@@ -172,16 +227,18 @@ with col_q_L:
     q1 = st.text_area("どのような時に、どのような場所で何をしているかという体験", key="input_q1", height=80)
     if st.button("Q1 を送信", key="btn_q1"):
         if q1.strip():
-            hp_session.handle_input1(q1)
+            engine.run(hp_session, sid, "q1", {"text": q1})
             state.show_q2 = True
+            persist()
 
     if state.show_q2:
         st.subheader("Q2")
         q2 = st.text_area("重要な製品やサービス", key="input_q2", height=60)
         if st.button("Q2 を送信", key="btn_q2"):
             if q2.strip():
-                hp_session.handle_input2(q2)
+                engine.run(hp_session, sid, "q2", {"text": q2})
                 state.show_q3 = True
+                persist()
 
 with col_q_R:
     if state.show_q3:
@@ -189,20 +246,25 @@ with col_q_R:
         q3 = st.text_area("何のために使用していますか？", key="input_q3", height=60)
         if st.button("Q3 を送信", key="btn_q3"):
             if q3.strip():
-                hp_session.handle_input3(q3)
+                engine.run(hp_session, sid, "q3", {"text": q3})
                 state.show_q4 = True
+                persist()
 
     if state.show_q4 and not state.step2:
         st.subheader("Q4")
         q4 = st.text_area("どんな自分でありたいですか？", key="input_q4", height=60)
+        draft_mode = st.checkbox("⚡ 高速ドラフトモード（先に全体を下書きし、検索による精緻化はバックグラウンドで実行）", key="draft_mode")
+        warm_start = st.checkbox("♻️ 回答が近い過去のセッションがあれば、その過去・現在のノードとエージェントを再利用する", value=True, key="warm_start")
         if st.button("Q4 を送信して Multi-Agent 起動", key="btn_q4", type="primary"):
             if q4.strip():
-                with st.spinner("マルチエージェントチームを編成し、過去・現在の分析と未来予測の議論を開始します..."):
-                    hp_session.start_from_values_and_trigger_future(q4)
-                    hp_session.wait_all()
-                    state.adv_candidates = hp_session.get_future_adv_candidates()
+                with st.spinner("マルチエージェントチームを編成し、過去・現在の分析と未来予測の議論を開始します..."), deadline.scope(ACTION_DEADLINES["q4"]):
+                    # Mt / Mt-1 の残りはステップ2のライブ表示で進捗を見せながら埋める
+                    state.adv_candidates = engine.run(hp_session, sid, "q4", {
+                        "text": q4, "draft_mode": draft_mode, "warm_start": warm_start, "sid": sid,
+                    })
                 state.step2 = True
                 state.s2_adv = True
+                persist()
                 st.rerun()
 
 # ============================================================
@@ -212,6 +274,28 @@ with col_q_R:
 if state.step2:
     st.header("ステップ 2：Multi-Agent による未来構築", divider="grey")
     st.info("AIエージェントチーム（専門家3名）が議論し、最も創造的な候補を提案します。")
+    render_budget_status()
+    if hp_session.warm_source:
+        if hp_session.warm_source.get("kept"):
+            st.caption(f"♻️ 非常に近い過去のセッションから過去・現在のノードをそのまま再利用しました（類似度 {hp_session.warm_source['score']:.2f}）。")
+        else:
+            st.caption(f"♻️ 類似する過去のセッションから過去・現在のノードを再利用しました（類似度 {hp_session.warm_source['score']:.2f}）。検索による精緻化はバックグラウンドで続きます。")
+
+    # バックグラウンドで埋まっていくノードをライブ表示（ジョブ実行中だけポーリング）
+    live = engine.has_pending_jobs(hp_session, sid)
+    with st.expander("🛰️ HPモデルの生成状況（ライブ）", expanded=live):
+        @st.fragment(run_every=2 if live else None)
+        def live_progress():
+            if engine.mode() == "queue":
+                # ワーカーが保存した途中の状態を取り込む
+                session_store.reload(sid)
+            if engine.has_pending_jobs(hp_session, sid):
+                pending = hp_session.pending_refinements()
+                st.caption(f"実行中のジョブ: {pending}" if pending else "バックグラウンドで生成中です。")
+            else:
+                st.caption("バックグラウンドの生成は完了しました。")
+            render_hp_live(hp_session)
+        live_progress()
 
     # --- ① 前衛的社会問題 ---
     if state.s2_adv and not state.s2_goal:
@@ -227,14 +311,16 @@ if state.step2:
             c1, c2 = st.columns([1, 4])
             if c1.button("戻る", key="b_adv"):
                 go_back()
+                persist()
                 st.rerun()
             if c2.button("① 確定して次へ", key="n_adv", type="primary"):
                 final_text = manual_adv.strip() if manual_adv.strip() else adv_list[sel_idx]
                 state.text_adv = final_text
                 
-                with st.spinner(f"「{final_text}」についてエージェントが議論中 (Goals)..."):
-                    state.mtplus1["goals"] = hp_session.generate_goals_from_adv(final_text)
+                with st.spinner(f"「{final_text}」についてエージェントが議論中 (Goals)..."), deadline.scope(ACTION_DEADLINES["step2"]):
+                    state.mtplus1["goals"] = engine.run(hp_session, sid, "goals", {"text": final_text})
                 state.s2_goal = True
+                persist()
                 st.rerun()
 
     # --- ② 社会の目標 ---
@@ -248,14 +334,16 @@ if state.step2:
         c1, c2 = st.columns([1, 4])
         if c1.button("戻る", key="b_goal"):
             go_back()
+            persist()
             st.rerun()
         if c2.button("② 確定して次へ", key="n_goal", type="primary"):
             final_text = manual_goal.strip() if manual_goal.strip() else goal_list[sel_idx]
             state.text_goal = final_text
             
-            with st.spinner(f"「{final_text}」についてエージェントが議論中 (Values)..."):
-                state.mtplus1["values"] = hp_session.generate_values_from_goal(final_text)
+            with st.spinner(f"「{final_text}」についてエージェントが議論中 (Values)..."), deadline.scope(ACTION_DEADLINES["step2"]):
+                state.mtplus1["values"] = engine.run(hp_session, sid, "values", {"text": final_text})
             state.s2_value = True
+            persist()
             st.rerun()
 
     # --- ③ 人々の価値観 ---
@@ -269,14 +357,16 @@ if state.step2:
         c1, c2 = st.columns([1, 4])
         if c1.button("戻る", key="b_val"):
             go_back()
+            persist()
             st.rerun()
         if c2.button("③ 確定して次へ", key="n_val", type="primary"):
             final_text = manual_val.strip() if manual_val.strip() else val_list[sel_idx]
             state.text_value = final_text
             
-            with st.spinner(f"「{final_text}」についてエージェントが議論中 (Habits)..."):
-                state.mtplus1["habits"] = hp_session.generate_habits_from_value(final_text)
+            with st.spinner(f"「{final_text}」についてエージェントが議論中 (Habits)..."), deadline.scope(ACTION_DEADLINES["step2"]):
+                state.mtplus1["habits"] = engine.run(hp_session, sid, "habits", {"text": final_text})
             state.s2_habit = True
+            persist()
             st.rerun()
 
     # --- ④ 慣習化 ---
@@ -290,14 +380,16 @@ if state.step2:
         c1, c2 = st.columns([1, 4])
         if c1.button("戻る", key="b_hab"):
             go_back()
+            persist()
             st.rerun()
         if c2.button("④ 確定して次へ", key="n_hab", type="primary"):
             final_text = manual_hab.strip() if manual_hab.strip() else hab_list[sel_idx]
             state.text_habit = final_text
             
-            with st.spinner(f"「{final_text}」についてエージェントが議論中 (UX)..."):
-                state.mtplus1["ux_future"] = hp_session.generate_ux_from_habit(final_text)
+            with st.spinner(f"「{final_text}」についてエージェントが議論中 (UX)..."), deadline.scope(ACTION_DEADLINES["step2"]):
+                state.mtplus1["ux_future"] = engine.run(hp_session, sid, "ux", {"text": final_text})
             state.s2_ux = True
+            persist()
             st.rerun()
 
     # --- ⑤ UX ---
@@ -311,17 +403,18 @@ if state.step2:
         c1, c2 = st.columns([1, 4])
         if c1.button("戻る", key="b_ux"):
             go_back()
+            persist()
             st.rerun()
         if c2.button("HPモデルを完成させる", key="n_ux", type="primary"):
             final_text = manual_ux.strip() if manual_ux.strip() else ux_list[sel_idx]
             state.text_ux = final_text
             
-            with st.spinner("HPモデルの残りの要素を計算し、JSONを構築中..."):
-                hp_session.finalize_mtplus1(final_text)
-                hp_session.wait_all()
-                state.hp_json = hp_session.to_dict()
+            with st.spinner("HPモデルの残りの要素を計算し、JSONを構築中..."), deadline.scope(ACTION_DEADLINES["step2"]):
+                # 締め切りまでに終わらなければ途中の結果で進み、残りは Step 3 で反映できる
+                state.hp_json = engine.run(hp_session, sid, "finalize", {"text": final_text}) or hp_session.to_dict()
             
             state.step4 = True
+            persist()
             st.rerun()
 
 # ============================================================
@@ -330,7 +423,21 @@ if state.step2:
 
 if state.step4 and state.hp_json:
     st.header("ステップ 3：HPモデルの可視化 & SF物語生成", divider="grey")
+    render_budget_status()
     
+    # ドラフトモード・時間切れ: バックグラウンドの精緻化状況
+    refining = engine.has_pending_jobs(hp_session, sid)
+    if hp_session.draft_mode or refining:
+        pending = hp_session.pending_refinements()
+        drafts = hp_session.draft_node_count()
+        if refining or drafts:
+            c1, c2 = st.columns([4, 1])
+            c1.info(f"検索による精緻化を実行中です（残りジョブ: {pending} / ドラフトのままのノード: {drafts}）。")
+            if c2.button("🔄 精緻化結果を反映", key="btn_refresh_draft"):
+                state.hp_json = hp_session.to_dict()
+                persist()
+                st.rerun()
+
     # 可視化
     render_hp_visualization(state.hp_json)
 
@@ -341,6 +448,7 @@ if state.step4 and state.hp_json:
         state.hp_json = None
         # Step 2 の最終段階（UX選択）に戻る
         state.s2_ux = True
+        persist()
         st.rerun()
 
     st.write("---") 
@@ -355,10 +463,13 @@ if state.step4 and state.hp_json:
 
     if state.outline is None:
         if st.button("✨ ストーリー概要を生成する", key="btn_generate_outline", type="primary"):
-            with st.spinner("監督(Director)と作家(Agent)が協力してストーリーを構築中... (これには時間がかかります)"):
-                # Multi-Agent Story Generation
-                state.outline = state.story_gen.generate_story_outline(state.hp_json)
+            with st.spinner("監督(Director)と作家(Agent)が協力してストーリーを構築中... (これには時間がかかります)"), deadline.scope(ACTION_DEADLINES["story"]):
+                # Multi-Agent Story Generation (完成したセクションから順に表示)
+                with st.container(border=True):
+                    box = st.empty()
+                    state.outline = engine.run(hp_session, sid, "story", {"hp_json": state.hp_json}, progress=box.markdown)
             st.success("ストーリー概要が生成されました！")
+            persist()
             st.rerun()
 
     if state.outline:
@@ -369,15 +480,21 @@ if state.step4 and state.hp_json:
             mod = st.text_area("修正提案（通常のGPT修正）:", height=100, key="outline_modify")
             if st.button("🔁 更新", key="btn_modify"):
                 if mod.strip():
-                    with st.spinner("ストーリー概要修正中…"):
-                        new_outline = modify_outline(state.outline, mod)
+                    try:
+                        with st.spinner("ストーリー概要修正中…"), deadline.scope(ACTION_DEADLINES["modify"]):
+                            new_outline = st.write_stream(modify_outline_stream(state.outline, mod))
+                    except deadline.CallTimeout:
+                        st.error("⏱️ 時間切れのため修正できませんでした。もう一度お試しください。")
+                    else:
                         state.outline = new_outline
-                    st.success("ストーリー概要が更新されました。")
-                    st.rerun()
+                        st.success("ストーリー概要が更新されました。")
+                        persist()
+                        st.rerun()
 
         with col2:
             if st.button("✔️ 確定 & ダウンロードへ", key="btn_confirm"):
                 state.final_confirmed = True
+                persist()
                 st.success("確定しました！")
 
 # ============================================================
@@ -0,0 +1,437 @@
+# batch.py
+"""
+オフラインの一括生成（保存済みの全 HP モデルのストーリー再生成、時間切れで未生成のノードの埋め直し）。
+対話時のように1回ずつ API を呼ばず、同時に進めている全パイプラインのリクエストを1つのバッチファイルに
+まとめてバッチバックエンドへ投入し、結果が届いたら各パイプラインを再開する（レイテンシより件数とコストを優先）。
+
+    python batch.py story WORKDIR                       # 保存済みセッション（hp_sessions.db）のストーリー
+    python batch.py story WORKDIR --corpus hp.corpus    # hp_corpus のコーパスから
+    python batch.py fill WORKDIR                        # 時間切れのノードを埋め直してスナップショットを更新
+    python batch.py story WORKDIR --backend local       # OpenAI Batch API の代わりにローカルで処理
+
+中断しても同じ WORKDIR で再実行すれば、投入済みのバッチの結果を待ち、取得済みの応答を再利用して続きから進む。
+openai バックエンドは既定ルートのエンドポイントにまとめて投入する（[routing] で別の base_url を指定した呼び出し箇所は local を使う）。
+"""
+import argparse
+import hashlib
+import json
+import os
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+import llm
+import metrics
+
+# 1つのバッチに入れるリクエスト数の上限（OpenAI Batch API は 50,000 件まで）
+MAX_BATCH_REQUESTS = 50_000
+# 全パイプラインが待ちに入ってから投入するまでに、遅れて来るリクエストを待つ秒数
+LINGER_SECONDS = 0.5
+POLL_SECONDS = 30.0
+# 同時に進めるパイプライン（1本 = ストーリー1件 / ノード1つ）の数
+PARALLEL_PIPELINES = 500
+
+_ENDPOINT = "/v1/chat/completions"
+
+
+class BatchRequestError(RuntimeError):
+    """バッチ内の1件が失敗した"""
+
+
+class BatchFailed(RuntimeError):
+    """バッチ全体が出力の無いまま終わった（failed / expired / cancelled）"""
+
+
+# ============ Backends ============
+
+class OpenAIBatchBackend:
+    """OpenAI Batch API（24時間以内に処理、通常の呼び出しより安い）"""
+
+    def __init__(self):
+        self.client = llm.get_client()
+
+    def submit(self, input_path: str) -> str:
+        with open(input_path, "rb") as f:
+            uploaded = self.client.files.create(file=f, purpose="batch")
+        return self.client.batches.create(
+            input_file_id=uploaded.id, endpoint=_ENDPOINT, completion_window="24h"
+        ).id
+
+    def poll(self, batch_id: str):
+        """終わっていれば出力の各行（dict）のリスト、まだなら None"""
+        b = self.client.batches.retrieve(batch_id)
+        if b.status in ("validating", "in_progress", "finalizing", "cancelling"):
+            return None
+        lines = []
+        for file_id in (b.output_file_id, b.error_file_id):
+            if file_id:
+                text = self.client.files.content(file_id).text
+                lines += [json.loads(line) for line in text.splitlines() if line.strip()]
+        if not lines and b.status != "completed":
+            raise BatchFailed(f"batch {batch_id}: {b.status}")
+        return lines
+
+
+class LocalBatchBackend:
+    """
+    Batch API と同じ入出力形式をローカルで処理する代わりのバックエンド。
+    responder(site, body) -> 応答の dict を渡せば API を使わずに動作を確認できる（既定は通常の API 呼び出し）。
+    """
+
+    def __init__(self, workdir: str, responder=None, workers: int = 8):
+        self.dir = os.path.join(workdir, "local_batches")
+        os.makedirs(self.dir, exist_ok=True)
+        self.responder = responder or self._call_api
+        self.workers = workers
+        self._running = set()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _call_api(site: str, body: dict) -> dict:
+        return llm.get_client(site).chat.completions.create(**body).model_dump()
+
+    def _path(self, batch_id: str, kind: str) -> str:
+        return os.path.join(self.dir, f"{batch_id}.{kind}.jsonl")
+
+    def submit(self, input_path: str) -> str:
+        batch_id = f"local_{uuid.uuid4().hex}"
+        with open(input_path, encoding="utf-8") as src, open(self._path(batch_id, "input"), "w", encoding="utf-8") as dst:
+            dst.write(src.read())
+        self._start(batch_id)
+        return batch_id
+
+    def _start(self, batch_id: str):
+        with self._lock:
+            if batch_id in self._running:
+                return
+            self._running.add(batch_id)
+        threading.Thread(target=self._process, args=(batch_id,), daemon=True).start()
+
+    def _process(self, batch_id: str):
+        with open(self._path(batch_id, "input"), encoding="utf-8") as f:
+            requests = [json.loads(line) for line in f if line.strip()]
+
+        def one(req):
+            site = req["custom_id"].split(":", 1)[0]
+            try:
+                return {"custom_id": req["custom_id"], "response": {"status_code": 200, "body": self.responder(site, req["body"])}}
+            except Exception as e:
+                return {"custom_id": req["custom_id"], "error": {"message": str(e)}}
+
+        with ThreadPoolExecutor(max_workers=self.workers) as ex:
+            results = list(ex.map(one, requests))
+        tmp = self._path(batch_id, "output") + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            for r in results:
+                f.write(json.dumps(r, ensure_ascii=False) + "\n")
+        os.replace(tmp, self._path(batch_id, "output"))
+
+    def poll(self, batch_id: str):
+        out = self._path(batch_id, "output")
+        if os.path.exists(out):
+            with open(out, encoding="utf-8") as f:
+                return [json.loads(line) for line in f if line.strip()]
+        # 中断後の再実行: 処理中でなければ入力からやり直す
+        self._start(batch_id)
+        return None
+
+
+# ============ Sink (called from llm.chat / llm.parse) ============
+
+class BatchSink:
+    """
+    パイプラインのスレッドから来たリクエストを溜め、全パイプラインが応答待ちになったらバッチとして投入する。
+    応答は WORKDIR/results.jsonl に保存し、再実行時は同じリクエストにそこから即座に応答する。
+    """
+
+    def __init__(self, backend, workdir: str, max_batch: int = MAX_BATCH_REQUESTS, poll_seconds: float = POLL_SECONDS):
+        self.backend = backend
+        self.workdir = workdir
+        self.max_batch = max_batch
+        self.poll_seconds = poll_seconds
+        os.makedirs(os.path.join(workdir, "batches"), exist_ok=True)
+        self._results_path = os.path.join(workdir, "results.jsonl")
+        self._state_path = os.path.join(workdir, "state.json")
+        self._results = self._load_results()
+        self._state = self._load_state()
+        self._waiting = {}  # custom_id -> request line
+        self._live = 0      # 実行中のパイプライン数
+        self._blocked = 0   # 応答待ちのパイプライン数
+        self._closed = False  # これ以上パイプラインが始まらない
+        self._cond = threading.Condition()
+        self._thread = None
+
+    # --- persistence ---
+
+    def _load_results(self) -> dict:
+        results = {}
+        if os.path.exists(self._results_path):
+            with open(self._results_path, encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        r = json.loads(line)
+                    except json.JSONDecodeError:
+                        continue  # 書き込み途中で中断した最終行
+                    results[r["custom_id"]] = r
+        return results
+
+    def _load_state(self) -> dict:
+        if os.path.exists(self._state_path):
+            with open(self._state_path, encoding="utf-8") as f:
+                return json.load(f)
+        return {"pending": {}, "submitted": 0}
+
+    def _save_state(self):
+        tmp = self._state_path + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(self._state, f)
+        os.replace(tmp, self._state_path)
+
+    # --- pipeline side ---
+
+    @staticmethod
+    def custom_id(site: str, body: dict) -> str:
+        digest = hashlib.sha1(json.dumps(body, ensure_ascii=False, sort_keys=True).encode("utf-8")).hexdigest()
+        return f"{site}:{digest}"
+
+    def register(self):
+        with self._cond:
+            self._live += 1
+
+    def unregister(self):
+        with self._cond:
+            self._live -= 1
+            self._cond.notify_all()
+
+    def call(self, site: str, body: dict) -> dict:
+        """応答の body（chat.completion の dict）を返す。届くまでこのスレッドは待つ"""
+        cid = self.custom_id(site, body)
+        with self._cond:
+            if cid in self._results:
+                metrics.incr("batch.replayed")
+            else:
+                self._waiting.setdefault(cid, {"custom_id": cid, "method": "POST", "url": _ENDPOINT, "body": body})
+                self._blocked += 1
+                self._cond.notify_all()
+                while cid not in self._results:
+                    self._cond.wait()
+                self._blocked -= 1
+            result = self._results[cid]
+        if "error" in result:
+            raise BatchRequestError(f"{site}: {result['error']}")
+        return result["body"]
+
+    # --- dispatcher ---
+
+    def start(self):
+        # 前回の実行で投入済みのバッチは、投入し直さずに結果を待ってから始める
+        for batch_id in list(self._state["pending"]):
+            self._wait_batch(batch_id)
+        self._thread = threading.Thread(target=self._dispatch, daemon=True, name="hp-batch")
+        self._thread.start()
+
+    def close(self):
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+        self._thread.join()
+
+    def _ready(self) -> bool:
+        return bool(self._waiting) and (self._blocked >= self._live or len(self._waiting) >= self.max_batch)
+
+    def _dispatch(self):
+        while True:
+            with self._cond:
+                while not self._ready():
+                    if self._closed and not self._waiting:
+                        return
+                    self._cond.wait()
+                self._cond.wait(LINGER_SECONDS)
+                take = list(self._waiting.values())[:self.max_batch]
+                for req in take:
+                    del self._waiting[req["custom_id"]]
+            try:
+                self._submit(take)
+            except Exception as e:
+                # 投入に失敗したら待っているパイプラインを失敗させる（保存しないので再実行で投入し直す）
+                metrics.incr("batch.submit_errors")
+                with self._cond:
+                    self._results.update({r["custom_id"]: {"custom_id": r["custom_id"], "error": str(e)} for r in take})
+                    self._cond.notify_all()
+
+    def _submit(self, requests: list):
+        n = self._state["submitted"]
+        path = os.path.join(self.workdir, "batches", f"{n:05d}.input.jsonl")
+        with open(path, "w", encoding="utf-8") as f:
+            for req in requests:
+                f.write(json.dumps(req, ensure_ascii=False) + "\n")
+        batch_id = self.backend.submit(path)
+        self._state["pending"][batch_id] = [req["custom_id"] for req in requests]
+        self._state["submitted"] = n + 1
+        self._save_state()
+        metrics.incr("batch.submitted")
+        metrics.incr("batch.requests", len(requests))
+        self._wait_batch(batch_id)
+
+    def _wait_batch(self, batch_id: str):
+        start = time.monotonic()
+        missing, persist = "missing from batch output", True
+        try:
+            while True:
+                lines = self.backend.poll(batch_id)
+                if lines is not None:
+                    break
+                time.sleep(self.poll_seconds)
+        except BatchFailed as e:
+            # 全件をバッチの失敗理由で失敗させる。保存しないので再実行で投入し直す
+            metrics.incr("batch.failed")
+            lines, missing, persist = [], str(e), False
+        metrics.observe("batch.turnaround", time.monotonic() - start)
+
+        results = {}
+        for line in lines:
+            response = line.get("response") or {}
+            if response.get("status_code") == 200:
+                results[line["custom_id"]] = {"custom_id": line["custom_id"], "body": response["body"]}
+            else:
+                error = line.get("error") or response.get("body", {}).get("error") or "unknown error"
+                results[line["custom_id"]] = {"custom_id": line["custom_id"], "error": error}
+        for cid in self._state["pending"].get(batch_id, []):
+            results.setdefault(cid, {"custom_id": cid, "error": missing})
+
+        if persist:
+            with open(self._results_path, "a", encoding="utf-8") as f:
+                for r in results.values():
+                    f.write(json.dumps(r, ensure_ascii=False) + "\n")
+        self._state["pending"].pop(batch_id, None)
+        self._save_state()
+        with self._cond:
+            self._results.update(results)
+            self._cond.notify_all()
+
+
+def run_pipelines(sink: BatchSink, jobs: list, parallel: int = PARALLEL_PIPELINES) -> list:
+    """
+    jobs（引数なしの関数）をバッチモードで並行に実行し、(結果 or None, 例外 or None) のリストを返す。
+    """
+    def run(job):
+        sink.register()
+        llm.use_batch(sink)
+        try:
+            return job(), None
+        except Exception as e:
+            metrics.incr("batch.pipeline_errors")
+            return None, e
+        finally:
+            sink.unregister()
+
+    sink.start()
+    try:
+        with ThreadPoolExecutor(max_workers=parallel, thread_name_prefix="hp-bulk") as ex:
+            return list(ex.map(run, jobs))
+    finally:
+        sink.close()
+
+
+# ============ Bulk jobs ============
+
+def _hp_models(corpus: str = None):
+    if corpus:
+        import hp_corpus
+        yield from hp_corpus.import_sessions(corpus)
+        return
+    import session_store
+    from generate import HPGenerationSession
+    for sid, snapshot in session_store.iter_snapshots():
+        if "session" in snapshot:
+            hp = HPGenerationSession.from_snapshot(snapshot["session"]).to_dict()
+            if any(hp.values()):
+                yield sid, hp
+
+
+def bulk_stories(sink: BatchSink, out_dir: str, corpus: str = None, parallel: int = PARALLEL_PIPELINES) -> dict:
+    """HP モデルごとにストーリー概要を生成して out_dir/<session_id>.md に書く。既にあるものは飛ばす"""
+    from story_generator import StoryGenerator
+    os.makedirs(out_dir, exist_ok=True)
+    generator = StoryGenerator()
+
+    def job(sid, hp):
+        def run():
+            text = generator.generate_story_outline(hp)
+            with open(os.path.join(out_dir, f"{sid}.md"), "w", encoding="utf-8") as f:
+                f.write(text)
+            return sid
+        return run
+
+    todo = [(sid, hp) for sid, hp in _hp_models(corpus) if not os.path.exists(os.path.join(out_dir, f"{sid}.md"))]
+    results = run_pipelines(sink, [job(sid, hp) for sid, hp in todo], parallel)
+    return {"done": sum(1 for r, e in results if e is None), "failed": {sid: str(e) for (sid, _), (r, e) in zip(todo, results) if e}}
+
+
+def bulk_fill(sink: BatchSink, parallel: int = PARALLEL_PIPELINES) -> dict:
+    """
+    保存済みセッションの時間切れのノードを、同じステージにある HP グラフ上の近傍ノードから
+    simple_fill で埋め直し、スナップショットを更新する。
+    """
+    import session_store
+    from agent_context import NEIGHBOURS
+    from generate import HPGenerationSession, TIMEOUT_TEXT
+    from prompt import HP_model
+
+    sessions, targets = {}, []
+    for sid, snapshot in session_store.iter_snapshots():
+        if "session" not in snapshot:
+            continue
+        session = HPGenerationSession.from_snapshot(snapshot["session"])
+        for stage in ("hp_mt_0", "hp_mt_1", "hp_mt_2"):
+            nodes = getattr(session, stage)
+            for nid, name in HP_model.items():
+                if nodes.get(name) != TIMEOUT_TEXT:
+                    continue
+                sources = [s for s in sorted(NEIGHBOURS[nid]) if nodes.get(HP_model[s]) not in (None, "", TIMEOUT_TEXT)]
+                if sources:
+                    sessions[sid] = session
+                    targets.append((sid, stage, nid, sources[0], nodes[HP_model[sources[0]]]))
+
+    def job(sid, stage, nid, src, src_text):
+        def run():
+            text = sessions[sid].simple_fill(src, src_text, nid)
+            if text != TIMEOUT_TEXT:
+                sessions[sid].set_node(stage, nid, text, "gpt")
+            return text
+        return run
+
+    results = run_pipelines(sink, [job(*t) for t in targets], parallel)
+    for sid, session in sessions.items():
+        session_store.update_snapshot(sid, session=session.to_snapshot())
+    return {"nodes": len(targets), "filled": sum(1 for r, e in results if e is None and r != TIMEOUT_TEXT), "sessions": len(sessions)}
+
+
+# ============ CLI ============
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("cmd", choices=["story", "fill"])
+    parser.add_argument("workdir", help="バッチファイル・応答・進捗を置くディレクトリ（再実行で続きから）")
+    parser.add_argument("--backend", choices=["openai", "local"], default="openai")
+    parser.add_argument("--corpus", help="story: 保存済みセッションの代わりに読む hp_corpus のコーパス")
+    parser.add_argument("--parallel", type=int, default=PARALLEL_PIPELINES)
+    parser.add_argument("--poll", type=float, default=POLL_SECONDS, help="バッチの完了を確認する間隔（秒）")
+    args = parser.parse_args()
+
+    os.makedirs(args.workdir, exist_ok=True)
+    backend = OpenAIBatchBackend() if args.backend == "openai" else LocalBatchBackend(args.workdir)
+    sink = BatchSink(backend, args.workdir, poll_seconds=args.poll)
+    start = time.perf_counter()
+    if args.cmd == "story":
+        summary = bulk_stories(sink, os.path.join(args.workdir, "stories"), args.corpus, args.parallel)
+    else:
+        summary = bulk_fill(sink, args.parallel)
+    summary["seconds"] = round(time.perf_counter() - start, 1)
+    summary["metrics"] = metrics.snapshot("batch.")["counters"]
+    print(json.dumps(summary, ensure_ascii=False, indent=2))
+
+
+if __name__ == "__main__":
+    main()
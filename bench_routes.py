@@ -0,0 +1,65 @@
+# bench_routes.py
+"""
+呼び出し箇所ごとのルート（model / base_url）のレイテンシを比較するベンチマーク。
+
+    python bench_routes.py                       # すべてのルートを計測
+    python bench_routes.py simple_fill judge -n 10
+    python bench_routes.py simple_fill --model gpt-4o --model gpt-4o-mini
+"""
+import argparse
+import statistics
+import time
+from contextlib import nullcontext
+
+import llm
+from prompt import SYSTEM_PROMPT
+
+# 50文字ノード程度の短い出力を求める代表的なプロンプト
+BENCH_PROMPT = """
+HPモデルに基づき分析します。
+【入力ノード】人々の価値観
+【内容】自分の時間を大切にしたい
+この内容を分析して、論理的に接続する【習慣化】の内容を作成してください。
+**50文字以内**で簡潔に記述してください。
+"""
+
+
+def bench_route(site: str, n: int) -> list[float]:
+    latencies = []
+    for _ in range(n):
+        start = time.perf_counter()
+        llm.chat(
+            site,
+            [
+                {"role": "system", "content": SYSTEM_PROMPT},
+                {"role": "user", "content": BENCH_PROMPT}
+            ],
+            max_tokens=100,
+        )
+        latencies.append(time.perf_counter() - start)
+    return latencies
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("sites", nargs="*", default=[s for s in llm.ROUTES if s != "default"])
+    parser.add_argument("-n", type=int, default=5, help="ルートごとの試行回数")
+    parser.add_argument("--model", action="append", default=[], help="ルートの model を差し替えて比較する（複数指定可）")
+    args = parser.parse_args()
+
+    print(f"{'site':<14} {'model':<28} {'base_url':<28} {'mean':>7} {'p50':>7} {'max':>7}")
+    for site in args.sites:
+        variants = args.model or [None]
+        for model in variants:
+            # secrets.toml の [routing] で model が指定されていても --model を優先する
+            with llm.override_route(site, model=model) if model else nullcontext():
+                conf = llm.route(site)
+                lat = bench_route(site, args.n)
+            print(
+                f"{site:<14} {conf['model']:<28} {str(conf['base_url'] or 'default'):<28} "
+                f"{statistics.mean(lat):7.2f} {statistics.median(lat):7.2f} {max(lat):7.2f}"
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,126 @@
+# budget.py
+import contextvars
+import threading
+import time
+
+import streamlit as st
+
+import metrics
+
+# セッションごとのトークン / Tavily 呼び出しの予算と、使い切りそうなときの段階的な縮退
+
+# 既定の上限（secrets.toml の [budget] max_tokens / max_tavily_calls で上書き可）
+MAX_TOKENS = 300_000
+MAX_TAVILY_CALLS = 60
+
+# 消費率がこの値を超えたら縮退する: (消費率, 縮退の種類, UI に表示する説明)
+DEGRADATION_STEPS = [
+    (0.5, "debate_rounds_2", "エージェントの議論を 3 ラウンドから 2 ラウンドに減らしました"),
+    (0.7, "no_search", "Tavily 検索をやめ、GPT のみでノードを埋めるようにしました"),
+    (0.8, "debate_rounds_1", "エージェントの議論を 1 ラウンドに減らしました"),
+    (0.9, "no_critic_retry", "ストーリー生成で総監督のレビューと書き直しを省略しました"),
+]
+
+# 実行中の処理が属するセッションの予算（ワーカーへは submit で引き継ぐ）
+_current = contextvars.ContextVar("hp_session_budget", default=None)
+
+
+class SessionBudget:
+    def __init__(self, max_tokens: int = None, max_tavily_calls: int = None):
+        conf = st.secrets.get("budget", {})
+        self.max_tokens = max_tokens or int(conf.get("max_tokens", MAX_TOKENS))
+        self.max_tavily_calls = max_tavily_calls or int(conf.get("max_tavily_calls", MAX_TAVILY_CALLS))
+        self.tokens = 0
+        self.tavily_calls = 0
+        self.decisions = []  # [{"kind", "message", "used", "at"}]
+        self._lock = threading.Lock()
+
+    def used(self) -> float:
+        """トークンと Tavily のうち、消費率の高い方"""
+        return max(self.tokens / self.max_tokens, self.tavily_calls / self.max_tavily_calls)
+
+    def _update_decisions(self):
+        # self._lock を保持した状態で呼ぶ
+        used = self.used()
+        taken = {d["kind"] for d in self.decisions}
+        for threshold, kind, message in DEGRADATION_STEPS:
+            if used >= threshold and kind not in taken:
+                self.decisions.append({"kind": kind, "message": message, "used": round(used, 3), "at": time.time()})
+                metrics.incr(f"budget.degraded.{kind}")
+
+    def add_tokens(self, n: int):
+        with self._lock:
+            self.tokens += n
+            self._update_decisions()
+
+    def add_tavily_call(self):
+        with self._lock:
+            self.tavily_calls += 1
+            self._update_decisions()
+
+    def degraded(self, kind: str) -> bool:
+        with self._lock:
+            return any(d["kind"] == kind for d in self.decisions)
+
+    def debate_rounds(self, default: int) -> int:
+        if self.degraded("debate_rounds_1"):
+            return 1
+        if self.degraded("debate_rounds_2"):
+            return min(default, 2)
+        return default
+
+    def allow_search(self) -> bool:
+        return not self.degraded("no_search") and self.tavily_calls < self.max_tavily_calls
+
+    def allow_critic_retry(self) -> bool:
+        return not self.degraded("no_critic_retry")
+
+    def to_snapshot(self) -> dict:
+        with self._lock:
+            return {"tokens": self.tokens, "tavily_calls": self.tavily_calls, "decisions": list(self.decisions)}
+
+    def load_snapshot(self, data: dict):
+        """スナップショットの消費量で置き換える（実行中のジョブが参照している同じオブジェクトを更新する）"""
+        with self._lock:
+            self.tokens = data.get("tokens", 0)
+            self.tavily_calls = data.get("tavily_calls", 0)
+            self.decisions = list(data.get("decisions", []))
+
+    @classmethod
+    def from_snapshot(cls, data: dict) -> "SessionBudget":
+        budget = cls()
+        budget.load_snapshot(data)
+        return budget
+
+
+def estimate_tokens(text: str) -> int:
+    # 日本語はおおよそ1文字1トークン、ASCII は4文字で1トークンとみなす
+    ascii_chars = sum(1 for c in text if ord(c) < 128)
+    return (len(text) - ascii_chars) + (ascii_chars + 3) // 4
+
+
+def current():
+    """実行中の処理が属するセッションの SessionBudget（無ければ None）"""
+    return _current.get()
+
+
+def activate(budget: SessionBudget):
+    _current.set(budget)
+
+
+def submit(executor, fn, *args, **kwargs):
+    """現在のコンテキスト（予算）を引き継いで executor に投入する"""
+    return executor.submit(contextvars.copy_context().run, fn, *args, **kwargs)
+
+
+def record_usage(usage):
+    """OpenAI の usage を現在のセッションの予算に加算する"""
+    budget = _current.get()
+    if budget is not None and usage is not None:
+        budget.add_tokens(getattr(usage, "total_tokens", 0) or 0)
+
+
+def record_tavily_call():
+    budget = _current.get()
+    if budget is not None:
+        budget.add_tavily_call()
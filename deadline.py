@@ -0,0 +1,79 @@
+# deadline.py
+import contextvars
+import time
+from contextlib import contextmanager
+
+import metrics
+
+# ユーザー操作ごとの締め切り。ネストした OpenAI / Tavily 呼び出しのタイムアウトになる。
+# コンテキスト変数なので budget.submit / HPGenerationSession._submit でワーカーにも引き継がれる。
+
+# 1回の呼び出しのタイムアウト上限（締め切りが無いときもこれで打ち切る）
+DEFAULT_CALL_TIMEOUT = 60.0
+CALL_TIMEOUTS = {
+    "agent_think": 30.0,
+    "simple_fill": 30.0,
+    "query_gen": 20.0,
+    "condense": 20.0,
+    "tavily": 30.0,
+}
+
+# 残りがこの秒数を切ったら、審査や書き直しなどの省略できる処理を飛ばす
+NEAR_SECONDS = 10.0
+
+# 時間切れで生成できなかったノードのテキスト
+TIMEOUT_TEXT = "（時間切れのため未生成）"
+
+_deadline = contextvars.ContextVar("hp_deadline", default=None)  # time.monotonic() 基準
+
+
+class CallTimeout(TimeoutError):
+    """締め切り切れ、または1回の呼び出しのタイムアウト"""
+
+    def __init__(self, site: str):
+        super().__init__(f"{site}: timed out")
+        self.site = site
+
+
+@contextmanager
+def scope(seconds: float, reset: bool = False):
+    """
+    この中の処理に seconds 秒の締め切りを設ける。外側により早い締め切りがあればそちらを使う。
+    reset=True なら外側の締め切りを引き継がない（バックグラウンドジョブ用）。
+    """
+    outer = _deadline.get()
+    end = time.monotonic() + seconds
+    if outer is not None and not reset:
+        end = min(end, outer)
+    token = _deadline.set(end)
+    try:
+        yield
+    finally:
+        _deadline.reset(token)
+
+
+def remaining():
+    """締め切りまでの秒数（締め切りが無ければ None）"""
+    end = _deadline.get()
+    return None if end is None else end - time.monotonic()
+
+
+def near(seconds: float = NEAR_SECONDS) -> bool:
+    left = remaining()
+    return left is not None and left < seconds
+
+
+def timeout_for(site: str) -> float:
+    """この呼び出しに使えるタイムアウト。締め切りを過ぎていれば CallTimeout"""
+    cap = CALL_TIMEOUTS.get(site, DEFAULT_CALL_TIMEOUT)
+    left = remaining()
+    if left is None:
+        return cap
+    if left <= 0:
+        record_timeout(site)
+        raise CallTimeout(site)
+    return min(cap, left)
+
+
+def record_timeout(site: str):
+    metrics.incr(f"timeout.{site}")
@@ -0,0 +1,162 @@
+# engine.py
+import time
+
+import streamlit as st
+
+import budget
+import deadline
+import job_queue
+import session_store
+import similarity_index
+from story_generator import StoryGenerator
+
+# UI の各操作（Q1〜Q4、Step 2 の確定、ストーリー生成）を実行する。
+#   inline: Streamlit サーバーのプロセス内でそのまま実行する（既定）
+#   queue : job_queue に投入し、worker.py のプロセスが実行した結果を待つ
+# secrets.toml の [engine] mode で切り替える。
+
+POLL_SECONDS = 0.5
+# queue モードで締め切りが無いときに結果を待つ上限
+DEFAULT_WAIT_SECONDS = 300
+
+# ユーザー操作ごとの締め切り（秒）。中の OpenAI / Tavily 呼び出しすべてに伝わる
+ACTION_DEADLINES = {"q4": 120, "step2": 90, "story": 240, "modify": 60}
+
+_story_generator = StoryGenerator()
+
+
+def mode() -> str:
+    return st.secrets.get("engine", {}).get("mode", "inline")
+
+
+# queue モードではこのプロセス（UI / API）は生成状態を保存しない。
+# 最初の操作より前の保存（autosave など）にも効くよう、読み込み時に決める
+session_store.remote_sessions = mode() == "queue"
+
+
+def query_mode() -> str:
+    """新規セッションの検索クエリの作り方（secrets.toml の [search] query_mode）"""
+    return st.secrets.get("search", {}).get("query_mode", "llm")
+
+
+# ============ Handlers (shared by inline mode and worker.py) ============
+
+def _q1(session, p, progress):
+    session.handle_input1(p["text"])
+
+def _q2(session, p, progress):
+    session.handle_input2(p["text"])
+
+def _q3(session, p, progress):
+    session.handle_input3(p["text"])
+
+def _q4(session, p, progress):
+    session.draft_mode = p.get("draft_mode", False)
+    if p.get("warm_start"):
+        match = similarity_index.find_warm_start({**session.user_inputs, "q4_value": p["text"]}, exclude=p.get("sid"))
+        if match:
+            session.warm_start(match)
+    session.start_from_values_and_trigger_future(p["text"])
+    if session.draft_mode:
+        session.wait_drafts()
+    return session.get_future_adv_candidates()
+
+def _goals(session, p, progress):
+    return session.generate_goals_from_adv(p["text"])
+
+def _values(session, p, progress):
+    return session.generate_values_from_goal(p["text"])
+
+def _habits(session, p, progress):
+    return session.generate_habits_from_value(p["text"])
+
+def _ux(session, p, progress):
+    return session.generate_ux_from_habit(p["text"])
+
+def _finalize(session, p, progress):
+    session.finalize_mtplus1(p["text"])
+    if not session.draft_mode:
+        session.wait_all(timeout=deadline.remaining())
+    return session.to_dict()
+
+def _story(session, p, progress):
+    text = ""
+    for section in _story_generator.stream_story_outline(p["hp_json"]):
+        text += section
+        progress(text)
+    return text
+
+
+HANDLERS = {
+    "q1": _q1, "q2": _q2, "q3": _q3, "q4": _q4,
+    "goals": _goals, "values": _values, "habits": _habits, "ux": _ux,
+    "finalize": _finalize, "story": _story,
+}
+
+# 各操作に使う ACTION_DEADLINES のキー（Q1〜Q3 はその場で LLM を待たないので締め切りなし）
+DEADLINE_KEYS = {
+    "q4": "q4",
+    "goals": "step2", "values": "step2", "habits": "step2", "ux": "step2", "finalize": "step2",
+    "story": "story",
+}
+
+# queue モードで待ちきれなかったときの結果（途中の結果で先に進む）
+TIMEOUT_RESULTS = {
+    "q4": [],
+    "goals": ["生成失敗"], "values": ["生成失敗"], "habits": ["生成失敗"], "ux": ["生成失敗"],
+}
+
+
+def execute(session, kind: str, payload: dict, progress=lambda text: None):
+    """ハンドラをこのプロセスで実行する（予算はセッションのもの）"""
+    budget.activate(session.budget)
+    return HANDLERS[kind](session, payload, progress)
+
+
+# ============ Entry point for app.py ============
+
+def has_pending_jobs(session, session_id: str) -> bool:
+    """バックグラウンドの生成が残っているか（queue モードではワーカー側のジョブを見る）"""
+    if mode() == "queue":
+        return job_queue.active(session_id)
+    return session.has_pending_jobs()
+
+
+def run(session, session_id: str, kind: str, payload: dict, progress=lambda text: None):
+    """
+    操作を実行して結果を返す。queue モードではジョブを投入して完了を待ち、
+    ワーカーが保存した生成状態をメモリ上のセッションに取り込む。
+    """
+    if mode() != "queue":
+        return execute(session, kind, payload, progress)
+
+    if "session" not in (session_store.load_snapshot(session_id) or {}):
+        # ワーカーが読めるように、まだ保存していない新規セッションを書き出しておく
+        session_store.update_snapshot(session_id, session=session.to_snapshot())
+    left = deadline.remaining()
+    wait_seconds = DEFAULT_WAIT_SECONDS if left is None else max(0.0, left)
+    job_id = job_queue.enqueue(session_id, kind, payload, deadline_seconds=wait_seconds)
+
+    end = time.monotonic() + wait_seconds
+    shown = ""
+    while True:
+        job = job_queue.get(job_id)
+        if job and job["progress"] != shown:
+            shown = job["progress"]
+            progress(shown)
+        if job and job["status"] in ("settling", "done", "error"):
+            break
+        if time.monotonic() >= end:
+            deadline.record_timeout(f"job.{kind}")
+            # まだ始まっていなければ取り消す（締め切りを過ぎてから空の時間で実行させない）
+            job_queue.cancel(job_id)
+            session_store.reload(session_id)
+            if kind == "story":
+                return shown + "\n\n> ⏱️ 時間切れのため、ここまでの内容で打ち切りました。\n"
+            return TIMEOUT_RESULTS.get(kind)
+        time.sleep(POLL_SECONDS)
+
+    session_store.reload(session_id)
+    if job["status"] == "error":
+        raise RuntimeError(f"job {kind} failed: {job['error']}")
+    return job["result"]
@@ -1,25 +1,81 @@
 # generate.py
+import contextvars
 import json
-from concurrent.futures import ThreadPoolExecutor, Future
+import threading
+from concurrent.futures import ThreadPoolExecutor, Future, wait, TimeoutError as FutureTimeout
 from typing import Dict, List, Optional
 
 from prompt import (
     HP_model,
     single_gpt,
     list_up_gpt,
+    draft_stage_gpt,
     generate_question_for_tavily,
+    generate_questions_for_tavily_batch,
+    template_question_for_tavily,
     tavily_generate_answer,
 )
-from agent_manager import AgentManager  # Import Multi-Agent Manager
+from agent_manager import AgentManager, DEBATE_ROUNDS  # Import Multi-Agent Manager
+import budget
+import deadline
+from budget import SessionBudget
+from deadline import CallTimeout, TIMEOUT_TEXT
+from llm import StructuredOutputError
+from node_budget import enforce_budget
+import metrics
+from agent_context import build_agent_context, record_reduction
+from transport import GENERATION_WORKERS
+
+# 全セッションで共有するワーカーとエージェント管理（セッションごとにスレッドやクライアントを持たない）
+_executor = ThreadPoolExecutor(max_workers=GENERATION_WORKERS, thread_name_prefix="hp-gen")
+_agent_manager = AgentManager()
+
+# バックグラウンドの穴埋めジョブの締め切り（投入した操作の締め切りとは独立）
+FILL_DEADLINE = 300
+
+_NODE_IDS = {name: nid for nid, name in HP_model.items()}
+
+# 暫定値の出所。確定済み（それ以外の出所）のノードは上書きしない
+_PROVISIONAL = ("draft", "warm")
+
+# ノード状態のログがこの件数を超えたら、ノードごとの最新の状態だけに詰める
+MAX_NODE_EVENTS = 4 * 3 * len(HP_model)
 
 class HPGenerationSession:
-    def __init__(self, max_workers: int = 8):
+    __slots__ = (
+        "hp_mt_0", "hp_mt_1", "hp_mt_2", "provenance", "raw_nodes", "_lock",
+        "draft_mode", "draft_futures", "query_mode", "_query_cache",
+        "all_futures", "user_inputs", "future_candidates_adv", "mtplus1_candidates", "agents",
+        "node_events", "_event_seq", "_plans", "warm_source", "warm_kept", "budget", "on_change",
+    )
+
+    def __init__(self, draft_mode: bool = False, query_mode: str = "llm"):
         self.hp_mt_0: Dict[str, str] = {}  # Mt-1 (過去)
         self.hp_mt_1: Dict[str, str] = {}  # Mt (現在)
         self.hp_mt_2: Dict[str, str] = {}  # Mt+1 (未来)
 
-        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+        # 各ノードの出所: user / tavily / gpt / draft / warm / reused / fixed
+        self.provenance: Dict[str, Dict[str, str]] = {"hp_mt_0": {}, "hp_mt_1": {}, "hp_mt_2": {}}
+        # 文字数予算で圧縮する前の元テキスト（検索結果など）
+        self.raw_nodes: Dict[str, Dict[str, str]] = {"hp_mt_0": {}, "hp_mt_1": {}, "hp_mt_2": {}}
+        self._lock = threading.Lock()
+
+        # 高速ドラフトモード: 1回の呼び出しでステージ全体を先に埋め、
+        # 検索ベースの逐次パイプラインはバックグラウンドでドラフトを置き換える
+        self.draft_mode = draft_mode
+        self.draft_futures: List[Future] = []
+
+        # 検索クエリの作り方: llm=1件ずつ / batch=ステージ単位でまとめて1回 / template=LLMなし
+        self.query_mode = query_mode
+        self._query_cache: Dict[tuple, tuple] = {}
+
         self.all_futures: List[Future] = []
+
+        # ライブ可視化用: ノードの状態変化のログ (pending / in_progress / draft / done / error)
+        self.node_events: List[dict] = []
+        self._event_seq = 0
+        # 実行中ジョブがこれから埋める (stage, node_id) の順番
+        self._plans: List[list] = []
         
         self.user_inputs = {
             "q1_ux": "",
@@ -37,72 +93,291 @@ class HPGenerationSession:
             "ux_future": [],
         }
         
-        # New: Agent Manager for Step 2
-        self.agent_manager = AgentManager()
+        # Step 2 の専門家エージェント（AgentManager は共有、ロスターはセッションごと）
+        self.agents: List[dict] = []
+
+        # ウォームスタートに使った過去セッション {"session_id", "score", "kept"}
+        self.warm_source: Optional[dict] = None
+        # 類似度が高く、精緻化せずにそのまま使うウォームスタートのノード (stage, node_id)
+        self.warm_kept: set = set()
+
+        # トークン / Tavily の予算（使い切りそうになると安い方法に切り替える）
+        self.budget = SessionBudget()
+
+        # ノードの書き込み・ジョブの完了のたびに呼ばれる（session_store が保存に使う）
+        self.on_change = None
+
+    @property
+    def executor(self) -> ThreadPoolExecutor:
+        return _executor
+
+    def _submit(self, fn, *args) -> Future:
+        # 呼び出し元に関係なく、このセッションの予算を有効にしてワーカーで実行する
+        ctx = contextvars.copy_context()
+        ctx.run(budget.activate, self.budget)
+        return self.executor.submit(ctx.run, fn, *args)
+
+    def _track(self, future: Future) -> Future:
+        # 完了済みのジョブは手放す
+        self.all_futures = [f for f in self.all_futures if not f.done()]
+        self.all_futures.append(future)
+        future.add_done_callback(lambda _: self._changed())
+        return future
+
+    def _changed(self):
+        if self.on_change is not None:
+            self.on_change()
+
+    # ============ Node status (live visualization) ============
+    def _emit(self, stage: str, node_id: int, status: str, text: str = ""):
+        # self._lock を保持した状態で呼ぶ
+        self._event_seq += 1
+        self.node_events.append({
+            "seq": self._event_seq,
+            "stage": int(stage[-1]),
+            "node_id": node_id,
+            "status": status,
+            "text": text,
+        })
+        if len(self.node_events) > MAX_NODE_EVENTS:
+            self._compact_events()
+
+    def _compact_events(self):
+        # self._lock を保持した状態で呼ぶ。
+        # 上書きされた古い状態を捨てる（どの位置から読んでも、各ノードの最新の状態は必ず受け取れる）
+        latest = {}
+        for e in self.node_events:
+            latest[(e["stage"], e["node_id"])] = e
+        self.node_events = sorted(latest.values(), key=lambda e: e["seq"])
+
+    def node_deltas(self, since: int = 0) -> List[dict]:
+        """seq が since より後の状態変化を返す"""
+        with self._lock:
+            return [dict(e) for e in self.node_events if e["seq"] > since]
+
+    def node_seq(self) -> int:
+        """最後に記録した状態変化の seq"""
+        with self._lock:
+            return self._event_seq
+
+    def _submit_fill(self, plan: list, fn, *args) -> Future:
+        """
+        plan の順に (stage, node_id) を埋めるジョブを投入する。
+        投入時は pending、開始時に先頭を in_progress にし、以降は set_node のたびに次へ進む。
+        """
+        plan = list(plan)
+        with self._lock:
+            for stage, nid in plan:
+                self._emit(stage, nid, "pending")
+
+        def run():
+            with self._lock:
+                self._plans.append(plan)
+                if plan:
+                    self._emit(*plan[0], "in_progress")
+            try:
+                with deadline.scope(FILL_DEADLINE, reset=True):
+                    return fn(*args)
+            except Exception:
+                with self._lock:
+                    for stage, nid in plan:
+                        self._emit(stage, nid, "error")
+                    plan.clear()
+                raise
+            finally:
+                with self._lock:
+                    self._plans.remove(plan)
+
+        return self._track(self._submit(run))
+
+    def _advance_plans(self, stage: str, node_id: int):
+        # self._lock を保持した状態で呼ぶ
+        for plan in self._plans:
+            if (stage, node_id) in plan:
+                plan.remove((stage, node_id))
+                if plan:
+                    self._emit(*plan[0], "in_progress")
 
     # ============ Utils ============
-    def tavily_from_nodes(self, input_id: int, input_text: str, output_id: int, time_state: int) -> str:
+    def set_node(self, stage: str, node_id: int, text: str, source: str):
+        """
+        ノードを書き込み、出所を記録する。ドラフト・ウォームスタートは確定済みのノードを上書きしない。
+        warm_kept のノードはユーザー入力以外では上書きしない。
+        ユーザー入力以外は文字数予算に収め、元のテキストは raw_nodes に残す。
+        """
+        key = HP_model[node_id]
+        raw = text
+        if source != "user":
+            text = enforce_budget(text, condense=(source not in _PROVISIONAL))
+        with self._lock:
+            if source in _PROVISIONAL and self.provenance[stage].get(key, source) not in _PROVISIONAL:
+                return
+            if source != "user" and (stage, node_id) in self.warm_kept:
+                return
+            getattr(self, stage)[key] = text
+            self.provenance[stage][key] = source
+            if text != raw:
+                self.raw_nodes[stage][key] = raw
+            else:
+                self.raw_nodes[stage].pop(key, None)
+            self._emit(stage, node_id, "draft" if source in _PROVISIONAL else "done", text)
+            if source not in _PROVISIONAL:
+                self._advance_plans(stage, node_id)
+        self._changed()
+
+    def prefetch_queries(self, specs: list):
+        """
+        batch モード: 既に分かっている (input_id, input_text, output_id, time_state) の検索クエリを
+        1回の呼び出しでまとめて先に作っておく。
+        """
+        if self.query_mode != "batch" or len(specs) < 2:
+            return
+        future = self._submit(
+            generate_questions_for_tavily_batch,
+            [(HP_model[i], text, HP_model[o], t) for i, text, o, t in specs]
+        )
+        for idx, spec in enumerate(specs):
+            self._query_cache[spec] = (future, idx)
+
+    def _question(self, input_id: int, input_text: str, output_id: int, time_state: int) -> str:
+        spec = (input_id, input_text, output_id, time_state)
+        args = (HP_model[input_id], input_text, HP_model[output_id], time_state)
+        if self.query_mode == "template":
+            return template_question_for_tavily(*args)
+        if spec in self._query_cache:
+            future, idx = self._query_cache.pop(spec)
+            # 共有ワーカーが埋まっていてまだ始まっていなければ、待たずに個別生成する
+            if not future.cancel():
+                try:
+                    return future.result()[idx]
+                except Exception as e:
+                    print(f"Batch query generation failed: {e}")
+        try:
+            return generate_question_for_tavily(*args)
+        except CallTimeout:
+            return template_question_for_tavily(*args)
+
+    def tavily_from_nodes(self, input_id: int, input_text: str, output_id: int, time_state: int) -> tuple:
+        """(テキスト, 出所) を返す。予算縮退で検索を省いたときの出所は gpt"""
         # time_state: 0=過去, 1=現在
+        if not self.budget.allow_search():
+            # 予算縮退: 検索をやめて GPT のみで埋める
+            metrics.incr("budget.search_skipped")
+            return self.simple_fill(input_id, input_text, output_id), "gpt"
         return tavily_generate_answer(
-            generate_question_for_tavily(HP_model[input_id], input_text, HP_model[output_id], time_state)
-        )
+            self._question(input_id, input_text, output_id, time_state),
+            time_state
+        ), "tavily"
 
-    def simple_fill(self, input_id: int, input_text: str, output_id: int) -> str:
+    def simple_fill(self, input_id: int, input_text: str, output_id: int, context: str = "") -> str:
         # GPTのみで高速に埋める（Tavilyなし）
-        return single_gpt(HP_model[input_id], input_text, HP_model[output_id])
+        try:
+            return single_gpt(HP_model[input_id], input_text, HP_model[output_id], context=context)
+        except CallTimeout:
+            return TIMEOUT_TEXT
     
     # NEW: Wrapper to call AgentManager.run_multi_agent_generation
     def run_multi_agent(self, element_type, element_desc, topic, context):
-        # 将 context 整合进 full_context_str
-        full_context = f"現在の状況: {self.hp_mt_1}\nユーザー入力: {self.user_inputs}\n具体的な文脈: {context}"
-        return self.agent_manager.run_multi_agent_generation(element_type, element_desc, topic, full_context)
+        # HP グラフ上の近傍とユーザー入力だけを、トークン予算内で文脈にする
+        hp = self.to_dict()
+        full_context = build_agent_context(
+            _NODE_IDS[element_type], hp["hp_mt_1"], hp["hp_mt_2"], self.user_inputs, context
+        )
+        record_reduction(
+            element_type,
+            f"現在の状況: {hp['hp_mt_1']}\nユーザー入力: {self.user_inputs}\n具体的な文脈: {context}",
+            full_context,
+        )
+        try:
+            if not self.agents:
+                self.agents = _agent_manager.generate_agents(topic)
+        except (CallTimeout, StructuredOutputError) as e:
+            print(f"Agent generation failed: {e}")
+            return ["生成失敗"]
+        return _agent_manager.run_multi_agent_generation(
+            self.agents, element_type, element_desc, topic, full_context,
+            rounds=self.budget.debate_rounds(DEBATE_ROUNDS),
+        )
 
     # ============ Step 1: User Input Handling ============
 
     def handle_input1(self, ux_text: str):
         # Mtのゴール地点としてのUX (HP:5)
-        self.hp_mt_1[HP_model[5]] = ux_text 
+        self.set_node("hp_mt_1", 5, ux_text, "user")
         self.user_inputs["q1_ux"] = ux_text
         
         # UXから派生する「現在」の要素を検索
+        self.prefetch_queries([(5, ux_text, 18, 1), (5, ux_text, 17, 1)])
+
         def job_art():
             # UX -> Art (18)
-            art = self.tavily_from_nodes(5, ux_text, 18, 1)
-            self.hp_mt_1[HP_model[18]] = art
+            art, source = self.tavily_from_nodes(5, ux_text, 18, 1)
+            self.set_node("hp_mt_1", 18, art, source)
             return art
         
         def job_be_and_inst():
             # UX -> BizEco (17) -> Institution (6)
-            be = self.tavily_from_nodes(5, ux_text, 17, 1)
-            self.hp_mt_1[HP_model[17]] = be
-            inst = self.tavily_from_nodes(17, be, 6, 1)
-            self.hp_mt_1[HP_model[6]] = inst
+            be, source = self.tavily_from_nodes(5, ux_text, 17, 1)
+            self.set_node("hp_mt_1", 17, be, source)
+            inst, source = self.tavily_from_nodes(17, be, 6, 1)
+            self.set_node("hp_mt_1", 6, inst, source)
             return inst
 
-        self.all_futures.append(self.executor.submit(job_art))
-        self.all_futures.append(self.executor.submit(job_be_and_inst))
+        self._submit_fill([("hp_mt_1", 18)], job_art)
+        self._submit_fill([("hp_mt_1", 17), ("hp_mt_1", 6)], job_be_and_inst)
 
     def handle_input2(self, product_text: str):
-        self.hp_mt_1[HP_model[14]] = product_text
+        self.set_node("hp_mt_1", 14, product_text, "user")
         self.user_inputs["q2_product"] = product_text
         
         def job_tech_mt():
             # Product -> Tech (4)
-            tech = self.tavily_from_nodes(14, product_text, 4, 1)
-            self.hp_mt_1[HP_model[4]] = tech
+            tech, source = self.tavily_from_nodes(14, product_text, 4, 1)
+            self.set_node("hp_mt_1", 4, tech, source)
             return tech
-        self.all_futures.append(self.executor.submit(job_tech_mt))
+        self._submit_fill([("hp_mt_1", 4)], job_tech_mt)
 
     def handle_input3(self, mean_text: str):
-        self.hp_mt_1[HP_model[13]] = mean_text
+        self.set_node("hp_mt_1", 13, mean_text, "user")
         self.user_inputs["q3_meaning"] = mean_text
 
+    def warm_start(self, match: dict):
+        """
+        類似した過去セッション（similarity_index.find_warm_start の結果）の Mt / Mt-1 と
+        エージェント構成を取り込む。ユーザー入力や生成済みのノードは上書きしない。
+        取り込んだノードはドラフトと同じ暫定値で、バックグラウンドの穴埋めジョブが順に置き換える。
+        match["keep"] が真（類似度が十分に高い）なら、穴埋めジョブが埋めるノードは確定値（reused）として取り込み、
+        作り直さない（穴埋めジョブはそれ以外のノードだけを埋める）。
+        """
+        payload = match["payload"]
+        keep = match.get("keep", False)
+        for stage in ("hp_mt_0", "hp_mt_1"):
+            for key, text in payload.get(stage, {}).items():
+                if key not in _NODE_IDS:
+                    continue
+                node = (stage, _NODE_IDS[key])
+                if keep and node in self.FILL_PLAN and self.provenance[stage].get(key, "warm") in _PROVISIONAL:
+                    self.set_node(stage, node[1], text, "reused")
+                    self.warm_kept.add(node)
+                else:
+                    self.set_node(stage, node[1], text, "warm")
+        if payload.get("agents"):
+            self.agents = list(payload["agents"])
+        self.warm_source = {"session_id": match["session_id"], "score": round(match["score"], 3), "kept": keep}
+
     def start_from_values_and_trigger_future(self, values_text: str):
-        self.hp_mt_1[HP_model[2]] = values_text
+        self.set_node("hp_mt_1", 2, values_text, "user")
         self.user_inputs["q4_value"] = values_text
-        
-        # 過去(Mt-1)と現在(Mt)の残りを埋めるジョブを開始
-        self.all_futures.append(self.executor.submit(self.job_fill_past_and_present, values_text))
+
+        # ドラフトを先に投入（逐次パイプラインより先にスレッドを確保する）。
+        # ウォームスタートした場合は取り込んだノードがドラフトの代わりになる
+        if self.draft_mode and self.warm_source is None:
+            self.trigger_stage_drafts()
+
+        # 過去(Mt-1)と現在(Mt)の残りを埋めるジョブを開始（ウォームスタートのノードもここで精緻化する。
+        # そのまま使うノードは計画から外す）
+        plan = [node for node in self.FILL_PLAN if node not in self.warm_kept]
+        self._submit_fill(plan, self.job_fill_past_and_present, values_text)
 
         # 未来(Mt+1)の候補生成を開始
         self.trigger_adv_candidates_generation()
@@ -116,8 +391,14 @@ class HPGenerationSession:
 この状況が行き着く先、あるいはこれに対する反動として生まれる未来の問題を予測してください。
 """
             # 【変更点】 Multi-Agentを使用
-            # 先に Agent を生成（トピック：現在の状況からの未来変化）
-            self.agent_manager.generate_agents(f"現在の状況（{self.user_inputs['q1_ux']}）と価値観（{self.user_inputs['q4_value']}）からの未来的進化")
+            # 先に Agent を生成（トピック：現在の状況からの未来変化）。ウォームスタート時は流用する
+            if self.warm_source is None or not self.agents:
+                try:
+                    self.agents = _agent_manager.generate_agents(f"現在の状況（{self.user_inputs['q1_ux']}）と価値観（{self.user_inputs['q4_value']}）からの未来的進化")
+                except StructuredOutputError as e:
+                    # ロスターを読めなければ候補なし（UI は再試行を促す）
+                    print(f"Agent generation failed: {e}")
+                    return []
             
             candidates = self.run_multi_agent(
                 element_type=HP_model[1], # 前衛的社会問題
@@ -127,37 +408,82 @@ class HPGenerationSession:
             )
             return candidates
 
-        self.future_candidates_adv = self.executor.submit(job_candidates)
-        self.all_futures.append(self.future_candidates_adv)
+        self.future_candidates_adv = self._track(self._submit(job_candidates))
+
+    # ============ Fast Draft: Mt & Mt-1 in one call each ============
+
+    def trigger_stage_drafts(self):
+        def job_draft(stage: str, time_state: int):
+            nodes = draft_stage_gpt(time_state, self.user_inputs)
+            for nid, text in nodes.items():
+                self.set_node(stage, nid, text, "draft")
+            return nodes
+
+        self.draft_futures = [
+            self._submit(job_draft, "hp_mt_1", 1),
+            self._submit(job_draft, "hp_mt_0", 0),
+        ]
+        for f in self.draft_futures:
+            self._track(f)
+
+    def wait_drafts(self):
+        wait(self.draft_futures, timeout=deadline.remaining())
+
+    def pending_refinements(self) -> int:
+        """まだ終わっていないバックグラウンドジョブの数"""
+        return sum(1 for f in self.all_futures if not f.done())
+
+    def draft_node_count(self) -> int:
+        with self._lock:
+            return sum(1 for p in self.provenance.values() for src in p.values() if src in _PROVISIONAL)
 
     # ============ Background: Fill Past (Mt-1) & Present (Mt) ============
 
+    def _fill(self, stage: str, node_id: int, source: str, fn, *args):
+        """fn(*args) の結果でノードを埋める。warm_kept のノードは生成しない"""
+        if (stage, node_id) in self.warm_kept:
+            return
+        self.set_node(stage, node_id, fn(*args), source)
+
+    def _fill_search(self, stage: str, node_id: int, input_id: int, input_text: str, time_state: int):
+        """tavily_from_nodes の結果と実際の出所でノードを埋める。warm_kept のノードは検索しない"""
+        if (stage, node_id) in self.warm_kept:
+            return
+        self.set_node(stage, node_id, *self.tavily_from_nodes(input_id, input_text, node_id, time_state))
+
+    # job_fill_past_and_present がノードを埋める順番（ライブ可視化の in_progress 表示用）
+    FILL_PLAN = (
+        [("hp_mt_1", nid) for nid in (15, 11, 9, 3, 8, 1, 12, 10, 7, 16)]
+        + [("hp_mt_0", nid) for nid in (16, 4, 18, 5, 17, 6, 13, 14, 7, 3, 11, 2, 1, 8, 9, 10, 12, 15)]
+    )
+
     def job_fill_past_and_present(self, values_text: str):
         """
         Mtの完全化と、そこから逆算したMt-1の生成を行う
         """
         # 1. Mt (現在) の不足分を埋める
         # 価値観(2) -> 習慣(15), コミュニケーション(11), 文化芸術(9), 社会問題(3)
-        self.hp_mt_1[HP_model[15]] = self.tavily_from_nodes(2, values_text, 15, 1)
-        self.hp_mt_1[HP_model[11]] = self.simple_fill(2, values_text, 11)
-        self.hp_mt_1[HP_model[9]] = self.simple_fill(2, values_text, 9)
-        self.hp_mt_1[HP_model[3]] = self.tavily_from_nodes(2, values_text, 3, 1)
+        self.prefetch_queries([(2, values_text, 15, 1), (2, values_text, 3, 1)])
+        self._fill_search("hp_mt_1", 15, 2, values_text, 1)
+        self._fill("hp_mt_1", 11, "gpt", self.simple_fill, 2, values_text, 11)
+        self._fill("hp_mt_1", 9, "gpt", self.simple_fill, 2, values_text, 9)
+        self._fill_search("hp_mt_1", 3, 2, values_text, 1)
 
         # 社会問題(3) -> コミュニティ(8) -> 前衛的問題(1)
-        self.hp_mt_1[HP_model[8]] = self.simple_fill(3, self.hp_mt_1[HP_model[3]], 8)
-        self.hp_mt_1[HP_model[1]] = self.tavily_from_nodes(8, self.hp_mt_1[HP_model[8]], 1, 1)
+        self._fill("hp_mt_1", 8, "gpt", self.simple_fill, 3, self.hp_mt_1[HP_model[3]], 8)
+        self._fill_search("hp_mt_1", 1, 8, self.hp_mt_1[HP_model[8]], 1)
         
         # 社会問題(3) -> 組織化(12) -> 技術(4, 既存確認)
-        self.hp_mt_1[HP_model[12]] = self.simple_fill(3, self.hp_mt_1[HP_model[3]], 12)
+        self._fill("hp_mt_1", 12, "gpt", self.simple_fill, 3, self.hp_mt_1[HP_model[3]], 12)
         
         # 制度(6) -> 標準化(10), メディア(7)
         inst_text = self.hp_mt_1.get(HP_model[6], "現代の制度")
-        self.hp_mt_1[HP_model[10]] = self.simple_fill(6, inst_text, 10)
-        self.hp_mt_1[HP_model[7]] = self.simple_fill(6, inst_text, 7)
+        self._fill("hp_mt_1", 10, "gpt", self.simple_fill, 6, inst_text, 10)
+        self._fill("hp_mt_1", 7, "gpt", self.simple_fill, 6, inst_text, 7)
 
         # 技術(4) -> パラダイム(16)
         tech_text = self.hp_mt_1.get(HP_model[4], "現代の技術")
-        self.hp_mt_1[HP_model[16]] = self.simple_fill(4, tech_text, 16)
+        self._fill("hp_mt_1", 16, "gpt", self.simple_fill, 4, tech_text, 16)
 
 
         # 2. Mt-1 (過去) の生成
@@ -165,55 +491,60 @@ class HPGenerationSession:
         mt_adv = self.hp_mt_1.get(HP_model[1], "")
         
         # Mt(1) -> Mt-1(16) パラダイム (過去の技術基盤)
-        self.hp_mt_0[HP_model[16]] = self.tavily_from_nodes(1, mt_adv, 16, 0)
+        self._fill_search("hp_mt_0", 16, 1, mt_adv, 0)
         
         # Mt-1(16) -> Mt-1(4) 技術
-        self.hp_mt_0[HP_model[4]] = self.simple_fill(16, self.hp_mt_0[HP_model[16]], 4)
+        self._fill("hp_mt_0", 4, "gpt", self.simple_fill, 16, self.hp_mt_0[HP_model[16]], 4)
 
         # Mt(1) -> Mt-1(18) アート (過去の社会批評)
-        self.hp_mt_0[HP_model[18]] = self.simple_fill(1, mt_adv, 18)
+        self._fill("hp_mt_0", 18, "gpt", self.simple_fill, 1, mt_adv, 18)
         
         # Mt-1(18) -> Mt-1(5) UX (【重要】過去のUX空間)
-        self.hp_mt_0[HP_model[5]] = self.tavily_from_nodes(18, self.hp_mt_0[HP_model[18]], 5, 0)
+        self._fill_search("hp_mt_0", 5, 18, self.hp_mt_0[HP_model[18]], 0)
 
         # Mt-1の残りをUX(5)から逆算的に埋める
         # UX(5) -> BizEco(17) -> Inst(6)
-        self.hp_mt_0[HP_model[17]] = self.simple_fill(5, self.hp_mt_0[HP_model[5]], 17)
-        self.hp_mt_0[HP_model[6]] = self.simple_fill(17, self.hp_mt_0[HP_model[17]], 6)
+        self._fill("hp_mt_0", 17, "gpt", self.simple_fill, 5, self.hp_mt_0[HP_model[5]], 17)
+        self._fill("hp_mt_0", 6, "gpt", self.simple_fill, 17, self.hp_mt_0[HP_model[17]], 6)
         
         # UX(5) -> Meaning(13) -> Value(2) (過去の価値観)
-        self.hp_mt_0[HP_model[13]] = "製品を使用する理由" # 簡易
-        self.hp_mt_0[HP_model[14]] = "過去の製品"
+        self.set_node("hp_mt_0", 13, "製品を使用する理由", "fixed") # 簡易
+        self.set_node("hp_mt_0", 14, "過去の製品", "fixed")
         # 逆算は難しいので、制度(6) -> メディア(7) -> 社会問題(3) -> 価値観(2) の順で推測
-        self.hp_mt_0[HP_model[7]] = self.simple_fill(6, self.hp_mt_0[HP_model[6]], 7)
-        self.hp_mt_0[HP_model[3]] = self.simple_fill(7, self.hp_mt_0[HP_model[7]], 3)
-        self.hp_mt_0[HP_model[11]] = self.simple_fill(3, self.hp_mt_0[HP_model[3]], 11)
-        self.hp_mt_0[HP_model[2]] = self.simple_fill(11, self.hp_mt_0[HP_model[11]], 2)
+        self._fill("hp_mt_0", 7, "gpt", self.simple_fill, 6, self.hp_mt_0[HP_model[6]], 7)
+        self._fill("hp_mt_0", 3, "gpt", self.simple_fill, 7, self.hp_mt_0[HP_model[7]], 3)
+        self._fill("hp_mt_0", 11, "gpt", self.simple_fill, 3, self.hp_mt_0[HP_model[3]], 11)
+        self._fill("hp_mt_0", 2, "gpt", self.simple_fill, 11, self.hp_mt_0[HP_model[11]], 2)
         
         # 残りの埋め合わせ
-        self.hp_mt_0[HP_model[1]] = self.simple_fill(16, self.hp_mt_0[HP_model[16]], 1) 
-        self.hp_mt_0[HP_model[8]] = self.simple_fill(3, self.hp_mt_0[HP_model[3]], 8)
-        self.hp_mt_0[HP_model[9]] = self.simple_fill(1, self.hp_mt_0[HP_model[1]], 9)
-        self.hp_mt_0[HP_model[10]] = self.simple_fill(6, self.hp_mt_0[HP_model[6]], 10)
-        self.hp_mt_0[HP_model[12]] = self.simple_fill(3, self.hp_mt_0[HP_model[3]], 12)
-        self.hp_mt_0[HP_model[15]] = self.simple_fill(2, self.hp_mt_0[HP_model[2]], 15)
+        self._fill("hp_mt_0", 1, "gpt", self.simple_fill, 16, self.hp_mt_0[HP_model[16]], 1)
+        self._fill("hp_mt_0", 8, "gpt", self.simple_fill, 3, self.hp_mt_0[HP_model[3]], 8)
+        self._fill("hp_mt_0", 9, "gpt", self.simple_fill, 1, self.hp_mt_0[HP_model[1]], 9)
+        self._fill("hp_mt_0", 10, "gpt", self.simple_fill, 6, self.hp_mt_0[HP_model[6]], 10)
+        self._fill("hp_mt_0", 12, "gpt", self.simple_fill, 3, self.hp_mt_0[HP_model[3]], 12)
+        self._fill("hp_mt_0", 15, "gpt", self.simple_fill, 2, self.hp_mt_0[HP_model[2]], 15)
 
     # ============ Step 2: Mt+1 Future Generation (With Multi-Agent) ============
 
     def get_future_adv_candidates(self) -> List[str]:
         if self.future_candidates_adv:
-            return self.future_candidates_adv.result()
+            try:
+                return self.future_candidates_adv.result(timeout=deadline.remaining())
+            except (FutureTimeout, CallTimeout):
+                deadline.record_timeout("adv_candidates")
+            except StructuredOutputError as e:
+                print(f"Adv candidates failed: {e}")
         return []
 
     def generate_goals_from_adv(self, adv_text: str) -> List[str]:
-        self.hp_mt_2[HP_model[1]] = adv_text
+        self.set_node("hp_mt_2", 1, adv_text, "user")
         # Mt+1 コミュニティ(8)
-        self.hp_mt_2[HP_model[8]] = single_gpt(
-            HP_model[1], adv_text, HP_model[8],
+        self.set_node("hp_mt_2", 8, self.simple_fill(
+            1, adv_text, 8,
             context=f"過去からの文脈: {self.user_inputs['q4_value']}"
-        )
+        ), "gpt")
         # Mt+1 文化芸術(9)
-        self.hp_mt_2[HP_model[9]] = self.simple_fill(1, adv_text, 9)
+        self.set_node("hp_mt_2", 9, self.simple_fill(1, adv_text, 9), "gpt")
 
         # 社会の目標候補 (Multi-Agent)
         self.mtplus1_candidates["goals"] = self.run_multi_agent(
@@ -225,10 +556,10 @@ class HPGenerationSession:
         return self.mtplus1_candidates["goals"]
 
     def generate_values_from_goal(self, goal_text: str) -> List[str]:
-        self.hp_mt_2[HP_model[3]] = goal_text
+        self.set_node("hp_mt_2", 3, goal_text, "user")
         # Mt+1 組織化(12), コミュニケーション(11)
-        self.hp_mt_2[HP_model[12]] = self.simple_fill(3, goal_text, 12)
-        self.hp_mt_2[HP_model[11]] = self.simple_fill(3, goal_text, 11)
+        self.set_node("hp_mt_2", 12, self.simple_fill(3, goal_text, 12), "gpt")
+        self.set_node("hp_mt_2", 11, self.simple_fill(3, goal_text, 11), "gpt")
 
         # 価値観 (Multi-Agent)
         self.mtplus1_candidates["values"] = self.run_multi_agent(
@@ -240,9 +571,9 @@ class HPGenerationSession:
         return self.mtplus1_candidates["values"]
 
     def generate_habits_from_value(self, value_text: str) -> List[str]:
-        self.hp_mt_2[HP_model[2]] = value_text
+        self.set_node("hp_mt_2", 2, value_text, "user")
         # Mt+1 意味付け(13)
-        self.hp_mt_2[HP_model[13]] = self.simple_fill(2, value_text, 13)
+        self.set_node("hp_mt_2", 13, self.simple_fill(2, value_text, 13), "gpt")
 
         # 習慣 (Multi-Agent)
         self.mtplus1_candidates["habits"] = self.run_multi_agent(
@@ -254,12 +585,12 @@ class HPGenerationSession:
         return self.mtplus1_candidates["habits"]
 
     def generate_ux_from_habit(self, habit_text: str) -> List[str]:
-        self.hp_mt_2[HP_model[15]] = habit_text
+        self.set_node("hp_mt_2", 15, habit_text, "user")
         # Mt+1 制度(6)
-        self.hp_mt_2[HP_model[6]] = single_gpt(HP_model[15], habit_text, HP_model[6])
+        self.set_node("hp_mt_2", 6, self.simple_fill(15, habit_text, 6), "gpt")
         # Mt+1 標準化(10), メディア(7)
-        self.hp_mt_2[HP_model[10]] = self.simple_fill(6, self.hp_mt_2[HP_model[6]], 10)
-        self.hp_mt_2[HP_model[7]] = self.simple_fill(6, self.hp_mt_2[HP_model[6]], 7)
+        self.set_node("hp_mt_2", 10, self.simple_fill(6, self.hp_mt_2[HP_model[6]], 10), "gpt")
+        self.set_node("hp_mt_2", 7, self.simple_fill(6, self.hp_mt_2[HP_model[6]], 7), "gpt")
 
         # UX (Multi-Agent)
         self.mtplus1_candidates["ux_future"] = self.run_multi_agent(
@@ -272,25 +603,88 @@ class HPGenerationSession:
 
     def finalize_mtplus1(self, ux_text: str):
         # Mt+1 UX(5)
-        self.hp_mt_2[HP_model[5]] = ux_text
+        self.set_node("hp_mt_2", 5, ux_text, "user")
         
         # 残り: BizEco(17), Prod(14), Tech(4), Paradigm(16), Art(18)
-        self.hp_mt_2[HP_model[17]] = self.simple_fill(5, ux_text, 17)
-        self.hp_mt_2[HP_model[14]] = self.simple_fill(5, ux_text, 14)
-        self.hp_mt_2[HP_model[18]] = self.simple_fill(5, ux_text, 18)
-        self.hp_mt_2[HP_model[4]] = self.simple_fill(14, self.hp_mt_2[HP_model[14]], 4)
-        self.hp_mt_2[HP_model[16]] = self.simple_fill(4, self.hp_mt_2[HP_model[4]], 16)
-
-    def wait_all(self):
-        for f in self.all_futures:
-            try:
-                f.result()
-            except Exception:
-                pass
+        self.set_node("hp_mt_2", 17, self.simple_fill(5, ux_text, 17), "gpt")
+        self.set_node("hp_mt_2", 14, self.simple_fill(5, ux_text, 14), "gpt")
+        self.set_node("hp_mt_2", 18, self.simple_fill(5, ux_text, 18), "gpt")
+        self.set_node("hp_mt_2", 4, self.simple_fill(14, self.hp_mt_2[HP_model[14]], 4), "gpt")
+        self.set_node("hp_mt_2", 16, self.simple_fill(4, self.hp_mt_2[HP_model[4]], 16), "gpt")
+
+    def wait_all(self, timeout: float = None) -> bool:
+        """ジョブの完了を待つ。timeout 内に終わらなければ途中の結果のまま False を返す"""
+        _, not_done = wait(self.all_futures, timeout=timeout)
+        if not_done:
+            deadline.record_timeout("wait_all")
+        return not not_done
+
+    def has_pending_jobs(self) -> bool:
+        return any(not f.done() for f in self.all_futures)
+
+    # ============ Snapshot / Restore ============
+
+    def to_snapshot(self) -> dict:
+        """
+        LLM を再実行せずに復元できる状態一式（実行中のジョブは含まない）。
+        """
+        adv = None
+        if self.future_candidates_adv and self.future_candidates_adv.done() and not self.future_candidates_adv.exception():
+            adv = self.future_candidates_adv.result()
+        with self._lock:
+            return {
+                "hp_mt_0": dict(self.hp_mt_0),
+                "hp_mt_1": dict(self.hp_mt_1),
+                "hp_mt_2": dict(self.hp_mt_2),
+                "provenance": {k: dict(v) for k, v in self.provenance.items()},
+                "raw_nodes": {k: dict(v) for k, v in self.raw_nodes.items()},
+                "user_inputs": dict(self.user_inputs),
+                "mtplus1_candidates": {k: list(v) for k, v in self.mtplus1_candidates.items()},
+                "adv_candidates": adv,
+                "agents": list(self.agents),
+                "draft_mode": self.draft_mode,
+                "query_mode": self.query_mode,
+                "warm_source": self.warm_source,
+                "budget": self.budget.to_snapshot(),
+            }
+
+    @classmethod
+    def from_snapshot(cls, data: dict) -> "HPGenerationSession":
+        session = cls(draft_mode=data.get("draft_mode", False), query_mode=data.get("query_mode", "llm"))
+        session.merge_snapshot(data)
+        return session
+
+    def merge_snapshot(self, data: dict):
+        """
+        スナップショット（別プロセスのワーカーが保存したものなど）の内容で置き換える。
+        変わったノードだけをライブ可視化の差分として記録する。
+        """
+        with self._lock:
+            for stage in ("hp_mt_0", "hp_mt_1", "hp_mt_2"):
+                old, new = getattr(self, stage), dict(data.get(stage, {}))
+                provenance = dict(data.get("provenance", {}).get(stage, {}))
+                for key, text in new.items():
+                    if key in _NODE_IDS and (old.get(key) != text or self.provenance[stage].get(key) != provenance.get(key)):
+                        status = "draft" if provenance.get(key) in _PROVISIONAL else "done"
+                        self._emit(stage, _NODE_IDS[key], status, text)
+                setattr(self, stage, new)
+                self.provenance[stage] = provenance
+                self.raw_nodes[stage] = dict(data.get("raw_nodes", {}).get(stage, {}))
+        self.draft_mode = data.get("draft_mode", self.draft_mode)
+        self.query_mode = data.get("query_mode", self.query_mode)
+        self.user_inputs.update(data.get("user_inputs", {}))
+        self.mtplus1_candidates.update(data.get("mtplus1_candidates", {}))
+        self.agents = list(data.get("agents", []))
+        self.warm_source = data.get("warm_source")
+        self.budget.load_snapshot(data.get("budget", {}))
+        if data.get("adv_candidates") is not None:
+            self.future_candidates_adv = Future()
+            self.future_candidates_adv.set_result(data["adv_candidates"])
 
     def to_dict(self) -> dict:
-        return {
-            "hp_mt_0": self.hp_mt_0,
-            "hp_mt_1": self.hp_mt_1,
-            "hp_mt_2": self.hp_mt_2,
-        }
\ No newline at end of file
+        with self._lock:
+            return {
+                "hp_mt_0": dict(self.hp_mt_0),
+                "hp_mt_1": dict(self.hp_mt_1),
+                "hp_mt_2": dict(self.hp_mt_2),
+            }
\ No newline at end of file
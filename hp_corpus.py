@@ -0,0 +1,348 @@
+# hp_corpus.py
+"""
+多数の HP モデル（HPGenerationSession.to_dict() / hp_output.json 形式）をまとめて保存する列指向コーパス。
+
+ディレクトリ構成（すべて追記のみ・ネイティブのバイト順）:
+    strings.bin   UTF-8 テキストを連結したもの（文字列テーブル）
+    strings.off   各文字列の終端オフセット (uint64)
+    session.col   行ごとのセッションID（文字列テーブルの番号, uint32）
+    stage.col     行ごとのステージ 0/1/2 (uint8)
+    node.col      行ごとのノードID = HP_model のキー (uint8)
+    text.col      行ごとのノードのテキスト（文字列テーブルの番号, uint32）
+
+同じ文字列は1度だけ格納する。読み出しは mmap で行い、必要な文字列だけをデコードする。
+書き込み途中で落ちた場合は、次に CorpusWriter を開いたときに不完全な末尾を切り詰める。
+
+    python hp_corpus.py export corpus/ hp_output.json ...
+    python hp_corpus.py import corpus/ out_dir/
+    python hp_corpus.py bench --sessions 2000
+"""
+import argparse
+import json
+import mmap
+import os
+import shutil
+import tempfile
+import time
+from array import array
+
+from hp_model import HP_model
+
+STAGES = ("hp_mt_0", "hp_mt_1", "hp_mt_2")
+NODE_IDS = {name: nid for nid, name in HP_model.items()}
+
+# 列名 -> array の型コード
+COLUMNS = {"session": "I", "stage": "B", "node": "B", "text": "I"}
+
+_STRINGS = "strings.bin"
+_OFFSETS = "strings.off"
+
+
+def _col_file(name: str) -> str:
+    return f"{name}.col"
+
+
+class CorpusWriter:
+    """コーパスへセッション単位で追記する（1プロセスから使う）"""
+
+    def __init__(self, path: str):
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+        self._repair()
+
+        # 既存の文字列テーブルを読み込んで重複排除に使う
+        self._index: dict = {}
+        with CorpusReader(path) as reader:
+            for i in range(reader.string_count):
+                self._index.setdefault(reader.string(i), i)
+            self._end = reader.string_end
+
+        self._strings = open(os.path.join(path, _STRINGS), "ab")
+        self._offsets = open(os.path.join(path, _OFFSETS), "ab")
+        self._cols = {name: open(os.path.join(path, _col_file(name)), "ab") for name in COLUMNS}
+
+    def _repair(self):
+        # オフセットと列を要素サイズの倍数・共通の行数に揃え、参照されない文字列の末尾を落とす
+        def truncate(name: str, size: int):
+            p = os.path.join(self.path, name)
+            if os.path.exists(p) and os.path.getsize(p) != size:
+                with open(p, "r+b") as f:
+                    f.truncate(size)
+
+        def length(name: str, itemsize: int) -> int:
+            p = os.path.join(self.path, name)
+            return os.path.getsize(p) // itemsize if os.path.exists(p) else 0
+
+        n_strings = length(_OFFSETS, 8)
+        truncate(_OFFSETS, n_strings * 8)
+        end = 0
+        if n_strings:
+            with open(os.path.join(self.path, _OFFSETS), "rb") as f:
+                f.seek((n_strings - 1) * 8)
+                end = array("Q", f.read(8))[0]
+        truncate(_STRINGS, end)
+
+        rows = min(length(_col_file(name), array(code).itemsize) for name, code in COLUMNS.items())
+        for name, code in COLUMNS.items():
+            truncate(_col_file(name), rows * array(code).itemsize)
+
+    def _intern(self, text: str, blob: bytearray, offsets: array) -> int:
+        if text in self._index:
+            return self._index[text]
+        data = text.encode("utf-8")
+        blob += data
+        self._end += len(data)
+        offsets.append(self._end)
+        idx = len(self._index)
+        self._index[text] = idx
+        return idx
+
+    def append(self, session_id: str, hp_json: dict):
+        """1セッション分（hp_mt_0/1/2）を追記する"""
+        blob, offsets = bytearray(), array("Q")
+        cols = {name: array(code) for name, code in COLUMNS.items()}
+        sid = self._intern(session_id, blob, offsets)
+        for stage_idx, stage in enumerate(STAGES):
+            for key, text in hp_json.get(stage, {}).items():
+                if key not in NODE_IDS:
+                    raise ValueError(f"未知のノード: {stage}.{key}")
+                cols["session"].append(sid)
+                cols["stage"].append(stage_idx)
+                cols["node"].append(NODE_IDS[key])
+                cols["text"].append(self._intern(text or "", blob, offsets))
+
+        # 文字列を先に書き、列は最後に書く（途中で落ちても列が未定義の文字列を指さない）
+        self._strings.write(blob)
+        self._offsets.write(offsets.tobytes())
+        self._strings.flush()
+        self._offsets.flush()
+        for name, f in self._cols.items():
+            f.write(cols[name].tobytes())
+            f.flush()
+
+    def close(self):
+        for f in (self._strings, self._offsets, *self._cols.values()):
+            f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class CorpusReader:
+    """mmap でコーパスを読む。columns の各列は memoryview（コピーなし）"""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._maps = []
+        self._views = []
+        self._blob = self._map(_STRINGS, "B")
+        self._offsets = self._map(_OFFSETS, "Q")
+        cols = {name: self._map(_col_file(name), code) for name, code in COLUMNS.items()}
+        rows = min(len(c) for c in cols.values())
+        self.columns = {name: self._view(c[:rows]) for name, c in cols.items()}
+
+    def _view(self, view: memoryview) -> memoryview:
+        self._views.append(view)
+        return view
+
+    def _map(self, name: str, fmt: str) -> memoryview:
+        p = os.path.join(self.path, name)
+        if not os.path.exists(p) or os.path.getsize(p) == 0:
+            return self._view(memoryview(b"").cast(fmt))
+        with open(p, "rb") as f:
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self._maps.append(mm)
+        raw = self._view(memoryview(mm))
+        itemsize = array(fmt).itemsize
+        return self._view(raw[:len(raw) // itemsize * itemsize].cast(fmt))
+
+    def __len__(self) -> int:
+        return len(self.columns["text"])
+
+    @property
+    def string_count(self) -> int:
+        return len(self._offsets)
+
+    @property
+    def string_end(self) -> int:
+        return self._offsets[-1] if len(self._offsets) else 0
+
+    def string(self, idx: int) -> str:
+        start = self._offsets[idx - 1] if idx else 0
+        return str(self._blob[start:self._offsets[idx]], "utf-8")
+
+    def rows(self, stage: int = None, node_id: int = None):
+        """(session_id, stage, node_id, text) を返す。stage / node_id で絞り込める"""
+        cols = self.columns
+        for i in range(len(self)):
+            if stage is not None and cols["stage"][i] != stage:
+                continue
+            if node_id is not None and cols["node"][i] != node_id:
+                continue
+            yield (self.string(cols["session"][i]), cols["stage"][i], cols["node"][i],
+                   self.string(cols["text"][i]))
+
+    def _records(self):
+        """
+        追記1回分の行範囲 (session の文字列番号, start, end) を書き込み順に返す。
+        同じセッションが続けて追記された場合は、同じノードが再び現れた位置を境目とみなす。
+        """
+        cols = self.columns
+        current, start, seen = None, 0, set()
+        for i in range(len(self)):
+            sid = cols["session"][i]
+            key = (cols["stage"][i], cols["node"][i])
+            if sid != current or key in seen:
+                if current is not None:
+                    yield current, start, i
+                current, start, seen = sid, i, set()
+            seen.add(key)
+        if current is not None:
+            yield current, start, len(self)
+
+    def sessions(self):
+        """
+        (session_id, hp_json) を返す（to_dict() と同じ形）。
+        同じ session_id が複数回追記されていれば最後のものだけを、その書き込み順で返す。
+        """
+        latest = {}
+        for sid, start, end in self._records():
+            latest.pop(sid, None)
+            latest[sid] = (start, end)
+        cols = self.columns
+        for sid, (start, end) in latest.items():
+            hp = {stage: {} for stage in STAGES}
+            for i in range(start, end):
+                hp[STAGES[cols["stage"][i]]][HP_model[cols["node"][i]]] = self.string(cols["text"][i])
+            yield self.string(sid), hp
+
+    def close(self):
+        # 呼び出し側が列のスライスを保持していると mmap を閉じられない
+        for view in reversed(self._views):
+            view.release()
+        for mm in self._maps:
+            mm.close()
+        self._views, self._maps = [], []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def export_sessions(path: str, items):
+    """(session_id, hp_json) の列をコーパスへ追記する"""
+    with CorpusWriter(path) as writer:
+        for session_id, hp_json in items:
+            writer.append(session_id, hp_json)
+
+
+def import_sessions(path: str) -> list:
+    """コーパスの全セッションを [(session_id, hp_json), ...] で返す"""
+    with CorpusReader(path) as reader:
+        return list(reader.sessions())
+
+
+# ============ CLI ============
+
+def _dir_size(path: str) -> int:
+    return sum(os.path.getsize(os.path.join(path, f)) for f in os.listdir(path))
+
+
+def _synthetic_sessions(n: int, base: dict):
+    # 一部のノードだけをセッションごとに変え、固定文やユーザー入力の重複は残す
+    for i in range(n):
+        hp = {}
+        for stage in STAGES:
+            hp[stage] = {
+                key: (f"{text}（案{i}）" if (NODE_IDS[key] + i) % 3 else text)
+                for key, text in base.get(stage, {}).items()
+            }
+        yield f"bench-{i:06d}", hp
+
+
+def bench(n: int, sample: str):
+    with open(sample, encoding="utf-8") as f:
+        base = json.load(f)
+    work = tempfile.mkdtemp(prefix="hp_corpus_")
+    try:
+        json_dir = os.path.join(work, "json")
+        corpus_dir = os.path.join(work, "corpus")
+        os.makedirs(json_dir)
+        sessions = list(_synthetic_sessions(n, base))
+        for sid, hp in sessions:
+            with open(os.path.join(json_dir, f"{sid}.json"), "w", encoding="utf-8") as f:
+                json.dump(hp, f, ensure_ascii=False, indent=4)
+
+        start = time.perf_counter()
+        export_sessions(corpus_dir, sessions)
+        t_write = time.perf_counter() - start
+
+        start = time.perf_counter()
+        loaded = []
+        for name in sorted(os.listdir(json_dir)):
+            with open(os.path.join(json_dir, name), encoding="utf-8") as f:
+                loaded.append(json.load(f))
+        t_json = time.perf_counter() - start
+
+        start = time.perf_counter()
+        restored = import_sessions(corpus_dir)
+        t_corpus = time.perf_counter() - start
+        assert [hp for _, hp in restored] == loaded
+
+        # 列だけを走査する分析（テキストはデコードしない）
+        start = time.perf_counter()
+        with CorpusReader(corpus_dir) as reader:
+            filled = [0] * (max(HP_model) + 1)
+            for nid in reader.columns["node"]:
+                filled[nid] += 1
+        t_scan = time.perf_counter() - start
+
+        print(f"sessions={n}")
+        print(f"{'format':<22} {'size KiB':>10} {'load s':>8}")
+        print(f"{'json (indent=4)':<22} {_dir_size(json_dir) / 1024:10.0f} {t_json:8.3f}")
+        print(f"{'corpus (full decode)':<22} {_dir_size(corpus_dir) / 1024:10.0f} {t_corpus:8.3f}")
+        print(f"{'corpus (column scan)':<22} {'':>10} {t_scan:8.3f}")
+        print(f"corpus write: {t_write:.3f}s")
+    finally:
+        shutil.rmtree(work, ignore_errors=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    sub = parser.add_subparsers(dest="cmd", required=True)
+
+    p_export = sub.add_parser("export", help="JSON ファイルをコーパスへ追記")
+    p_export.add_argument("corpus")
+    p_export.add_argument("files", nargs="+")
+
+    p_import = sub.add_parser("import", help="コーパスを JSON ファイルに書き出す")
+    p_import.add_argument("corpus")
+    p_import.add_argument("out_dir")
+
+    p_bench = sub.add_parser("bench", help="JSON との読み込み時間の比較")
+    p_bench.add_argument("--sessions", type=int, default=1000)
+    p_bench.add_argument("--sample", default="hp_output.json", help="元にする HP モデルの JSON")
+
+    args = parser.parse_args()
+    if args.cmd == "export":
+        def items():
+            for p in args.files:
+                with open(p, encoding="utf-8") as f:
+                    yield os.path.splitext(os.path.basename(p))[0], json.load(f)
+        export_sessions(args.corpus, items())
+    elif args.cmd == "import":
+        os.makedirs(args.out_dir, exist_ok=True)
+        for sid, hp in import_sessions(args.corpus):
+            with open(os.path.join(args.out_dir, f"{sid}.json"), "w", encoding="utf-8") as f:
+                json.dump(hp, f, ensure_ascii=False, indent=4)
+    else:
+        bench(args.sessions, args.sample)
+
+
+if __name__ == "__main__":
+    main()
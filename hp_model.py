@@ -0,0 +1,24 @@
+# hp_model.py
+# HP モデル（アーキオロジカル・プロトタイピング）の18要素。
+# 依存の無いモジュールに置き、API キーの要らないツール（hp_corpus.py など）からも読めるようにする。
+
+HP_model = {
+    1: "前衛的社会問題",
+    2: "人々の価値観",
+    3: "社会問題",
+    4: "技術や資源",
+    5: "日常の空間とユーザー体験",
+    6: "制度",
+    7: "メディア",
+    8: "コミュニティ化",
+    9: "文化芸術振興",
+    10: "標準化",
+    11: "コミュニケーション",
+    12: "組織化",
+    13: "意味付け",
+    14: "製品・サービス",
+    15: "習慣化",
+    16: "パラダイム",
+    17: "ビジネスエコシステム",
+    18: "アート(社会批評)"
+}
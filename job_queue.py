@@ -0,0 +1,247 @@
+# job_queue.py
+import json
+import os
+import sqlite3
+import time
+import uuid
+
+# 生成ジョブのローカルキュー（SQLite）。app.py が投入し、worker.py のプロセス群が取り出して実行する。
+# 同じセッションのジョブは投入順に1つずつ実行する（状態が前のステップに依存するため）。
+# settling: 結果は返したが、ワーカーがバックグラウンドのノード生成をまだ続けている状態。
+#           app.py は結果を受け取って先に進む。同じセッションの次のジョブは、生成を続けている
+#           ワーカーが claim_session で取り出し、同じプロセスのセッション上で待たずに実行する。
+# 締め切り（deadline_at）を過ぎても取り出されなかったジョブは実行せずに error にする
+# （UI は既に時間切れとして先に進んでいるため）。
+
+DB_PATH = os.environ.get("HP_JOB_DB", "hp_jobs.db")
+
+# 実行中のまま更新が止まったジョブ（ワーカーが落ちた等）をキューに戻すまでの秒数
+STALE_SECONDS = 120
+
+
+def _connect() -> sqlite3.Connection:
+    conn = sqlite3.connect(DB_PATH, timeout=30, isolation_level=None)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS jobs (
+            id TEXT PRIMARY KEY,
+            session_id TEXT NOT NULL,
+            kind TEXT NOT NULL,
+            payload TEXT NOT NULL,
+            status TEXT NOT NULL,          -- queued / running / settling / done / error
+            progress TEXT NOT NULL DEFAULT '',
+            result TEXT,
+            error TEXT,
+            worker TEXT,
+            deadline_at REAL,              -- この時刻（time.time()）までに結果が要る
+            created_at REAL NOT NULL,
+            updated_at REAL NOT NULL
+        )
+    """)
+    conn.execute("CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, created_at)")
+    return conn
+
+
+def enqueue(session_id: str, kind: str, payload: dict, deadline_seconds: float = None) -> str:
+    """
+    ジョブを投入して ID を返す。同じ内容のジョブが未完了なら新しく作らずにそれを返す
+    （UI の再起動後に同じ操作をやり直しても二重に実行しない）。
+    """
+    deadline_at = None if deadline_seconds is None else time.time() + deadline_seconds
+    body = json.dumps(payload, ensure_ascii=False, sort_keys=True)
+    now = time.time()
+    conn = _connect()
+    try:
+        conn.execute("BEGIN IMMEDIATE")
+        row = conn.execute(
+            "SELECT id FROM jobs WHERE session_id = ? AND kind = ? AND payload = ? AND status IN ('queued', 'running')",
+            (session_id, kind, body)
+        ).fetchone()
+        job_id = row[0] if row else uuid.uuid4().hex
+        if not row:
+            conn.execute(
+                "INSERT INTO jobs (id, session_id, kind, payload, status, deadline_at, created_at, updated_at) "
+                "VALUES (?, ?, ?, ?, 'queued', ?, ?, ?)",
+                (job_id, session_id, kind, body, deadline_at, now, now)
+            )
+        conn.execute("COMMIT")
+        return job_id
+    finally:
+        conn.close()
+
+
+def _expire(conn: sqlite3.Connection, now: float):
+    # トランザクション内で呼ぶ
+    conn.execute(
+        "UPDATE jobs SET status = 'error', error = 'deadline passed before start', updated_at = ? "
+        "WHERE status = 'queued' AND deadline_at IS NOT NULL AND deadline_at <= ?",
+        (now, now)
+    )
+
+
+def _take(conn: sqlite3.Connection, row, worker_id: str):
+    # トランザクション内で呼ぶ
+    if not row:
+        return None
+    conn.execute(
+        "UPDATE jobs SET status = 'running', worker = ?, updated_at = ? WHERE id = ?",
+        (worker_id, time.time(), row[0])
+    )
+    return {"id": row[0], "session_id": row[1], "kind": row[2], "payload": json.loads(row[3]), "deadline_at": row[4]}
+
+
+def claim(worker_id: str):
+    """
+    実行できるジョブを1つ取り出して running にする。
+    同じセッションのジョブが実行中（settling を含む）なら、そのセッションの後続は取り出さない。
+    """
+    conn = _connect()
+    try:
+        conn.execute("BEGIN IMMEDIATE")
+        _expire(conn, time.time())
+        row = conn.execute("""
+            SELECT id, session_id, kind, payload, deadline_at FROM jobs AS j
+            WHERE status = 'queued'
+              AND NOT EXISTS (SELECT 1 FROM jobs WHERE session_id = j.session_id AND status IN ('running', 'settling'))
+              AND NOT EXISTS (SELECT 1 FROM jobs WHERE session_id = j.session_id AND status = 'queued' AND created_at < j.created_at)
+            ORDER BY created_at LIMIT 1
+        """).fetchone()
+        job = _take(conn, row, worker_id)
+        conn.execute("COMMIT")
+    finally:
+        conn.close()
+    return job
+
+
+def claim_session(worker_id: str, session_id: str):
+    """
+    settling のジョブを持つワーカーが、同じセッションの次のジョブを取り出す
+    （バックグラウンドの生成が終わるのを待たせない）。
+    """
+    conn = _connect()
+    try:
+        conn.execute("BEGIN IMMEDIATE")
+        _expire(conn, time.time())
+        row = conn.execute(
+            "SELECT id, session_id, kind, payload, deadline_at FROM jobs "
+            "WHERE session_id = ? AND status = 'queued' ORDER BY created_at LIMIT 1",
+            (session_id,)
+        ).fetchone()
+        job = _take(conn, row, worker_id)
+        conn.execute("COMMIT")
+    finally:
+        conn.close()
+    return job
+
+
+def cancel(job_id: str) -> bool:
+    """まだ取り出されていないジョブを取り消す。取り消せたら True"""
+    conn = _connect()
+    try:
+        cur = conn.execute(
+            "UPDATE jobs SET status = 'error', error = 'cancelled', updated_at = ? WHERE id = ? AND status = 'queued'",
+            (time.time(), job_id)
+        )
+        return cur.rowcount > 0
+    finally:
+        conn.close()
+
+
+def _update(job_id: str, **fields):
+    fields["updated_at"] = time.time()
+    cols = ", ".join(f"{k} = ?" for k in fields)
+    conn = _connect()
+    try:
+        conn.execute(f"UPDATE jobs SET {cols} WHERE id = ?", (*fields.values(), job_id))
+    finally:
+        conn.close()
+
+
+def heartbeat(job_id: str, progress: str = None):
+    """実行中であることを知らせる（progress は途中経過のテキスト）"""
+    if progress is None:
+        _update(job_id)
+    else:
+        _update(job_id, progress=progress)
+
+
+def publish(job_id: str, result):
+    """結果を先に返し、バックグラウンドの生成が終わるまで settling にする"""
+    _update(job_id, status="settling", result=json.dumps(result, ensure_ascii=False))
+
+
+def complete(job_id: str, result=None):
+    if result is None:
+        _update(job_id, status="done")
+    else:
+        _update(job_id, status="done", result=json.dumps(result, ensure_ascii=False))
+
+
+def fail(job_id: str, error: str):
+    _update(job_id, status="error", error=error)
+
+
+def get(job_id: str):
+    conn = _connect()
+    try:
+        row = conn.execute(
+            "SELECT status, progress, result, error FROM jobs WHERE id = ?", (job_id,)
+        ).fetchone()
+    finally:
+        conn.close()
+    if not row:
+        return None
+    status, progress, result, error = row
+    return {
+        "status": status,
+        "progress": progress,
+        "result": json.loads(result) if result is not None else None,
+        "error": error,
+    }
+
+
+def active(session_id: str) -> bool:
+    """セッションに未完了（settling を含む）のジョブがあるか"""
+    conn = _connect()
+    try:
+        row = conn.execute(
+            "SELECT 1 FROM jobs WHERE session_id = ? AND status IN ('queued', 'running', 'settling') LIMIT 1",
+            (session_id,)
+        ).fetchone()
+    finally:
+        conn.close()
+    return row is not None
+
+
+def requeue_stale(max_age: float = STALE_SECONDS) -> int:
+    """
+    更新が止まった実行中のジョブをキューに戻す。戻した数を返す。
+    settling のまま止まったものは結果を返し済みなので done にする。
+    """
+    now = time.time()
+    conn = _connect()
+    try:
+        conn.execute(
+            "UPDATE jobs SET status = 'done', updated_at = ? WHERE status = 'settling' AND updated_at < ?",
+            (now, now - max_age)
+        )
+        cur = conn.execute(
+            "UPDATE jobs SET status = 'queued', worker = NULL, updated_at = ? WHERE status = 'running' AND updated_at < ?",
+            (now, now - max_age)
+        )
+        return cur.rowcount
+    finally:
+        conn.close()
+
+
+def purge(max_age: float = 24 * 3600) -> int:
+    """終わったジョブを削除する"""
+    conn = _connect()
+    try:
+        cur = conn.execute(
+            "DELETE FROM jobs WHERE status IN ('done', 'error') AND updated_at < ?",
+            (time.time() - max_age,)
+        )
+        return cur.rowcount
+    finally:
+        conn.close()
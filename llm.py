@@ -0,0 +1,271 @@
+# llm.py
+import contextvars
+import json
+import threading
+from contextlib import contextmanager
+from types import SimpleNamespace
+import streamlit as st
+from openai import OpenAI, APITimeoutError
+from openai.lib._parsing._completions import type_to_response_format_param
+from openai.types.chat import ChatCompletion
+from pydantic import BaseModel, ValidationError, create_model
+
+import budget
+import deadline
+import prompt_registry
+import singleflight
+import transport
+from deadline import CallTimeout
+from utils import parse_json_response, parse_json_stream
+
+DEFAULT_MODEL = "gpt-4o"
+
+# 呼び出し箇所ごとのモデル・エンドポイント
+# secrets.toml の [routing.<site>] で model / base_url / api_key を上書きできる
+#   [routing.simple_fill]
+#   model = "llama-3.1-8b-instruct"
+#   base_url = "http://localhost:8000/v1"
+ROUTES = {
+    "default":      {"model": DEFAULT_MODEL},
+    "simple_fill":  {"model": DEFAULT_MODEL},  # single_gpt (50文字ノード)
+    "list_up":      {"model": DEFAULT_MODEL},  # list_up_gpt
+    "draft_stage":  {"model": DEFAULT_MODEL},  # ステージ一括ドラフト
+    "query_gen":    {"model": DEFAULT_MODEL},  # Tavily 検索クエリ生成
+    "condense":     {"model": DEFAULT_MODEL},  # 長すぎるノードの要約
+    "agent_gen":    {"model": DEFAULT_MODEL},  # 専門家エージェント生成
+    "agent_think":  {"model": DEFAULT_MODEL},  # エージェントの提案
+    "judge":        {"model": DEFAULT_MODEL},  # 提案の審査
+    "brief":        {"model": DEFAULT_MODEL},  # 総監督のブリーフ
+    "critic":       {"model": DEFAULT_MODEL},  # 総監督の審査
+    "setting":      {"model": DEFAULT_MODEL},  # 設定エージェント
+    "story_step":   {"model": DEFAULT_MODEL},  # プロットエージェント
+    "outline":      {"model": DEFAULT_MODEL},  # outline.py
+}
+
+class StructuredOutputError(Exception):
+    """スキーマ検証が部分再生成の後も通らなかった"""
+    def __init__(self, site: str, schema: type, errors: list):
+        self.site = site
+        self.schema = schema
+        self.errors = errors
+        super().__init__(f"{site}: {schema.__name__} の検証に失敗しました: {errors}")
+
+_clients: dict = {}
+_clients_lock = threading.Lock()
+
+# 一括生成（batch.py）の投入先。設定されたスレッドでは API を直接呼ばず、バッチにまとめて応答を待つ
+_batch_sink = contextvars.ContextVar("hp_batch_sink", default=None)
+
+
+def use_batch(sink):
+    _batch_sink.set(sink)
+
+
+# 一時的なルートの差し替え（bench_routes.py など）。secrets.toml の [routing] より優先する
+_route_override = contextvars.ContextVar("hp_route_override", default={})
+
+
+@contextmanager
+def override_route(site: str, **conf):
+    """with の中だけ site のルートを conf で差し替える"""
+    token = _route_override.set({**_route_override.get(), site: conf})
+    try:
+        yield
+    finally:
+        _route_override.reset(token)
+
+
+def route(site: str) -> dict:
+    """
+    呼び出し箇所のルート設定（model, base_url, api_key）を返す。
+    ROUTES < secrets.toml の [routing] < override_route の順に上書きする。
+    """
+    conf = dict(ROUTES.get(site, ROUTES["default"]))
+    overrides = st.secrets.get("routing", {})
+    conf.update(overrides.get(site, {}))
+    conf.update(_route_override.get().get(site, {}))
+    conf.setdefault("base_url", None)
+    conf.setdefault("api_key", st.secrets["openai"]["api_key"])
+    return conf
+
+
+def get_client(site: str = "default") -> OpenAI:
+    """
+    base_url / api_key ごとに OpenAI 互換クライアントを共有する。
+    """
+    conf = route(site)
+    key = (conf["base_url"], conf["api_key"])
+    with _clients_lock:
+        if key not in _clients:
+            # 接続プールは全クライアントで共有する（transport.py）
+            _clients[key] = OpenAI(api_key=conf["api_key"], base_url=conf["base_url"], http_client=transport.httpx_client())
+        return _clients[key]
+
+
+def endpoints() -> list[str]:
+    """ルートが使う API のベース URL（接続のウォームアップ用）"""
+    urls = {route(site)["base_url"] or "https://api.openai.com/v1" for site in ROUTES}
+    return sorted(urls)
+
+
+def _coalescable(kwargs: dict) -> bool:
+    # 温度の指定が無いと API 既定の 1.0 になるので対象外
+    return not kwargs.get("stream") and kwargs.get("temperature", 1.0) <= singleflight.MAX_TEMPERATURE
+
+
+def chat(site: str, messages: list[dict], **kwargs):
+    """
+    chat.completions.create を呼び出し箇所のルートで実行する（使用トークンはセッションの予算に計上）。
+    タイムアウトは操作の締め切りから決め、超えたら CallTimeout。
+    低温度の呼び出しは、同時に実行中の同一リクエストがあればその応答を共有する。
+    """
+    conf = route(site)
+    sink = _batch_sink.get()
+    if sink is not None and not kwargs.get("stream"):
+        response = ChatCompletion.model_validate(sink.call(site, {"model": conf["model"], "messages": messages, **kwargs}))
+        prompt_registry.record_cache_usage(site, response.usage)
+        return response
+
+    def call():
+        try:
+            response = get_client(site).chat.completions.create(
+                model=conf["model"],
+                messages=messages,
+                timeout=deadline.timeout_for(site),
+                **kwargs
+            )
+        except APITimeoutError as e:
+            deadline.record_timeout(site)
+            raise CallTimeout(site) from e
+        if not kwargs.get("stream"):
+            # 応答を共有した側は API を呼んでいないので、実行した側の予算にだけ計上する
+            budget.record_usage(getattr(response, "usage", None))
+            prompt_registry.record_cache_usage(site, getattr(response, "usage", None))
+        return response
+
+    if not _coalescable(kwargs):
+        return call()
+    key = singleflight.make_key(site, {"model": conf["model"], "base_url": conf["base_url"], "messages": messages, **kwargs})
+    return singleflight.do(site, key, call, timeout=deadline.timeout_for(site))
+
+
+def stream_text(site: str, messages: list[dict], **kwargs):
+    """
+    ストリーミングで生成し、本文の差分テキストを順に yield する。
+    途中で generator を閉じると接続も閉じる（残りのトークンを消費しない）。
+    受信中に締め切りを過ぎたら接続を閉じて CallTimeout。
+    """
+    stream = chat(site, messages, stream=True, stream_options={"include_usage": True}, **kwargs)
+    usage, produced = None, []
+    try:
+        for chunk in stream:
+            left = deadline.remaining()
+            if left is not None and left <= 0:
+                deadline.record_timeout(site)
+                raise CallTimeout(site)
+            usage = getattr(chunk, "usage", None) or usage
+            if chunk.choices and chunk.choices[0].delta.content:
+                produced.append(chunk.choices[0].delta.content)
+                yield chunk.choices[0].delta.content
+    finally:
+        stream.close()
+        if usage is None:
+            # 途中で打ち切ると usage が届かないので文字数から見積もる
+            text = "".join(str(m.get("content", "")) for m in messages) + "".join(produced)
+            budget.record_usage(SimpleNamespace(total_tokens=budget.estimate_tokens(text)))
+        else:
+            budget.record_usage(usage)
+            prompt_registry.record_cache_usage(site, usage)
+
+
+def parse(site: str, messages: list[dict], response_format, **kwargs):
+    """chat.completions.parse (Structured Outputs) を呼び出し箇所のルートで実行する"""
+    sink = _batch_sink.get()
+    if sink is not None:
+        body = sink.call(site, {
+            "model": route(site)["model"],
+            "messages": messages,
+            "response_format": type_to_response_format_param(response_format),
+            **kwargs,
+        })
+        completion = ChatCompletion.model_validate(body)
+        prompt_registry.record_cache_usage(site, completion.usage)
+        content = completion.choices[0].message.content or ""
+        message = SimpleNamespace(content=content, parsed=response_format.model_validate_json(content))
+        return SimpleNamespace(choices=[SimpleNamespace(message=message)], usage=completion.usage)
+    try:
+        response = get_client(site).chat.completions.parse(
+            model=route(site)["model"],
+            messages=messages,
+            response_format=response_format,
+            timeout=deadline.timeout_for(site),
+            **kwargs
+        )
+    except APITimeoutError as e:
+        deadline.record_timeout(site)
+        raise CallTimeout(site) from e
+    budget.record_usage(getattr(response, "usage", None))
+    prompt_registry.record_cache_usage(site, getattr(response, "usage", None))
+    return response
+
+
+def _schema_format(schema: type) -> dict:
+    return {
+        "type": "json_schema",
+        "json_schema": {"name": schema.__name__, "schema": schema.model_json_schema()},
+    }
+
+
+def _describe_errors(errors: list) -> str:
+    return "\n".join(
+        f"- {'.'.join(str(x) for x in err['loc'])}: {err['msg']}" for err in errors
+    )
+
+
+def structured(site: str, messages: list[dict], schema: type[BaseModel], stop_after: str = None, **kwargs) -> BaseModel:
+    """
+    JSON Schema を指定して生成し、pydantic で検証する。
+    検証に失敗したフィールドだけを小さな追加呼び出しで再生成し、それでも駄目なら StructuredOutputError。
+    stop_after を指定するとストリーミングで生成し、そのフィールドが揃った時点で打ち切る。
+    """
+    if stop_after and _batch_sink.get() is None:
+        chunks = stream_text(site, messages, response_format=_schema_format(schema), **kwargs)
+        try:
+            data = parse_json_stream(chunks, stop_after=stop_after)
+        finally:
+            chunks.close()
+        raw = json.dumps(data, ensure_ascii=False)
+    else:
+        response = chat(site, messages, response_format=_schema_format(schema), **kwargs)
+        raw = response.choices[0].message.content or ""
+        data = parse_json_response(raw)
+
+    try:
+        return schema.model_validate(data)
+    except ValidationError as e:
+        errors = e.errors()
+
+    bad_fields = sorted({err["loc"][0] for err in errors if err["loc"] and err["loc"][0] in schema.model_fields})
+    if not isinstance(data, dict) or not bad_fields:
+        raise StructuredOutputError(site, schema, errors)
+
+    # 不正なフィールドのみを再生成する
+    repair_schema = create_model(
+        f"{schema.__name__}Repair",
+        **{f: (schema.model_fields[f].annotation, schema.model_fields[f]) for f in bad_fields}
+    )
+    repair_messages = messages + [
+        {"role": "assistant", "content": raw},
+        {"role": "user", "content": f"""以下のフィールドが不正です。
+{_describe_errors(errors)}
+
+これらのフィールド（{', '.join(bad_fields)}）のみを、指定のJSON形式で再出力してください。"""},
+    ]
+    response = chat(site, repair_messages, response_format=_schema_format(repair_schema), **kwargs)
+    fixed = parse_json_response(response.choices[0].message.content or "")
+
+    valid = {k: v for k, v in data.items() if k not in bad_fields}
+    try:
+        return schema.model_validate({**valid, **fixed})
+    except ValidationError as e:
+        raise StructuredOutputError(site, schema, e.errors())
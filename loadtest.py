@@ -0,0 +1,246 @@
+# loadtest.py
+"""
+複数ユーザーの同時利用を Streamlit の AppTest で再現する負荷テスト。
+OpenAI / Tavily はスタブに差し替え、セッションあたりの RSS とステップごとの p50/p95 レイテンシを出力する。
+
+AppTest はスレッドセーフではないため、1プロセス内のスクリプトの実行（at.run）はロックで直列化し、
+レイテンシはロック待ちを除いた実行時間で計測する（バックグラウンドの生成ジョブは共有ワーカー上で並行に走る）。
+同時ユーザーとしてのレイテンシを測るときは --processes でユーザーを別プロセスに分ける
+（ユーザー数と同じにすると全員のスクリプト実行が並行する）。
+
+    python loadtest.py --users 20 --latency 0.05
+    python loadtest.py --users 8 --processes 8
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import statistics
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from types import SimpleNamespace
+
+APP_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "app.py")
+
+
+# ============ Stub backends ============
+
+_STUB_JSON = {
+    "AgentRoster": {"agents": [
+        {"name": f"エージェント{i}", "expertise": "未来学", "personality": "大胆", "perspective": "技術と社会"}
+        for i in range(1, 4)
+    ]},
+    "Judgment": {"selected_agent": "エージェント1", "selected_content": "スタブの提案", "reason": "スタブ"},
+    "Ranking": {"ranked": [1, 2, 3], "reason": "スタブ"},
+    "Brief": {"briefing_theme": "スタブのテーマ", "relevant_data_points": "スタブのデータ"},
+    "Review": {"approved": True, "feedback": ""},
+    "StorySettings": {
+        "world_view": "2050年、すべての通勤が仮想化された都市。人々は移動の代わりに共有空間で働き、暮らしている。",
+        "characters": [{"name": "佐藤ユウキ", "role": "主人公", "background": "技術者", "motivation": "真実を知る"}],
+    },
+    "OutlineStep": {
+        "title": "スタブの場面",
+        "summary": "佐藤ユウキは" + "仮想都市の異変に気づき、調査を始める。" * 6,
+        "notes": "",
+    },
+}
+
+
+class _StubStream:
+    def __init__(self, text: str):
+        self._chunks = [text[i:i + 8] for i in range(0, len(text), 8)]
+
+    def __iter__(self):
+        for c in self._chunks:
+            yield SimpleNamespace(choices=[SimpleNamespace(delta=SimpleNamespace(content=c))])
+
+    def close(self):
+        pass
+
+
+class _StubCompletions:
+    def __init__(self, latency: float):
+        self.latency = latency
+
+    def _content(self, response_format) -> str:
+        name = (response_format or {}).get("json_schema", {}).get("name", "")
+        if name in _STUB_JSON:
+            return json.dumps(_STUB_JSON[name], ensure_ascii=False)
+        return "スタブの応答テキスト"
+
+    def create(self, model, messages, stream=False, response_format=None, **kwargs):
+        time.sleep(self.latency)
+        content = self._content(response_format)
+        if stream:
+            return _StubStream(content)
+        return SimpleNamespace(
+            choices=[SimpleNamespace(message=SimpleNamespace(content=content))],
+            usage=SimpleNamespace(prompt_tokens=100, completion_tokens=50, total_tokens=150),
+        )
+
+    def parse(self, model, messages, response_format, **kwargs):
+        time.sleep(self.latency)
+        from prompt import HP_model
+        stub = {
+            "Candidate": {"candidates": ["スタブ候補"] * 5},
+            "StageDraft": {"nodes": [{"id": i, "text": f"スタブ{name}"} for i, name in HP_model.items()]},
+            "QueryBatch": {"queries": ["スタブの質問"] * 8},
+        }[response_format.__name__]
+        parsed = response_format.model_validate(stub)
+        return SimpleNamespace(choices=[SimpleNamespace(message=SimpleNamespace(parsed=parsed))])
+
+
+class StubOpenAI:
+    def __init__(self, latency: float):
+        self.chat = SimpleNamespace(completions=_StubCompletions(latency))
+
+
+class StubTavily:
+    def __init__(self, latency: float):
+        self.latency = latency
+
+    def search(self, query, **kwargs):
+        time.sleep(self.latency)
+        return {"answer": "スタブの検索結果。現在の社会では移動の仮想化が進んでいる。"}
+
+
+def install_stubs(latency: float):
+    import llm
+    import prompt
+    stub = StubOpenAI(latency)
+    llm.get_client = lambda site="default": stub
+    prompt.tavily_client = StubTavily(latency)
+
+
+# ============ Measurement ============
+
+def rss_bytes() -> int:
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except OSError:
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+_latencies: dict = {}
+_lat_lock = threading.Lock()
+_run_lock = threading.Lock()  # AppTest はスレッドセーフではない
+
+
+def _run(at) -> float:
+    with _run_lock:
+        start = time.perf_counter()
+        at.run()
+        return time.perf_counter() - start
+
+
+def _step(name: str, at, action):
+    action()
+    elapsed = _run(at)
+    if at.exception:
+        raise RuntimeError(f"{name}: {at.exception[0].value}")
+    with _lat_lock:
+        _latencies.setdefault(name, []).append(elapsed)
+
+
+def simulate_user(user_idx: int, timeout: float):
+    from streamlit.testing.v1 import AppTest
+
+    at = AppTest.from_file(APP_PATH, default_timeout=timeout)
+    at.session_state["authenticated"] = True
+    at.query_params["sid"] = f"loadtest-{user_idx}"
+    _run(at)
+
+    def submit(q, text, btn):
+        at.text_area(key=q).input(text)
+        at.button(key=btn).click()
+
+    _step("q1", at, lambda: submit("input_q1", "通勤電車でスマホを見ている", "btn_q1"))
+    _step("q2", at, lambda: submit("input_q2", "スマートフォン", "btn_q2"))
+    _step("q3", at, lambda: submit("input_q3", "情報収集", "btn_q3"))
+    _step("q4", at, lambda: submit("input_q4", "自由な時間を持つ自分", "btn_q4"))
+    for stage in ["n_adv", "n_goal", "n_val", "n_hab", "n_ux"]:
+        _step(stage, at, lambda: at.button(key=stage).click())
+    _step("outline", at, lambda: at.button(key="btn_generate_outline").click())
+    return at
+
+
+def percentile(samples: list, p: float) -> float:
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * p))]
+
+
+def run_users(user_ids: list, timeout: float, latency: float) -> dict:
+    """このプロセスで user_ids のユーザーを同時に流し、計測結果を返す"""
+    sys.path.insert(0, os.path.dirname(APP_PATH))
+    install_stubs(latency)
+
+    # 1ユーザー分を先に流して import やキャッシュの初期化分を除外する
+    simulate_user(f"warmup-{os.getpid()}", timeout)
+    _latencies.clear()
+
+    baseline = rss_bytes()
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=len(user_ids)) as ex:
+        list(ex.map(lambda i: simulate_user(i, timeout), user_ids))
+    wall = time.perf_counter() - start
+
+    import metrics
+    return {
+        "latencies": dict(_latencies),
+        "wall": wall,
+        "rss_per_session": (rss_bytes() - baseline) / len(user_ids),
+        "counters": metrics.snapshot("coalesce.")["counters"],
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=10, help="同時ユーザー数")
+    parser.add_argument("--processes", type=int, default=1, help="ユーザーを分けるプロセス数（プロセス内の実行は直列化される）")
+    parser.add_argument("--latency", type=float, default=0.05, help="スタブ呼び出し1回あたりの遅延（秒）")
+    parser.add_argument("--timeout", type=float, default=120, help="1ステップのタイムアウト（秒）")
+    args = parser.parse_args()
+
+    os.environ.setdefault("HP_SESSION_DB", os.path.join(tempfile.mkdtemp(), "loadtest.db"))
+    sys.path.insert(0, os.path.dirname(APP_PATH))
+    processes = max(1, min(args.processes, args.users))
+    groups = [list(range(args.users))[i::processes] for i in range(processes)]
+
+    if processes == 1:
+        results = [run_users(groups[0], args.timeout, args.latency)]
+    else:
+        ctx = multiprocessing.get_context("spawn")
+        with ProcessPoolExecutor(max_workers=processes, mp_context=ctx) as ex:
+            results = list(ex.map(run_users, groups, [args.timeout] * processes, [args.latency] * processes))
+
+    latencies = {}
+    for r in results:
+        for name, samples in r["latencies"].items():
+            latencies.setdefault(name, []).extend(samples)
+    per_session = statistics.mean(r["rss_per_session"] for r in results)
+
+    print(f"users={args.users} processes={processes} stub_latency={args.latency}s wall={max(r['wall'] for r in results):.1f}s")
+    if processes < args.users:
+        print(f"note: script runs are serialised within each process (up to {len(groups[0])} users per process), "
+              f"so step latencies are not concurrent-user latencies; use --processes {args.users} for those")
+    print(f"RSS per session: {per_session / 1024:.0f} KiB")
+    print(f"{'step':<10} {'p50':>8} {'p95':>8}")
+    for name, samples in latencies.items():
+        print(f"{name:<10} {statistics.median(samples):8.3f} {percentile(samples, 0.95):8.3f}")
+    import metrics
+    import singleflight
+    for r in results if processes > 1 else []:
+        for name, n in r["counters"].items():
+            metrics.incr(name, n)
+    rates = singleflight.coalescing_rate()
+    if rates:
+        print("coalescing rate: " + ", ".join(f"{site}={rate:.0%}" for site, rate in sorted(rates.items())))
+
+
+if __name__ == "__main__":
+    main()
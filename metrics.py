@@ -0,0 +1,57 @@
+# metrics.py
+import statistics
+import threading
+import time
+from collections import defaultdict, deque
+from contextlib import contextmanager
+
+# プロセス内の簡易メトリクス（カウンタとレイテンシ）
+
+_MAX_SAMPLES = 1000
+
+_lock = threading.Lock()
+_counters: dict = defaultdict(int)
+_timings: dict = defaultdict(lambda: deque(maxlen=_MAX_SAMPLES))
+
+
+def incr(name: str, n: int = 1):
+    with _lock:
+        _counters[name] += n
+
+
+def observe(name: str, seconds: float):
+    with _lock:
+        _timings[name].append(seconds)
+
+
+@contextmanager
+def timer(name: str):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(name, time.perf_counter() - start)
+
+
+def _summary(samples) -> dict:
+    ordered = sorted(samples)
+    return {
+        "count": len(ordered),
+        "mean": statistics.mean(ordered),
+        "p50": ordered[len(ordered) // 2],
+        "p95": ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))],
+    }
+
+
+def snapshot(prefix: str = "") -> dict:
+    with _lock:
+        return {
+            "counters": {k: v for k, v in _counters.items() if k.startswith(prefix)},
+            "timings": {k: _summary(v) for k, v in _timings.items() if k.startswith(prefix) and v},
+        }
+
+
+def reset():
+    with _lock:
+        _counters.clear()
+        _timings.clear()
@@ -0,0 +1,65 @@
+# node_budget.py
+import re
+
+from deadline import TIMEOUT_TEXT
+from prompt import SEARCH_ERROR_PREFIX, condense_gpt
+
+# HPモデルの各ノードに許す最大文字数（プロンプト上は50文字だが、多少の超過は許容する）
+NODE_CHAR_BUDGET = 60
+
+# 生成に失敗したノードのテキストの先頭（要約せずに切り詰める）
+FAILED_PREFIXES = (TIMEOUT_TEXT, SEARCH_ERROR_PREFIX)
+
+_SENTENCE_END = re.compile(r"(?<=[。！？!?])|\n+")
+_LEADING_NOISE = re.compile(r"^[\s・\-*#>]+")
+
+
+def split_sentences(text: str) -> list[str]:
+    sentences = []
+    for s in _SENTENCE_END.split(text or ""):
+        s = _LEADING_NOISE.sub("", s).strip()
+        if s:
+            sentences.append(s)
+    return sentences
+
+
+def extract_within_budget(text: str, max_chars: int = NODE_CHAR_BUDGET) -> str:
+    """
+    先頭から文単位で予算内に収まるだけ取り出す（ローカル抽出）。
+    最初の1文すら収まらない場合は空文字を返す。
+    """
+    picked = ""
+    for s in split_sentences(text):
+        if len(picked) + len(s) > max_chars:
+            break
+        picked += s
+    return picked
+
+
+def enforce_budget(text: str, max_chars: int = NODE_CHAR_BUDGET, condense: bool = True) -> str:
+    """
+    ノードのテキストを max_chars 文字以内に収める。
+    1. そのまま収まればそのまま
+    2. 文単位のローカル抽出
+    3. condense=True なら LLM で要約（時間切れ・失敗時は切り詰め）、そうでなければ切り詰め。
+       時間切れ・検索エラーのテキストは要約しない
+    """
+    text = (text or "").strip()
+    if len(text) <= max_chars:
+        return text
+
+    extracted = extract_within_budget(text, max_chars)
+    if extracted:
+        return extracted
+
+    if condense and not text.startswith(FAILED_PREFIXES):
+        try:
+            condensed = condense_gpt(text, max_chars).strip()
+        except Exception as e:
+            print(f"Condense failed: {e}")
+            condensed = ""
+        if 0 < len(condensed) <= max_chars:
+            return condensed
+        text = condensed or text
+
+    return text[:max_chars - 1] + "…"
@@ -1,6 +1,7 @@
 # outline.py
 import json
-from prompt import SYSTEM_PROMPT, client
+from prompt import SYSTEM_PROMPT
+from llm import chat, stream_text
 
 def build_ap_model_history_from_dict(data: dict) -> list[dict]:
     """
@@ -26,9 +27,9 @@ def generate_outline(ap_model_history: list[dict]) -> str:
 
 上記の情報に基づき、指定された舞台設定で展開される主要なプロット、登場人物、中心的な対立を含む、革新的で魅力的なSF小説のスタイルに従った物語のストーリー概要を作成してください。
 """
-    response = client.chat.completions.create(
-        model="gpt-4o",
-        messages=[
+    response = chat(
+        "outline",
+        [
             {"role": "system", "content": SYSTEM_PROMPT},
             {"role": "user", "content": prompt},
         ],
@@ -39,6 +40,12 @@ def modify_outline(outline: str, modification_request: str) -> str:
     """
     根据用户修正意见调整故事大纲（无 input()，给 Streamlit 调用）。
     """
+    return "".join(modify_outline_stream(outline, modification_request))
+
+def modify_outline_stream(outline: str, modification_request: str):
+    """
+    modify_outline 的流式版本：逐 token yield（给 st.write_stream 调用）。
+    """
     prompt = f"""あなたはプロのSF作家です。
 
 【ユーザーの修正意見】に基づき、【元のストーリー概要】を調整してください。
@@ -52,11 +59,10 @@ def modify_outline(outline: str, modification_request: str) -> str:
 ユーザーの修正意見に基づき、ストーリー概要の関連部分を調整し、物語の一貫性を保ち、ユーザーの要求に合致させてください。修正後の完全なストーリー概要を出力してください。
 上記の情報を基に、指定された設定で展開される主要なプロット、キャラクター、中心的な対立を含む、革新的で魅力的なSF小説のスタイルに従った物語のあらすじを作成してください。
 """
-    response = client.chat.completions.create(
-        model="gpt-4o",
-        messages=[
+    yield from stream_text(
+        "outline",
+        [
             {"role": "system", "content": SYSTEM_PROMPT},
             {"role": "user", "content": prompt},
         ],
     )
-    return response.choices[0].message.content
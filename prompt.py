@@ -1,36 +1,49 @@
 # prompt.py
+from concurrent.futures import ThreadPoolExecutor
+
 import streamlit as st
-from openai import OpenAI
 from pydantic import BaseModel
 from tavily import TavilyClient
 
-client = OpenAI(api_key=st.secrets["openai"]["api_key"])
-tavily_client = TavilyClient(api_key=st.secrets["tavily"]["api_key"])
-
-HP_model = {
-    1: "前衛的社会問題",
-    2: "人々の価値観",
-    3: "社会問題",
-    4: "技術や資源",
-    5: "日常の空間とユーザー体験",
-    6: "制度",
-    7: "メディア",
-    8: "コミュニティ化",
-    9: "文化芸術振興",
-    10: "標準化",
-    11: "コミュニケーション",
-    12: "組織化",
-    13: "意味付け",
-    14: "製品・サービス",
-    15: "習慣化",
-    16: "パラダイム",
-    17: "ビジネスエコシステム",
-    18: "アート(社会批評)"
+import budget
+import deadline
+import metrics
+import prompt_registry
+import singleflight
+import transport
+from llm import get_client, chat, parse
+from hp_model import HP_model
+
+client = get_client()
+# session は tavily-python 0.7.23 以降（requirements.txt で下限を指定）
+tavily_client = TavilyClient(api_key=st.secrets["tavily"]["api_key"], session=transport.requests_session())
+
+
+# Tavily 検索ポリシー (time_state ごと)
+# tiers: 順に試す search_depth。回答が min_answer_chars 未満なら次の段階へ
+# fan_out: 並列に投げるクエリの数（最も充実した回答を採用）。2以上にすると、元のクエリとは
+#          切り口の異なるクエリを LLM で作って一緒に投げる（既定は1 = 元のクエリのみ）
+# secrets.toml の [search.past] / [search.present] で上書きできる
+SEARCH_POLICY = {
+    0: {"tiers": ["basic", "advanced"], "min_answer_chars": 40, "fan_out": 1},  # 過去
+    1: {"tiers": ["basic", "advanced"], "min_answer_chars": 40, "fan_out": 1},  # 現在
 }
+# 検索に失敗したときに返すテキストの先頭
+SEARCH_ERROR_PREFIX = "検索エラー"
 
 class Candidate(BaseModel):
     candidates: list[str]
 
+class QueryBatch(BaseModel):
+    queries: list[str]
+
+class DraftNode(BaseModel):
+    id: int
+    text: str
+
+class StageDraft(BaseModel):
+    nodes: list[DraftNode]
+
 #  System Prompt: 强调简洁性
 SYSTEM_PROMPT = """君はサイエンスフィクションの専門家であり、「アーキオロジカル・プロトタイピング（HP）」モデルに基づいて社会を分析します。
 君の任務は、ユーザーの具体的な「体験」と「価値観」を入力として受け取り、過去・現在・未来の3世代にわたる社会構造（18要素）を論理的かつ創造的に構築することです。
@@ -43,84 +56,255 @@ SYSTEM_PROMPT = """君はサイエンスフィクションの専門家であり
 （以下、HPモデルの定義は省略しますが、各要素の役割に従ってください）
 """
 
-def list_up_gpt(input_node: str, input_content: str, output_node: str, context: str = "") -> list[str]:
-    context_str = f"なお、この社会の文脈・背景情報は以下の通りです：\n{context}\n" if context else ""
-    
-    prompt = f"""
+# ============ Prompt templates (static instructions first, variable data last) ============
+
+_NODE_LIST = "\n".join([f"{nid}: {name}" for nid, name in HP_model.items()])
+
+prompt_registry.register("list_up", SYSTEM_PROMPT, """
 HPモデルに基づき分析します。
-【入力ノード】{input_node}
-【内容】{input_content}
-{context_str}
-上記の入力内容（および文脈）から論理的に導き出される、【{output_node}】の未来の可能性を5つ挙げてください。
+末尾の「入力ノード」と「内容」（「文脈・背景情報」があればそれも）から論理的に導き出される、「出力ノード」の未来の可能性を5つ挙げてください。
 
 【制約】
 - **各候補は50文字以内**で記述してください。
 - ユーザーの入力した体験や価値観と断絶しないよう注意してください。
 
 以下のJSON形式で出力してください：
-{{ "candidates": ["内容1(50文字以内)", "内容2", "内容3", "内容4", "内容5"] }}
-"""
-    response = client.chat.completions.parse(
-        model="gpt-4o",
-        messages=[
-            {"role": "system", "content": SYSTEM_PROMPT},
-            {"role": "user", "content": prompt}
-        ],
-        temperature=1.0,
-        response_format=Candidate,
-    )
-    return response.choices[0].message.parsed.candidates
+{ "candidates": ["内容1(50文字以内)", "内容2", "内容3", "内容4", "内容5"] }
+""", [("context", "文脈・背景情報"), ("input_node", "入力ノード"), ("input_content", "内容"), ("output_node", "出力ノード")])
 
-def single_gpt(input_node: str, input_content: str, output_node: str, context: str = "") -> str:
-    context_str = f"文脈・背景情報：{context}\n" if context else ""
-    prompt = f"""
+prompt_registry.register("simple_fill", SYSTEM_PROMPT, """
 HPモデルに基づき分析します。
-【入力ノード】{input_node}
-【内容】{input_content}
-{context_str}
-この内容を分析して、論理的に接続する【{output_node}】の内容を作成してください。
+末尾の「入力ノード」と「内容」（「文脈・背景情報」があればそれも）を分析して、論理的に接続する「出力ノード」の内容を作成してください。
 
 【制約】
 - **50文字以内**で簡潔に記述してください。
 - 余計な修飾語は省き、核心のみを出力してください。
 - 出力は内容の文章のみにしてください。
-"""
-    response = client.chat.completions.create(
-        model="gpt-4o",
-        messages=[
-            {"role": "system", "content": SYSTEM_PROMPT},
-            {"role": "user", "content": prompt}
-        ]
+""", [("context", "文脈・背景情報"), ("input_node", "入力ノード"), ("input_content", "内容"), ("output_node", "出力ノード")])
+
+prompt_registry.register("draft_stage", SYSTEM_PROMPT, f"""
+HPモデルに基づき、末尾の「対象の時代」の社会構造を一度にすべて推定してください。
+「ユーザーの入力」（「文脈・背景情報」があればそれも）を起点にしてください。
+
+【要素一覧】
+{_NODE_LIST}
+
+【制約】
+- 上記18要素すべてについて、IDと内容を出力してください。
+- **各要素は50文字以内**で記述してください。
+- 要素同士が論理的に接続するよう注意してください。
+""", [("user_inputs", "ユーザーの入力"), ("context", "文脈・背景情報"), ("state", "対象の時代")])
+
+prompt_registry.register("condense", SYSTEM_PROMPT, """
+末尾の「文章」を、HPモデルのノードとして「上限文字数」以内の1文に要約してください。
+固有名詞や年代など、核心となる情報を優先して残してください。
+出力は要約文のみにしてください。
+""", [("budget", "上限文字数"), ("text", "文章")])
+
+prompt_registry.register("query_gen", SYSTEM_PROMPT, """
+末尾の「入力ノード」と「内容」の事象に基づき、HPモデルの要素「出力ノード」の「時代」における状況を調査するための検索クエリを作成してください。
+検索エンジンで有効な、具体的かつ自然な日本語の質問文を1つ出力してください。
+""", [("state", "時代"), ("input_node", "入力ノード"), ("input_content", "内容"), ("output_node", "出力ノード")])
+
+prompt_registry.register("query_gen_batch", SYSTEM_PROMPT, """
+末尾の「項目」の各項目について、その状況を調査するための検索クエリを作成してください。
+検索エンジンで有効な、具体的かつ自然な日本語の質問文を、項目ごとに1つずつ、同じ順番で出力してください。
+
+以下のJSON形式で出力してください：
+{ "queries": ["質問文1", "質問文2", ...] }
+""", [("items", "項目")])
+
+prompt_registry.register("query_variants", SYSTEM_PROMPT, """
+末尾の「元の検索クエリ」と同じ状況を調べるための、別の検索クエリを「件数」だけ作成してください。
+それぞれ異なる切り口（統計・データ、具体的な事例や製品・企業、制度・政策、当事者の声、専門家の分析など）から、
+元のクエリとも互いとも異なるキーワードで書いてください。言い回しや語尾を変えただけのものは不可です。
+検索エンジンで有効な、具体的かつ自然な日本語の質問文にしてください。
+
+以下のJSON形式で出力してください：
+{ "queries": ["質問文1", "質問文2", ...] }
+""", [("count", "件数"), ("state", "時代"), ("question", "元の検索クエリ")])
+
+def list_up_gpt(input_node: str, input_content: str, output_node: str, context: str = "") -> list[str]:
+    response = parse(
+        "list_up",
+        prompt_registry.render(
+            "list_up", context=context, input_node=input_node, input_content=input_content, output_node=output_node
+        ),
+        Candidate,
+        temperature=1.0,
+    )
+    return response.choices[0].message.parsed.candidates
+
+def _fill_kwargs() -> dict:
+    """
+    simple_fill / query_gen の温度（secrets.toml の [coalesce] fill_temperature）。
+    既定は指定なし（API の既定）。singleflight.MAX_TEMPERATURE 以下にすると、同時に来た同一の入力が
+    1回の呼び出しを共有できるようになる（その分、出力の揺らぎは小さくなる）。
+    """
+    temperature = st.secrets.get("coalesce", {}).get("fill_temperature")
+    return {} if temperature is None else {"temperature": float(temperature)}
+
+def single_gpt(input_node: str, input_content: str, output_node: str, context: str = "") -> str:
+    response = chat(
+        "simple_fill",
+        prompt_registry.render(
+            "simple_fill", context=context, input_node=input_node, input_content=input_content, output_node=output_node
+        ),
+        **_fill_kwargs(),
+    )
+    return response.choices[0].message.content
+
+def draft_stage_gpt(time_state: int, user_inputs: dict, context: str = "") -> dict[int, str]:
+    """
+    1ステージ分（18要素すべて）を1回の呼び出しでドラフト生成する。
+    time_state: 0=過去, 1=現在, 2=未来
+    """
+    state = {0: "過去(Mt-1)", 1: "現在(Mt)", 2: "未来(Mt+1)"}[time_state]
+    inputs = f"""体験(UX): {user_inputs.get('q1_ux', '')}
+製品・サービス: {user_inputs.get('q2_product', '')}
+意味付け: {user_inputs.get('q3_meaning', '')}
+価値観: {user_inputs.get('q4_value', '')}"""
+    response = parse(
+        "draft_stage",
+        prompt_registry.render("draft_stage", user_inputs=inputs, context=context, state=state),
+        StageDraft,
+    )
+    return {n.id: n.text for n in response.choices[0].message.parsed.nodes if n.id in HP_model}
+
+def condense_gpt(text: str, max_chars: int) -> str:
+    response = chat(
+        "condense",
+        prompt_registry.render("condense", budget=f"{max_chars}文字", text=text),
+        temperature=0,
     )
     return response.choices[0].message.content
 
+ANSWER_LENGTH_HINT = "\n**50文字以内**で簡潔に回答してください。"
+
 def generate_question_for_tavily(input_node: str, input_content: str, output_node: str, time: int) -> str:
     state = "過去" if time == 0 else "現在"
-    prompt = f"""
-{input_node}（{input_content}）という事象に基づき、HPモデルの要素「{output_node}」の{state}における状況を調査するための検索クエリを作成してください。
-検索エンジンで有効な、具体的かつ自然な日本語の質問文を1つ出力してください。
-"""
-    response = client.chat.completions.create(
-        model="gpt-4o",
-        messages=[
-            {"role": "system", "content": SYSTEM_PROMPT},
-            {"role": "user", "content": prompt}
-        ]
+    response = chat(
+        "query_gen",
+        prompt_registry.render(
+            "query_gen", state=state, input_node=input_node, input_content=input_content, output_node=output_node
+        ),
+        **_fill_kwargs(),
     )
-    return response.choices[0].message.content + "\n**50文字以内**で簡潔に回答してください。"
+    return response.choices[0].message.content + ANSWER_LENGTH_HINT
+
+def generate_questions_for_tavily_batch(specs: list[tuple[str, str, str, int]]) -> list[str]:
+    """
+    複数の (input_node, input_content, output_node, time) に対する検索クエリを1回の呼び出しでまとめて作成する。
+    """
+    items = "\n".join([
+        f"{i+1}. {input_node}（{input_content}）という事象に基づき、HPモデルの要素「{output_node}」の{'過去' if time == 0 else '現在'}における状況"
+        for i, (input_node, input_content, output_node, time) in enumerate(specs)
+    ])
+    response = parse(
+        "query_gen",
+        prompt_registry.render("query_gen_batch", items=items),
+        QueryBatch,
+    )
+    queries = response.choices[0].message.parsed.queries
+    # 数が合わない分はテンプレートで補う
+    return [
+        queries[i] + ANSWER_LENGTH_HINT if i < len(queries) and queries[i].strip()
+        else template_question_for_tavily(*spec)
+        for i, spec in enumerate(specs)
+    ]
+
+def template_question_for_tavily(input_node: str, input_content: str, output_node: str, time: int) -> str:
+    """LLMを使わずに HP_model の要素名と入力テキストから検索クエリを組み立てる"""
+    state = "過去" if time == 0 else "現在"
+    return f"{input_content[:100]} における{output_node}の{state}の状況は？" + ANSWER_LENGTH_HINT
 
-def tavily_generate_answer(question: str) -> str:
+def search_policy(time_state: int) -> dict:
+    policy = dict(SEARCH_POLICY.get(time_state, SEARCH_POLICY[1]))
+    name = "past" if time_state == 0 else "present"
+    policy.update(st.secrets.get("search", {}).get(name, {}))
+    return policy
+
+def query_variants(question: str, fan_out: int, time_state: int) -> list[str]:
+    """
+    元の質問と、切り口の異なる検索クエリを合わせて最大 fan_out 件返す。
+    追加のクエリは1回の呼び出しでまとめて作る。作れなかったときは元の質問だけで検索する。
+    """
+    if fan_out <= 1:
+        return [question]
+    core = question.split("\n")[0].strip() or question
     try:
-        response = tavily_client.search(
-            query=question,
-            include_answer="advanced",
-            search_depth="advanced",
-            max_results=5,
+        response = parse(
+            "query_gen",
+            prompt_registry.render(
+                "query_variants", count=f"{fan_out - 1}件", state="過去" if time_state == 0 else "現在", question=core
+            ),
+            QueryBatch,
         )
-        # 検索結果も要約して短くする
-        raw_answer = response.get("answer", "情報が見つかりませんでした。")
-        # ここでGPTを使って要約させることも可能ですが、Tavilyのanswerは比較的まとまっているため、そのまま返すか、
-        # 必要であればここで要約ロジックを入れることも可能です。今回は現状維持とします。
-        return raw_answer
+        extra = response.choices[0].message.parsed.queries
     except Exception as e:
-        return f"検索エラー: {str(e)}"
\ No newline at end of file
+        print(f"Query variants failed: {e}")
+        return [question]
+    variants = [question]
+    seen = {core}
+    for q in extra:
+        q = q.strip()
+        if q and q not in seen:
+            seen.add(q)
+            variants.append(q + ANSWER_LENGTH_HINT)
+    return variants[:fan_out]
+
+def _tavily_search(query: str, depth: str) -> str:
+    def call():
+        with metrics.timer(f"tavily.{depth}"):
+            response = tavily_client.search(
+                query=query,
+                include_answer=depth,
+                search_depth=depth,
+                max_results=5,
+                timeout=deadline.timeout_for("tavily"),
+            )
+        metrics.incr(f"tavily.{depth}.calls")
+        budget.record_tavily_call()
+        return response.get("answer") or ""
+
+    # 検索は決定的なので、同時に実行中の同じ検索があれば結果を共有する
+    key = singleflight.make_key("tavily", {"query": query, "depth": depth})
+    return singleflight.do("tavily", key, call, timeout=deadline.timeout_for("tavily"))
+
+def tavily_generate_answer(question: str, time_state: int = 1) -> str:
+    """
+    basic から順に検索し、回答が無い・短すぎる場合だけ advanced に切り替える。
+    fan_out > 1 のときはクエリのバリエーションを並列に投げ、最も充実した回答を採用する。
+    """
+    policy = search_policy(time_state)
+    queries = query_variants(question, policy["fan_out"], time_state)
+    best, error = "", None
+
+    def run(query, depth):
+        nonlocal error
+        try:
+            return _tavily_search(query, depth)
+        except Exception as e:
+            metrics.incr(f"tavily.{depth}.errors")
+            # CallTimeout は締め切り切れで timeout_for 側が計上済み
+            if not isinstance(e, deadline.CallTimeout) and "Timeout" in type(e).__name__:
+                deadline.record_timeout("tavily")
+            error = e
+            return ""
+
+    for depth in policy["tiers"]:
+        if len(queries) == 1:
+            answers = [run(queries[0], depth)]
+        else:
+            with ThreadPoolExecutor(max_workers=len(queries)) as ex:
+                answers = [f.result() for f in [budget.submit(ex, run, q, depth) for q in queries]]
+        best = max(answers + [best], key=len)
+        if len(best) >= policy["min_answer_chars"]:
+            break
+        metrics.incr(f"tavily.{depth}.escalated")
+
+    if best:
+        return best
+    if error is not None:
+        return f"{SEARCH_ERROR_PREFIX}: {str(error)}"
+    return "情報が見つかりませんでした。"
\ No newline at end of file
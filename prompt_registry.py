@@ -0,0 +1,87 @@
+# prompt_registry.py
+import json
+
+import metrics
+
+# プロンプトのテンプレート登録簿。プロバイダ側のプレフィックスキャッシュ（先頭が一致する入力の再利用）が
+# 効くように、メッセージを次の順に組み立てる。
+#   1. system（静的）
+#   2. user の冒頭: 指示・制約・出力形式（静的。テンプレートが同じなら全呼び出しで完全に一致する）
+#   3. user の末尾: 可変のデータ（fields の順に「## 見出し」付きで並べ、dict / list はキー順で JSON 化）
+# fields は変わりにくいものから順に並べる（同じセッション内の呼び出しで一致する部分を長くする）。
+
+_templates: dict = {}
+
+
+class PromptTemplate:
+    __slots__ = ("name", "system", "instructions", "fields")
+
+    def __init__(self, name: str, system: str, instructions: str, fields: list[tuple[str, str]]):
+        self.name = name
+        self.system = system
+        self.instructions = instructions.strip()
+        self.fields = fields  # [(引数名, 見出し), ...]
+
+    def render(self, **values) -> list[dict]:
+        unknown = set(values) - {key for key, _ in self.fields}
+        if unknown:
+            raise KeyError(f"{self.name}: unknown fields {sorted(unknown)}")
+        blocks = [self.instructions]
+        for key, label in self.fields:
+            value = values.get(key)
+            # 省略できる欄（文脈・フィードバックなど）は空なら見出しごと出さない
+            if value is None or value == "":
+                continue
+            blocks.append(f"## {label}\n{serialize(value)}")
+        return [
+            {"role": "system", "content": self.system},
+            {"role": "user", "content": "\n\n".join(blocks)},
+        ]
+
+
+def serialize(value) -> str:
+    """可変データの安定したシリアライズ（同じ内容なら常に同じ文字列）"""
+    if isinstance(value, str):
+        return value.strip()
+    if isinstance(value, (dict, list, tuple)):
+        return json.dumps(value, ensure_ascii=False, sort_keys=True, indent=2)
+    return str(value)
+
+
+def register(name: str, system: str, instructions: str, fields: list[tuple[str, str]]) -> PromptTemplate:
+    template = PromptTemplate(name, system, instructions, fields)
+    _templates[name] = template
+    return template
+
+
+def render(name: str, **values) -> list[dict]:
+    return _templates[name].render(**values)
+
+
+def templates() -> dict:
+    return dict(_templates)
+
+
+# ============ Cached-prefix metrics ============
+
+def record_cache_usage(site: str, usage):
+    """応答の usage から、入力トークンのうちキャッシュから読まれた分を計上する"""
+    if usage is None:
+        return
+    prompt_tokens = getattr(usage, "prompt_tokens", 0) or 0
+    details = getattr(usage, "prompt_tokens_details", None)
+    cached = getattr(details, "cached_tokens", 0) or 0
+    if prompt_tokens:
+        metrics.incr(f"prompt_cache.{site}.prompt_tokens", prompt_tokens)
+        metrics.incr(f"prompt_cache.{site}.cached_tokens", cached)
+
+
+def cache_hit_rate(prefix: str = "prompt_cache.") -> dict:
+    """呼び出し箇所ごとの、入力トークンに占めるキャッシュ済みトークンの割合"""
+    counters = metrics.snapshot(prefix)["counters"]
+    rates = {}
+    for name, total in counters.items():
+        if name.endswith(".prompt_tokens") and total:
+            site = name[len(prefix):-len(".prompt_tokens")]
+            rates[site] = counters.get(f"{prefix}{site}.cached_tokens", 0) / total
+    return rates
@@ -0,0 +1,50 @@
+# schemas.py
+from typing import Union
+from pydantic import BaseModel, Field
+
+# LLM の構造化出力スキーマ (llm.structured で使用)
+
+# ---------- Step 2: Multi-Agent ----------
+
+class AgentProfile(BaseModel):
+    name: str = Field(min_length=1)
+    expertise: str = Field(min_length=1)
+    personality: str = ""
+    perspective: str = Field(min_length=1)
+
+class AgentRoster(BaseModel):
+    agents: list[AgentProfile] = Field(min_length=1)
+
+class Judgment(BaseModel):
+    selected_agent: str = ""
+    selected_content: str = Field(min_length=1)
+    reason: str = ""
+
+class Ranking(BaseModel):
+    ranked: list[int] = Field(min_length=1)  # 提案番号（1始まり）を良い順に
+    reason: str = ""
+
+# ---------- Step 3: Story Generator ----------
+
+class Brief(BaseModel):
+    briefing_theme: str = Field(min_length=1)
+    relevant_data_points: Union[str, list[str]]
+
+class Review(BaseModel):
+    approved: bool
+    feedback: str = ""
+
+class Character(BaseModel):
+    name: str = Field(min_length=1)
+    role: str = Field(min_length=1)
+    background: str = ""
+    motivation: str = Field(min_length=1)
+
+class StorySettings(BaseModel):
+    world_view: str = Field(min_length=1)
+    characters: list[Character] = Field(min_length=1)
+
+class OutlineStep(BaseModel):
+    title: str = Field(min_length=1)
+    summary: str = Field(min_length=1)
+    notes: str = ""
@@ -0,0 +1,177 @@
+# session_store.py
+import json
+import os
+import sqlite3
+import threading
+import time
+
+from generate import HPGenerationSession
+
+# セッションのスナップショット保存先（SQLite）
+DB_PATH = os.environ.get("HP_SESSION_DB", "hp_sessions.db")
+
+# この秒数アクセスの無いセッションはメモリから外し、ディスクにのみ残す
+IDLE_EVICT_SECONDS = 15 * 60
+# バックグラウンドのジョブがノードを書き込んでから保存するまでの秒数（この間の変更はまとめて1回で保存）
+AUTOSAVE_DELAY = 1.0
+
+# True のとき生成状態はワーカープロセスが書き込む（このプロセスは UI 状態だけを保存し、
+# 生成状態はスナップショットから読み直す）。engine.py が読み込み時に [engine] mode から設定する
+remote_sessions = False
+
+_db_lock = threading.Lock()
+
+
+def _connect() -> sqlite3.Connection:
+    conn = sqlite3.connect(DB_PATH, timeout=30)
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS snapshots (
+            session_id TEXT PRIMARY KEY,
+            data TEXT NOT NULL,
+            updated_at REAL NOT NULL
+        )
+    """)
+    return conn
+
+
+def save_snapshot(session_id: str, data: dict):
+    payload = json.dumps(data, ensure_ascii=False)
+    with _db_lock, _connect() as conn:
+        conn.execute(
+            "INSERT OR REPLACE INTO snapshots (session_id, data, updated_at) VALUES (?, ?, ?)",
+            (session_id, payload, time.time())
+        )
+
+
+def load_snapshot(session_id: str):
+    with _db_lock, _connect() as conn:
+        row = conn.execute("SELECT data FROM snapshots WHERE session_id = ?", (session_id,)).fetchone()
+    return json.loads(row[0]) if row else None
+
+
+def update_snapshot(session_id: str, session: dict = None, ui: dict = None):
+    """スナップショットの session / ui の片方だけを書き換える（読み込みと書き込みを1トランザクションで）"""
+    with _db_lock, _connect() as conn:
+        conn.execute("BEGIN IMMEDIATE")
+        row = conn.execute("SELECT data FROM snapshots WHERE session_id = ?", (session_id,)).fetchone()
+        data = json.loads(row[0]) if row else {}
+        if session is not None:
+            data["session"] = session
+        if ui is not None:
+            data["ui"] = ui
+        conn.execute(
+            "INSERT OR REPLACE INTO snapshots (session_id, data, updated_at) VALUES (?, ?, ?)",
+            (session_id, json.dumps(data, ensure_ascii=False), time.time())
+        )
+
+
+def delete_snapshot(session_id: str):
+    with _db_lock, _connect() as conn:
+        conn.execute("DELETE FROM snapshots WHERE session_id = ?", (session_id,))
+
+
+def iter_snapshots():
+    """(session_id, data) を更新の新しい順に返す"""
+    with _db_lock, _connect() as conn:
+        rows = conn.execute("SELECT session_id, data FROM snapshots ORDER BY updated_at DESC").fetchall()
+    for session_id, data in rows:
+        yield session_id, json.loads(data)
+
+
+# ============ Live sessions (in memory, evicted to disk when idle) ============
+
+_live: dict = {}  # session_id -> [HPGenerationSession, ui_state, last_access]
+_live_lock = threading.Lock()
+
+
+def get_session(session_id: str):
+    """
+    (HPGenerationSession, ui_state) を返す。メモリに無ければスナップショットから復元し、
+    それも無ければ新規作成する。
+    """
+    with _live_lock:
+        entry = _live.get(session_id)
+        if entry:
+            entry[2] = time.time()
+            return entry[0], entry[1]
+
+    snapshot = load_snapshot(session_id) or {}
+    if "session" in snapshot:
+        session = HPGenerationSession.from_snapshot(snapshot["session"])
+    else:
+        session = HPGenerationSession()
+    ui_state = snapshot.get("ui", {})
+    with _live_lock:
+        entry = _live.setdefault(session_id, [session, ui_state, time.time()])
+        # バックグラウンドで埋まったノードは次の操作を待たずに保存する
+        entry[0].on_change = lambda: _schedule_save(session_id)
+    return entry[0], entry[1]
+
+
+def persist(session_id: str, ui_state: dict = None):
+    """
+    現在の状態をディスクへ書き出す（各ステップの後に呼ぶ）。
+    ui_state を渡さなければ保存済みの UI 状態には触れない（API やバックグラウンドの保存が、
+    別のプロセスの Streamlit が保存した UI 状態を上書きしないように）。
+    """
+    with _live_lock:
+        entry = _live.get(session_id)
+        if not entry:
+            return
+        if ui_state is not None:
+            entry[1] = ui_state
+        session = entry[0]
+    # remote_sessions のときの生成状態はワーカーが書き込む
+    data = None if remote_sessions else session.to_snapshot()
+    if data is not None or ui_state is not None:
+        update_snapshot(session_id, session=data, ui=ui_state)
+
+
+_autosave_pending: set = set()
+_autosave_lock = threading.Lock()
+
+
+def _schedule_save(session_id: str):
+    with _autosave_lock:
+        if session_id in _autosave_pending:
+            return
+        _autosave_pending.add(session_id)
+    timer = threading.Timer(AUTOSAVE_DELAY, _autosave, args=(session_id,))
+    timer.daemon = True
+    timer.start()
+
+
+def _autosave(session_id: str):
+    with _autosave_lock:
+        _autosave_pending.discard(session_id)
+    persist(session_id)
+
+
+def reload(session_id: str):
+    """ワーカーが保存した生成状態をメモリ上のセッションに取り込む"""
+    with _live_lock:
+        entry = _live.get(session_id)
+    snapshot = load_snapshot(session_id) or {}
+    if entry and "session" in snapshot:
+        entry[0].merge_snapshot(snapshot["session"])
+
+
+def evict_idle(max_idle_seconds: float = IDLE_EVICT_SECONDS) -> int:
+    """アイドルなセッションを保存してメモリから外す。外した数を返す。"""
+    now = time.time()
+    with _live_lock:
+        idle = [
+            sid for sid, (session, _, last) in _live.items()
+            if now - last > max_idle_seconds and not session.has_pending_jobs()
+        ]
+    evicted = 0
+    for sid in idle:
+        persist(sid)
+        with _live_lock:
+            entry = _live.get(sid)
+            # 保存中にアクセスされたものは残す
+            if entry is None or time.time() - entry[2] <= max_idle_seconds:
+                continue
+            del _live[sid]
+        evicted += 1
+    return evicted
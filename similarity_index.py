@@ -0,0 +1,177 @@
+# similarity_index.py
+import math
+import threading
+import time
+from collections import Counter, defaultdict
+
+import streamlit as st
+
+import metrics
+import session_store
+from node_budget import FAILED_PREFIXES
+from prompt import HP_model
+
+# 過去セッションの Q1〜Q4 を文字 n-gram の TF-IDF で索引し、近いセッションの
+# Mt / Mt-1 ノードとエージェント構成をウォームスタートに使う（ネットワーク不要）
+
+FIELDS = ("q1_ux", "q2_product", "q3_meaning", "q4_value")
+NGRAM_RANGE = (2, 3)
+
+# この類似度（コサイン）以上なら再利用する
+MIN_SCORE = 0.5
+# この類似度以上なら取り込んだノードを精緻化せずにそのまま使う
+# （secrets.toml の [warm_start] keep_score で上書き可）
+KEEP_SCORE = 0.85
+# 保存済みセッションから索引を作り直す間隔（秒）
+REBUILD_SECONDS = 300
+
+# 再利用しないノードの出所（精緻化前の暫定値）。生成に失敗したテキストは FAILED_PREFIXES で見分ける
+_UNREFINED_SOURCES = ("draft", "warm")
+
+
+def _ngrams(text: str):
+    text = "".join((text or "").split()).lower()
+    lo, hi = NGRAM_RANGE
+    for n in range(lo, hi + 1):
+        for i in range(len(text) - n + 1):
+            yield text[i:i + n]
+
+
+def _features(user_inputs: dict) -> Counter:
+    # 質問ごとに別の特徴にする（Q1 の「電車」と Q2 の「電車」は区別する）
+    tf = Counter()
+    for field in FIELDS:
+        for gram in _ngrams(user_inputs.get(field, "")):
+            tf[f"{field}:{gram}"] += 1
+    return tf
+
+
+class SimilarityIndex:
+    def __init__(self):
+        self._docs = []  # (session_id, tf, payload)
+        self._idf = {}
+        self._postings = defaultdict(list)  # term -> [(doc_idx, weight)]
+
+    def __len__(self) -> int:
+        return len(self._docs)
+
+    def add(self, session_id: str, user_inputs: dict, payload: dict):
+        tf = _features(user_inputs)
+        if tf:
+            self._docs.append((session_id, tf, payload))
+
+    def _vectorize(self, tf: Counter) -> dict:
+        vec = {t: (1 + math.log(c)) * self._idf[t] for t, c in tf.items() if t in self._idf}
+        norm = math.sqrt(sum(w * w for w in vec.values())) or 1.0
+        return {t: w / norm for t, w in vec.items()}
+
+    def build(self):
+        df = Counter()
+        for _, tf, _ in self._docs:
+            df.update(tf.keys())
+        n = len(self._docs)
+        self._idf = {t: math.log((1 + n) / (1 + d)) + 1 for t, d in df.items()}
+        self._postings = defaultdict(list)
+        for idx, (_, tf, _) in enumerate(self._docs):
+            for t, w in self._vectorize(tf).items():
+                self._postings[t].append((idx, w))
+        return self
+
+    def query(self, user_inputs: dict, k: int = 3, min_score: float = 0.0, exclude: str = None) -> list:
+        """近い順に [{"session_id", "score", "payload"}, ...] を返す"""
+        scores = defaultdict(float)
+        for t, w in self._vectorize(_features(user_inputs)).items():
+            for idx, dw in self._postings.get(t, ()):
+                scores[idx] += w * dw
+        hits = []
+        for idx, score in sorted(scores.items(), key=lambda x: -x[1]):
+            session_id, _, payload = self._docs[idx]
+            if score < min_score or len(hits) >= k:
+                break
+            if session_id != exclude:
+                hits.append({"session_id": session_id, "score": score, "payload": payload})
+        return hits
+
+
+def warm_start_payload(snapshot: dict):
+    """
+    Mt / Mt-1 がすべて確定しているスナップショットから再利用する部分を取り出す。
+    ドラフトやウォームスタートの値が残っているもの、時間切れ・検索エラーのノードを含むものは
+    使わない（精緻化されていない値がセッションからセッションへ広がらないように）。使えなければ None。
+    """
+    names = set(HP_model.values())
+    for stage in ("hp_mt_0", "hp_mt_1"):
+        nodes = snapshot.get(stage, {})
+        if not names <= set(nodes):
+            return None
+        if any(src in _UNREFINED_SOURCES for src in snapshot.get("provenance", {}).get(stage, {}).values()):
+            return None
+        if any(str(text).startswith(FAILED_PREFIXES) for text in nodes.values()):
+            return None
+    return {
+        "hp_mt_0": dict(snapshot["hp_mt_0"]),
+        "hp_mt_1": dict(snapshot["hp_mt_1"]),
+        "agents": list(snapshot.get("agents", [])),
+    }
+
+
+def build_from_store() -> SimilarityIndex:
+    index = SimilarityIndex()
+    for session_id, data in session_store.iter_snapshots():
+        session = data.get("session", {})
+        payload = warm_start_payload(session)
+        if payload:
+            index.add(session_id, session.get("user_inputs", {}), payload)
+    return index.build()
+
+
+_index = SimilarityIndex().build()
+_built_at = None
+_rebuilding = False
+_index_lock = threading.Lock()
+
+
+def _rebuild():
+    global _index, _built_at, _rebuilding
+    try:
+        with metrics.timer("warm_start.build"):
+            index = build_from_store()
+        with _index_lock:
+            _index, _built_at = index, time.time()
+    finally:
+        with _index_lock:
+            _rebuilding = False
+
+
+def refresh_async(max_age: float = REBUILD_SECONDS):
+    """索引が古ければバックグラウンドで作り直す（作り直している間は前の索引を使う）"""
+    global _rebuilding
+    with _index_lock:
+        if _rebuilding or (_built_at is not None and time.time() - _built_at <= max_age):
+            return
+        _rebuilding = True
+    threading.Thread(target=_rebuild, daemon=True, name="hp-similarity-index").start()
+
+
+def get_index(max_age: float = REBUILD_SECONDS) -> SimilarityIndex:
+    """現在の索引を返す。リクエストの途中では作り直しを待たない（初回の構築前は空の索引）"""
+    refresh_async(max_age)
+    with _index_lock:
+        return _index
+
+
+def keep_score() -> float:
+    return float(st.secrets.get("warm_start", {}).get("keep_score", KEEP_SCORE))
+
+
+def find_warm_start(user_inputs: dict, exclude: str = None, min_score: float = MIN_SCORE):
+    """
+    最も近い過去セッション（類似度が min_score 以上）を返す。無ければ None。
+    類似度が keep_score() 以上なら "keep" を真にする（ノードを作り直さずに使う）。
+    """
+    hits = get_index().query(user_inputs, k=1, min_score=min_score, exclude=exclude)
+    metrics.incr("warm_start.hit" if hits else "warm_start.miss")
+    if not hits:
+        return None
+    hits[0]["keep"] = hits[0]["score"] >= keep_score()
+    return hits[0]
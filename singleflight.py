@@ -0,0 +1,86 @@
+# singleflight.py
+import json
+import threading
+import time
+
+import deadline
+import metrics
+
+# 同時に発生した同一の呼び出し（決定的・低温度のもの）を1回の実行にまとめる。
+# 先に来た呼び出し（leader）だけが実際に実行し、実行中に来た同じキーの呼び出しはその結果を共有する。
+# 結果はキャッシュしない（実行が終わればキーは消える）。
+
+# この温度以下の LLM 呼び出しだけをまとめる（高温度の呼び出しは毎回違う結果が欲しいので対象外）
+MAX_TEMPERATURE = 0.3
+
+
+class _Call:
+    __slots__ = ("done", "result", "error")
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+_inflight: dict = {}
+_lock = threading.Lock()
+
+
+def make_key(site: str, payload) -> str:
+    # 送信する内容そのもので比べる（空白や全角/半角が違えば別の呼び出し）
+    return site + "\x00" + json.dumps(payload, ensure_ascii=False, sort_keys=True, default=str)
+
+
+def do(site: str, key: str, fn, timeout: float = None):
+    """
+    key が同じ実行中の呼び出しがあればその結果を待って返し、無ければ fn() を実行する。
+    待つ側は timeout 秒で諦めて CallTimeout（自分の締め切りを守る）。leader の例外は待つ側にも伝わるが、
+    CallTimeout は leader 自身の締め切りによるものなので、待つ側はやり直す（誰かが新しい leader になる）。
+    """
+    end = None if timeout is None else time.monotonic() + timeout
+    metrics.incr(f"coalesce.{site}.calls")
+    shared = False
+    while True:
+        with _lock:
+            call = _inflight.get(key)
+            leader = call is None
+            if leader:
+                call = _inflight[key] = _Call()
+        if leader:
+            break
+
+        if not shared:
+            metrics.incr(f"coalesce.{site}.shared")
+            shared = True
+        left = None if end is None else max(0.0, end - time.monotonic())
+        if not call.done.wait(left):
+            deadline.record_timeout(site)
+            raise deadline.CallTimeout(site)
+        if isinstance(call.error, deadline.CallTimeout):
+            continue
+        if call.error is not None:
+            raise call.error
+        return call.result
+
+    try:
+        call.result = fn()
+        return call.result
+    except BaseException as e:
+        call.error = e
+        raise
+    finally:
+        with _lock:
+            _inflight.pop(key, None)
+        call.done.set()
+
+
+def coalescing_rate(prefix: str = "coalesce.") -> dict:
+    """呼び出し箇所ごとの、他の呼び出しと結果を共有した割合"""
+    counters = metrics.snapshot(prefix)["counters"]
+    rates = {}
+    for name, calls in counters.items():
+        if name.endswith(".calls") and calls:
+            site = name[len(prefix):-len(".calls")]
+            rates[site] = counters.get(f"{prefix}{site}.shared", 0) / calls
+    return rates
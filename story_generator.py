@@ -1,38 +1,24 @@
 import json
-from prompt import SYSTEM_PROMPT, client
-from utils import parse_json_response
+from prompt import SYSTEM_PROMPT
+import budget
+import deadline
+import prompt_registry
+from llm import structured, StructuredOutputError
+from schemas import Brief, Review, StorySettings, OutlineStep
+from validators import validate_settings, validate_outline_step
 
 # 仅供写作 Agent 使用的创意 Prompt (日语版)
 CREATIVE_SYSTEM_PROMPT = "あなたは受賞歴のあるSF作家兼編集者です。詳細な社会学データ（HPモデル）に基づき、説得力があり、論理的かつ創造的な物語を作成することを目標としています。"
 
-class StoryGenerator:
-    def __init__(self):
-        self.client = client
-
-    # ==========================================
-    # 0. Global Overseer: Briefing Director
-    # ==========================================
-    def _overseer_prepare_brief(self, full_ap_data, target_type):
-        """
-        Overseer (Director) 准备简报。
-        """
-        ap_context_str = json.dumps(full_ap_data, indent=2, ensure_ascii=False)
+# ============ Prompt templates (static instructions first, variable data last) ============
 
-        if target_type == "setting":
-            focus_instruction = "世界観構築（World Building）に関連する静的な要素（技術、日常空間、制度、雰囲気など）のみを抽出してください。"
-        else:
-            focus_instruction = "プロットと対立（Plot & Conflict）に関連する動的な要素（社会問題、メディア、アート、前衛的運動、変化を引き起こす矢印など）のみを抽出してください。"
-
-        prompt = f"""
-あなたは**総監督（Global Overseer）**です。あなたは完全な社会モデル（HPモデル）を保持しています。
+_BRIEF_INSTRUCTIONS = """
+あなたは**総監督（Global Overseer）**です。あなたは末尾の「マスターファイル（HPモデル）」に完全な社会モデルを保持しています。
 あなたの任務は、SF小説を完成させるために、エージェントに必要な情報を与えることです。
 
-## マスターファイル（HPモデル）
-{ap_context_str}
-
 ## タスク
-{target_type} エージェントのための **コンセプト・ブリーフ（指示書）** を作成してください。
-{focus_instruction}
+{agent} エージェントのための **コンセプト・ブリーフ（指示書）** を作成してください。
+{focus}
 
 ## 出力形式 (JSON)
 {{
@@ -40,157 +26,225 @@ class StoryGenerator:
     "relevant_data_points": "このエージェントが注目すべき具体的なHPモデルの要素（ノード/矢印）の要約。すべてを含めず、関連するものだけを記述すること。"
 }}
 """
-        response = self.client.chat.completions.create(
-            model="gpt-4o",
-            messages=[
-                {"role": "system", "content": SYSTEM_PROMPT},
-                {"role": "user", "content": prompt}
-            ],
-            response_format={"type": "json_object"},
-            temperature=0.5 
-        )
-        return parse_json_response(response.choices[0].message.content)
 
+prompt_registry.register("brief_setting", SYSTEM_PROMPT, _BRIEF_INSTRUCTIONS.format(
+    agent="setting",
+    focus="世界観構築（World Building）に関連する静的な要素（技術、日常空間、制度、雰囲気など）のみを抽出してください。",
+), [("hp_model", "マスターファイル（HPモデル）")])
 
-    # ==========================================
-    # 1. Global Overseer: The Critic
-    # ==========================================
-    def _global_check(self, content_type, content_data, context_data, full_ap_data, specific_criteria):
-        """
-        Global Agent 审核内容，确保符合 HP 模型。
-        """
-        ap_master_str = json.dumps(full_ap_data, indent=2, ensure_ascii=False)
+prompt_registry.register("brief_outline", SYSTEM_PROMPT, _BRIEF_INSTRUCTIONS.format(
+    agent="outline",
+    focus="プロットと対立（Plot & Conflict）に関連する動的な要素（社会問題、メディア、アート、前衛的運動、変化を引き起こす矢印など）のみを抽出してください。",
+), [("hp_model", "マスターファイル（HPモデル）")])
 
-        prompt = f"""
+prompt_registry.register("critic", SYSTEM_PROMPT, """
 あなたは厳格な**総監督（Global Overseer）**です。
-あなたの仕事は、生成されたコンテンツがHPモデルの論理および具体的な指示（ブリーフ）に従っているかを確認することです。
-
-## 資料1：マスター社会モデル（正解データ）
-{ap_master_str}
-
-## 資料2：エージェントへの指示（ブリーフ）
-{context_data}
-
-## 審査基準
-{specific_criteria}
-
-## 審査対象コンテンツ ({content_type})
-{json.dumps(content_data, indent=2, ensure_ascii=False)}
+あなたの仕事は、末尾の「審査対象コンテンツ」がHPモデルの論理および具体的な指示（ブリーフ）に従っているかを確認することです。
+「マスター社会モデル（正解データ）」と「エージェントへの指示（ブリーフ）」を資料とし、「審査基準」に従って審査してください。
 
 ## 出力形式 (JSON)
-{{
+{
     "approved": true/false,
     "feedback": "承認(true)の場合は空欄。拒否(false)の場合は、HPモデルやブリーフとの矛盾点を具体的に指摘し、修正方法を助言してください。"
-}}
-"""
-        response = self.client.chat.completions.create(
-            model="gpt-4o",
-            messages=[
-                {"role": "system", "content": SYSTEM_PROMPT},
-                {"role": "user", "content": prompt}
-            ],
-            response_format={"type": "json_object"},
-            temperature=0.3
-        )
-        return parse_json_response(response.choices[0].message.content)
-
-    # ==========================================
-    # 2. Setting Agent (World & Characters)
-    # ==========================================
-    def _agent_build_settings(self, setting_brief, feedback=""):
-        brief_str = json.dumps(setting_brief, indent=2, ensure_ascii=False)
-
-        prompt = f"""
+}
+""", [
+    ("criteria", "審査基準"),
+    ("hp_model", "マスター社会モデル（正解データ）"),
+    ("brief", "エージェントへの指示（ブリーフ）"),
+    ("content_type", "審査対象の種類"),
+    ("content", "審査対象コンテンツ"),
+])
+
+prompt_registry.register("setting", CREATIVE_SYSTEM_PROMPT, """
 あなたは**設定制作エージェント（Setting Agent）**です。SF小説のための魅力的で創造的な世界設定とキャラクターをデザインしてください。
 
-## 総監督からのブリーフ（基盤情報）
-{brief_str}
-
 ## 指示
-このブリーフを統合し、生き生きとした世界を作り上げてください。
+末尾の「総監督からのブリーフ（基盤情報）」を統合し、生き生きとした世界を作り上げてください。
+「以前のフィードバック」がある場合は、必ずそれに従って修正してください。
 
 1. **世界観 (World View)**: 年代、雰囲気、技術レベル、社会の機能などを詳細に記述してください。
 2. **キャラクター (Characters)**: この世界に住む主要なキャラクターを作成してください。名前、役割、背景、動機を設定してください。
 
-## 以前のフィードバック（ある場合、必ず修正すること）
-{feedback}
-
 ## 出力形式 (JSON)
-{{
+{
     "world_view": "世界観の詳細な記述",
     "characters": [
-        {{ "name": "名前", "role": "役割", "background": "背景", "motivation": "動機" }}
+        { "name": "名前", "role": "役割", "background": "背景", "motivation": "動機" }
     ]
-}}
-"""
-        response = self.client.chat.completions.create(
-            model="gpt-4o",
-            messages=[
-                {"role": "system", "content": CREATIVE_SYSTEM_PROMPT},
-                {"role": "user", "content": prompt}
-            ],
-            response_format={"type": "json_object"}
-        )
-        return parse_json_response(response.choices[0].message.content)
-
-    # ==========================================
-    # 3. Outline Agent (Plot Architect)
-    # ==========================================
-    def _agent_build_outline_step(self, step_name, step_goal, settings, plot_brief, current_outline_history, feedback=""):
-        history_text = "\n".join([f"{k}: {v['summary']}" for k, v in current_outline_history.items()])
-        settings_str = json.dumps(settings, indent=2, ensure_ascii=False)
-        brief_str = json.dumps(plot_brief, indent=2, ensure_ascii=False)
-        
-        prompt = f"""
-あなたは**プロット構成エージェント（Outline Agent）**です。物語の **{step_name}** 部分を作成してください。
-
-## 物語の設定
-{settings_str}
-
-## 総監督のプロット指示
-以下の要素を使ってプロットイベントを推進してください：
-{brief_str}
-
-## 現在のプロット履歴（これまでの出来事）
-{history_text if history_text else "ここから物語が始まります。"}
+}
+""", [("brief", "総監督からのブリーフ（基盤情報）"), ("feedback", "以前のフィードバック")])
 
-## このステップの目標
-{step_goal}
+prompt_registry.register("story_step", CREATIVE_SYSTEM_PROMPT, """
+あなたは**プロット構成エージェント（Outline Agent）**です。末尾の「作成するステップ」の部分の物語を作成してください。
 
-## 以前のフィードバック（ある場合、修正してください）
-{feedback}
+## 指示
+- 「物語の設定」の世界とキャラクターを使ってください。
+- 「総監督のプロット指示」の要素を使ってプロットイベントを推進してください。
+- 「現在のプロット履歴（これまでの出来事）」に続く内容にし、「このステップの目標」を満たしてください。
+- 「以前のフィードバック」がある場合は、それに従って修正してください。
 
 ## 出力形式 (JSON)
-{{
+{
     "title": "シーンのタイトル",
     "summary": "何が起こるかの詳細な説明（約150〜300文字）。キャラクターの行動とプロットの進行に焦点を当ててください。",
     "notes": "監督のブリーフとどのように関連しているかのメモ。"
-}}
-"""
-        response = self.client.chat.completions.create(
-            model="gpt-4o",
-            messages=[
-                {"role": "system", "content": CREATIVE_SYSTEM_PROMPT},
-                {"role": "user", "content": prompt}
-            ],
-            response_format={"type": "json_object"}
+}
+""", [
+    ("settings", "物語の設定"),
+    ("plot_brief", "総監督のプロット指示"),
+    ("history", "現在のプロット履歴（これまでの出来事）"),
+    ("step_name", "作成するステップ"),
+    ("step_goal", "このステップの目標"),
+    ("feedback", "以前のフィードバック"),
+])
+
+def _error_feedback(e: StructuredOutputError) -> str:
+    """スキーマ検証エラーを、次の試行に渡すフィードバックの文章にする"""
+    lines = []
+    for err in e.errors:
+        field = ".".join(str(x) for x in err.get("loc", ())) or "出力全体"
+        lines.append(f"「{field}」: {err.get('msg', '形式が正しくありません')}")
+    return "\n".join(lines) or "指定のJSON形式で出力してください。"
+
+
+class StoryGenerator:
+    @staticmethod
+    def _critic_enabled() -> bool:
+        # 予算縮退中・締め切り間際は総監督のレビューと書き直しを省略する
+        if deadline.near():
+            deadline.record_timeout("critic")
+            return False
+        session_budget = budget.current()
+        return session_budget is None or session_budget.allow_critic_retry()
+
+    # ==========================================
+    # 0. Global Overseer: Briefing Director
+    # ==========================================
+    def _overseer_prepare_brief(self, full_ap_data, target_type):
+        """
+        Overseer (Director) 准备简报。
+        """
+        template = "brief_setting" if target_type == "setting" else "brief_outline"
+        try:
+            result = structured(
+                "brief",
+                prompt_registry.render(template, hp_model=full_ap_data),
+                Brief,
+                temperature=0.5,
+            )
+        except StructuredOutputError as e:
+            # ブリーフが作れなくても物語の生成は続ける（該当欄は N/A 表示）
+            print(f"Brief failed: {e}")
+            return {}
+        return result.model_dump()
+
+
+    # ==========================================
+    # 1. Global Overseer: The Critic
+    # ==========================================
+    def _global_check(self, content_type, content_data, context_data, full_ap_data, specific_criteria):
+        """
+        Global Agent 审核内容，确保符合 HP 模型。
+        """
+        try:
+            result = structured(
+                "critic",
+                prompt_registry.render(
+                    "critic",
+                    criteria=specific_criteria,
+                    hp_model=full_ap_data,
+                    brief=context_data,
+                    content_type=content_type,
+                    content=content_data,
+                ),
+                Review,
+                temperature=0.3,
+            )
+        except StructuredOutputError as e:
+            # 審査結果を読めなかったときは不承認として扱い、検証エラーをフィードバックにする
+            return {"approved": False, "feedback": _error_feedback(e)}
+        return result.model_dump()
+
+    # ==========================================
+    # 2. Setting Agent (World & Characters)
+    # ==========================================
+    def _agent_build_settings(self, setting_brief, feedback=""):
+        result = structured(
+            "setting",
+            prompt_registry.render("setting", brief=setting_brief, feedback=feedback),
+            StorySettings,
+        )
+        return result.model_dump()
+
+    # ==========================================
+    # 3. Outline Agent (Plot Architect)
+    # ==========================================
+    def _agent_build_outline_step(self, step_name, step_goal, settings, plot_brief, current_outline_history, feedback=""):
+        history_text = "\n".join([f"{k}: {v['summary']}" for k, v in current_outline_history.items()])
+        result = structured(
+            "story_step",
+            prompt_registry.render(
+                "story_step",
+                settings=settings,
+                plot_brief=plot_brief,
+                history=history_text or "ここから物語が始まります。",
+                step_name=step_name,
+                step_goal=step_goal,
+                feedback=feedback,
+            ),
+            OutlineStep,
         )
-        return parse_json_response(response.choices[0].message.content)
+        return result.model_dump()
 
     # ==========================================
     # 4. Main Workflow Orchestrator
     # ==========================================
     def generate_story_outline(self, ap_data_dict: dict) -> str:
+        return "".join(self.stream_story_outline(ap_data_dict))
+
+    def stream_story_outline(self, ap_data_dict: dict):
+        """
+        generate_story_outline のストリーミング版。
+        完成したセクション（テーマ、世界観、キャラクター、各プロットステップ）から順に Markdown を yield する。
+        締め切りを過ぎた場合は、そこまでに完成したセクションで打ち切る。
+        """
+        try:
+            yield from self._stream_sections(ap_data_dict)
+        except deadline.CallTimeout:
+            yield "\n\n> ⏱️ 時間切れのため、ここまでの内容で打ち切りました。\n"
+
+    def _stream_sections(self, ap_data_dict: dict):
         # --- PHASE 0: Director prepares Briefs ---
         setting_brief = self._overseer_prepare_brief(ap_data_dict, "setting")
 
+        yield f"""# SFストーリー概要 (Generated by Multi-Agent)
+
+## 1. 世界観とキャラクター
+**テーマ:** {setting_brief.get('briefing_theme', 'N/A')}
+
+"""
+
         # --- PHASE 1: Build & Verify Settings ---
         settings = None
         feedback = ""
         max_retries = 2 # 試行回数
+        critic = self._critic_enabled()
         
-        for i in range(max_retries + 1):
-            settings = self._agent_build_settings(setting_brief, feedback)
+        for i in range(max_retries + 1 if critic else 1):
+            try:
+                settings = self._agent_build_settings(setting_brief, feedback)
+            except StructuredOutputError as e:
+                # 失敗した試行として数え、前回までの設定は残す
+                feedback = _error_feedback(e)
+                continue
+
+            # ローカル検査で明らかな不備は即差し戻し（総監督の呼び出しを節約）
+            problems = validate_settings(settings)
+            if problems:
+                feedback = "\n".join(problems)
+                continue
+            if not critic:
+                break
             
             criteria = "「世界観」と「キャラクター」が、提供された監督のブリーフを論理的に反映しており、かつマスターHPモデルと矛盾していないか確認してください。"
             context_data = json.dumps(setting_brief, ensure_ascii=False)
@@ -203,17 +257,40 @@ class StoryGenerator:
                 feedback = review.get('feedback', '')
         
         if not settings:
-             return "エラー: 設定の生成に失敗しました。"
+             yield "エラー: 設定の生成に失敗しました。"
+             return
+
+        chars_text = ""
+        for c in settings.get('characters', []):
+            chars_text += f"* **{c.get('name', '不明')}** ({c.get('role', 'N/A')}): {c.get('motivation', 'N/A')}\n"
+
+        yield f"""**世界観:**
+{settings.get('world_view', 'N/A')}
+
+**主要キャラクター:**
+{chars_text}
+
+"""
 
         # --- PHASE 0.5: Director prepares Plot Brief ---
         plot_brief = self._overseer_prepare_brief(ap_data_dict, "outline")
 
+        raw_conflict = plot_brief.get('relevant_data_points', "N/A")
+        if isinstance(raw_conflict, list):
+            conflict_str = ", ".join([str(x) for x in raw_conflict])
+        else:
+            conflict_str = str(raw_conflict)
+
+        yield f"""## 2. プロットアウトライン
+**対立の源:** {conflict_str[:300]}...
+"""
+
         # --- PHASE 2: Build Outline Step-by-Step ---
         steps_config = [
-            {"name": "1. Inciting Incident (発端)", "goal": "物語は設定の中で始まり、キャラクターと舞台が紹介されます。"},
-            {"name": "2. Rising Action (葛藤)", "goal": "事件や対立が導入され、キャラクターは一連の課題や紛争に直面し始めます。緊張が高まります。"},
-            {"name": "3. Climax (クライマックス)", "goal": "物語の最も盛り上がる瞬間、または転換点です。"},
-            {"name": "4. Resolution (結末)", "goal": "物語の結末です。"}
+            {"name": "1. Inciting Incident (発端)", "heading": "I. 発端 (Inciting Incident)", "goal": "物語は設定の中で始まり、キャラクターと舞台が紹介されます。"},
+            {"name": "2. Rising Action (葛藤)", "heading": "II. 葛藤 (Rising Action)", "goal": "事件や対立が導入され、キャラクターは一連の課題や紛争に直面し始めます。緊張が高まります。"},
+            {"name": "3. Climax (クライマックス)", "heading": "III. クライマックス (Climax)", "goal": "物語の最も盛り上がる瞬間、または転換点です。"},
+            {"name": "4. Resolution (結末)", "heading": "IV. 結末 (Resolution)", "goal": "物語の結末です。"}
         ]
 
         final_outline_steps = {}
@@ -222,15 +299,27 @@ class StoryGenerator:
             step_content = None
             feedback = ""
             
-            for i in range(max_retries + 1):
-                step_content = self._agent_build_outline_step(
-                    step['name'], 
-                    step['goal'], 
-                    settings, 
-                    plot_brief,
-                    final_outline_steps, 
-                    feedback
-                )
+            critic = self._critic_enabled()
+            for i in range(max_retries + 1 if critic else 1):
+                try:
+                    step_content = self._agent_build_outline_step(
+                        step['name'], 
+                        step['goal'], 
+                        settings, 
+                        plot_brief,
+                        final_outline_steps, 
+                        feedback
+                    )
+                except StructuredOutputError as e:
+                    feedback = _error_feedback(e)
+                    continue
+
+                problems = validate_outline_step(step_content, settings, final_outline_steps)
+                if problems:
+                    feedback = "\n".join(problems)
+                    continue
+                if not critic:
+                    break
                 
                 context_for_review = f"""
                 PLOT BRIEF: {json.dumps(plot_brief, ensure_ascii=False)}
@@ -246,48 +335,13 @@ class StoryGenerator:
                 else:
                     feedback = review.get('feedback', '')
             
-            if step['name'] not in final_outline_steps:
+            if step['name'] not in final_outline_steps and step_content:
                  final_outline_steps[step['name']] = step_content
 
-        # --- PHASE 3: Compile Final Output ---
-        chars_text = ""
-        for c in settings.get('characters', []):
-            chars_text += f"* **{c.get('name', '不明')}** ({c.get('role', 'N/A')}): {c.get('motivation', 'N/A')}\n"
-
-        raw_conflict = plot_brief.get('relevant_data_points', "N/A")
-        if isinstance(raw_conflict, list):
-            conflict_str = ", ".join([str(x) for x in raw_conflict])
-        else:
-            conflict_str = str(raw_conflict)
-            
-        full_text = f"""# SFストーリー概要 (Generated by Multi-Agent)
-
-## 1. 世界観とキャラクター
-**テーマ:** {setting_brief.get('briefing_theme', 'N/A')}
-
-**世界観:**
-{settings.get('world_view', 'N/A')}
-
-**主要キャラクター:**
-{chars_text}
-
-## 2. プロットアウトライン
-**対立の源:** {conflict_str[:300]}...
-
-### I. 発端 (Inciting Incident)
-**タイトル:** {final_outline_steps.get('1. Inciting Incident (発端)', {}).get('title', 'N/A')}
-{final_outline_steps.get('1. Inciting Incident (発端)', {}).get('summary', 'N/A')}
-
-### II. 葛藤 (Rising Action)
-**タイトル:** {final_outline_steps.get('2. Rising Action (葛藤)', {}).get('title', 'N/A')}
-{final_outline_steps.get('2. Rising Action (葛藤)', {}).get('summary', 'N/A')}
-
-### III. クライマックス (Climax)
-**タイトル:** {final_outline_steps.get('3. Climax (クライマックス)', {}).get('title', 'N/A')}
-{final_outline_steps.get('3. Climax (クライマックス)', {}).get('summary', 'N/A')}
-
-### IV. 結末 (Resolution)
-**タイトル:** {final_outline_steps.get('4. Resolution (結末)', {}).get('title', 'N/A')}
-{final_outline_steps.get('4. Resolution (結末)', {}).get('summary', 'N/A')}
-"""
-        return full_text
\ No newline at end of file
+            # --- PHASE 3: Emit each finished step ---
+            done = final_outline_steps.get(step['name']) or {}
+            yield f"""
+### {step['heading']}
+**タイトル:** {done.get('title', 'N/A')}
+{done.get('summary', 'N/A')}
+"""
\ No newline at end of file
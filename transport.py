@@ -0,0 +1,157 @@
+# transport.py
+import importlib.util
+import threading
+import weakref
+from concurrent.futures import ThreadPoolExecutor
+
+import httpx
+import requests
+import streamlit as st
+from requests.adapters import HTTPAdapter
+
+import metrics
+
+# OpenAI / Tavily の呼び出しで共有する HTTP 接続プール。
+# ワーカー数とプールの大きさをここで一緒に決め、接続の張り直し（TLS ハンドシェイク）を減らす。
+# secrets.toml の [concurrency] と [http] で上書きできる。
+
+_conf_concurrency = st.secrets.get("concurrency", {})
+_conf_http = st.secrets.get("http", {})
+
+# 全セッション共有のワーカー数（generate.py / agent_manager.py が使う）
+GENERATION_WORKERS = int(_conf_concurrency.get("generation_workers", 16))
+DEBATE_WORKERS = int(_conf_concurrency.get("debate_workers", 12))
+# ワーカー以外（Streamlit のスクリプト実行スレッドなど）から同時に呼ぶ分の余裕
+SCRIPT_THREADS = int(_conf_concurrency.get("script_threads", 8))
+# 1回の Tavily 検索で並列に投げるクエリ数の上限（prompt.SEARCH_POLICY の fan_out）
+MAX_SEARCH_FAN_OUT = 3
+
+KEEPALIVE_SECONDS = float(_conf_http.get("keepalive_seconds", 60))
+CONNECT_TIMEOUT = float(_conf_http.get("connect_timeout", 10))
+# 起動時に先に張っておく接続数（HTTP/2 なら1本で多重化される）
+WARM_CONNECTIONS = int(_conf_http.get("warm_connections", 4))
+
+
+def http2_enabled() -> bool:
+    # HTTP/2 は h2 パッケージ（httpx[http2]）が入っているときだけ使う
+    return bool(_conf_http.get("http2", True)) and importlib.util.find_spec("h2") is not None
+
+
+def openai_pool_size() -> int:
+    return GENERATION_WORKERS + DEBATE_WORKERS + SCRIPT_THREADS
+
+
+def tavily_pool_size() -> int:
+    return GENERATION_WORKERS * MAX_SEARCH_FAN_OUT + SCRIPT_THREADS
+
+
+# ============ Shared clients ============
+
+_lock = threading.Lock()
+_httpx_client = None
+_requests_session = None
+_seen_connections = weakref.WeakSet()
+
+
+def _count_new_connections(response: httpx.Response):
+    # 応答のたびにプールを見て、初めて見る接続（= 新しく張った接続）を数える
+    pool = getattr(_httpx_client._transport, "_pool", None)
+    for conn in list(getattr(pool, "connections", [])):
+        if conn not in _seen_connections:
+            _seen_connections.add(conn)
+            metrics.incr("http.openai.connections_opened")
+    metrics.incr("http.openai.requests")
+
+
+def httpx_client() -> httpx.Client:
+    """OpenAI クライアントに渡す共有 httpx.Client"""
+    global _httpx_client
+    with _lock:
+        if _httpx_client is None:
+            size = openai_pool_size()
+            _httpx_client = httpx.Client(
+                http2=http2_enabled(),
+                limits=httpx.Limits(
+                    max_connections=size,
+                    max_keepalive_connections=size,
+                    keepalive_expiry=KEEPALIVE_SECONDS,
+                ),
+                # 読み込みのタイムアウトは呼び出しごとに deadline から決める
+                timeout=httpx.Timeout(None, connect=CONNECT_TIMEOUT),
+                event_hooks={"response": [_count_new_connections]},
+            )
+        return _httpx_client
+
+
+def requests_session() -> requests.Session:
+    """TavilyClient に渡す共有 requests.Session（Tavily SDK は requests を使うので HTTP/1.1 のまま）"""
+    global _requests_session
+    with _lock:
+        if _requests_session is None:
+            size = tavily_pool_size()
+            session = requests.Session()
+            # pool_block=False: 上限を超えた分は一時的な接続で処理し、待たせない
+            adapter = HTTPAdapter(pool_connections=4, pool_maxsize=size, pool_block=False)
+            session.mount("https://", adapter)
+            session.mount("http://", adapter)
+            _requests_session = session
+        return _requests_session
+
+
+# ============ Warm-up & metrics ============
+
+def warm_up(urls: list[str], tavily_url: str = "https://api.tavily.com"):
+    """
+    接続を先に張っておく（起動直後の最初の呼び出しで TLS ハンドシェイクを待たないように）。
+    HEAD を投げるだけなので応答の内容やエラーは気にしない。
+    """
+    client = httpx_client()
+    session = requests_session()
+
+    def head_openai(url):
+        try:
+            client.head(url, timeout=CONNECT_TIMEOUT)
+        except httpx.HTTPError:
+            metrics.incr("http.openai.warm_up_errors")
+
+    def head_tavily(_):
+        try:
+            session.head(tavily_url, timeout=CONNECT_TIMEOUT)
+        except requests.RequestException:
+            metrics.incr("http.tavily.warm_up_errors")
+
+    n = 1 if http2_enabled() else WARM_CONNECTIONS
+    with ThreadPoolExecutor(max_workers=WARM_CONNECTIONS * (len(urls) + 1)) as ex:
+        for url in urls:
+            for _ in range(n):
+                ex.submit(head_openai, url)
+        for i in range(WARM_CONNECTIONS):
+            ex.submit(head_tavily, i)
+
+
+def warm_up_async(urls: list[str]):
+    threading.Thread(target=warm_up, args=(urls,), daemon=True, name="hp-warm-up").start()
+
+
+def pool_stats() -> dict:
+    """接続プールの現在の状態（上限・接続数・アイドル数・これまでに張った接続数）"""
+    stats = {"openai": {"max": openai_pool_size(), "http2": http2_enabled()},
+             "tavily": {"max": tavily_pool_size()}}
+    if _httpx_client is not None:
+        pool = getattr(_httpx_client._transport, "_pool", None)
+        conns = list(getattr(pool, "connections", []))
+        stats["openai"].update({
+            "connections": len(conns),
+            "idle": sum(1 for c in conns if c.is_idle()),
+            "opened": metrics.snapshot("http.openai.connections_opened")["counters"].get("http.openai.connections_opened", 0),
+        })
+    if _requests_session is not None:
+        pools = _requests_session.get_adapter("https://").poolmanager.pools
+        hosts = [pools[k] for k in list(pools.keys())]
+        stats["tavily"].update({
+            "connections": sum(p.num_connections for p in hosts),
+            # 空きスロットは None で埋まっているので、実際の接続だけを数える
+            "idle": sum(1 for p in hosts if p.pool is not None for c in list(p.pool.queue) if c is not None),
+            "requests": sum(p.num_requests for p in hosts),
+        })
+    return stats
@@ -1,21 +1,158 @@
 import json
 import re
 
+def _strip_code_fences(response_content: str) -> str:
+    # Strip code blocks like ```json ... ```
+    if "```json" in response_content:
+        response_content = response_content.split("```json")[1].split("```")[0]
+    elif "```" in response_content:
+        response_content = response_content.split("```")[1].split("```")[0]
+    return response_content
+
 def parse_json_response(response_content: str) -> dict:
     """
     Parses JSON from a string that might contain Markdown code blocks.
+    Truncated or slightly malformed JSON is repaired locally before giving up.
     """
     try:
-        # Strip code blocks like ```json ... ```
-        if "```json" in response_content:
-            response_content = response_content.split("```json")[1].split("```")[0]
-        elif "```" in response_content:
-            response_content = response_content.split("```")[1].split("```")[0]
-        
-        return json.loads(response_content.strip())
+        return json.loads(_strip_code_fences(response_content).strip())
     except json.JSONDecodeError:
-        print(f"JSON Decode Error. Raw content: {response_content}")
-        return {}
+        try:
+            return repair_json(response_content)
+        except ValueError:
+            print(f"JSON Decode Error. Raw content: {response_content}")
+            return {}
     except Exception as e:
         print(f"Parse Error: {e}")
-        return {}
\ No newline at end of file
+        return {}
+
+def repair_json(text: str):
+    """
+    Repairs fenced, truncated or trailing-comma JSON.
+    Closes an unterminated string and any open brackets; if that is still invalid,
+    drops trailing members back to the last comma until it parses.
+    """
+    text = text.replace("```json", "").replace("```", "")
+    starts = [i for i in (text.find("{"), text.find("[")) if i != -1]
+    if not starts:
+        raise ValueError("no JSON object found")
+    s = text[min(starts):]
+
+    stack = []
+    cuts = []  # (comma position, closers needed at that point)
+    in_str = esc = False
+    for i, c in enumerate(s):
+        if in_str:
+            if esc:
+                esc = False
+            elif c == "\\":
+                esc = True
+            elif c == '"':
+                in_str = False
+        elif c == '"':
+            in_str = True
+        elif c in "{[":
+            stack.append("}" if c == "{" else "]")
+        elif c in "}]":
+            if stack:
+                stack.pop()
+            if not stack:
+                s = s[:i + 1]
+                break
+        elif c == ",":
+            cuts.append((i, "".join(reversed(stack))))
+
+    candidates = [
+        s,
+        re.sub(r",\s*([}\]])", r"\1", s),
+        s + ('"' if in_str else "") + "".join(reversed(stack)),
+    ]
+    candidates += [s[:pos] + closers for pos, closers in reversed(cuts)]
+    for candidate in candidates:
+        try:
+            return json.loads(candidate)
+        except json.JSONDecodeError:
+            continue
+    raise ValueError("unrepairable JSON")
+
+class IncrementalJSONParser:
+    """
+    Consumes a token stream of one JSON object and exposes each top-level field
+    as soon as its value is complete (e.g. "selected_content" before "reason").
+    """
+    def __init__(self):
+        self.buffer = ""
+        self.fields: dict = {}
+        self.complete = False
+        self._pos = 0
+        self._depth = 0
+        self._in_str = False
+        self._esc = False
+        self._member_start = None
+
+    def feed(self, chunk: str) -> dict:
+        """Adds a chunk and returns the fields completed by it."""
+        self.buffer += chunk
+        new_fields = {}
+        buf = self.buffer
+        while self._pos < len(buf) and not self.complete:
+            c = buf[self._pos]
+            if self._member_start is None:
+                if c == "{":
+                    self._depth = 1
+                    self._member_start = self._pos + 1
+            elif self._in_str:
+                if self._esc:
+                    self._esc = False
+                elif c == "\\":
+                    self._esc = True
+                elif c == '"':
+                    self._in_str = False
+            elif c == '"':
+                self._in_str = True
+            elif c in "{[":
+                self._depth += 1
+            elif c in "}]":
+                self._depth -= 1
+                if self._depth == 0:
+                    new_fields.update(self._emit(self._member_start, self._pos))
+                    self.complete = True
+            elif c == "," and self._depth == 1:
+                new_fields.update(self._emit(self._member_start, self._pos))
+                self._member_start = self._pos + 1
+            self._pos += 1
+        return new_fields
+
+    def _emit(self, start: int, end: int) -> dict:
+        member = self.buffer[start:end].strip()
+        if not member:
+            return {}
+        try:
+            parsed = json.loads("{" + member + "}")
+        except json.JSONDecodeError:
+            return {}
+        self.fields.update(parsed)
+        return parsed
+
+    def result(self) -> dict:
+        """Best-effort full object: complete fields plus a repaired partial tail."""
+        if self.complete:
+            return dict(self.fields)
+        try:
+            repaired = repair_json(self.buffer)
+        except ValueError:
+            return dict(self.fields)
+        return {**repaired, **self.fields} if isinstance(repaired, dict) else dict(self.fields)
+
+def parse_json_stream(chunks, stop_after: str = None) -> dict:
+    """
+    Parses a stream of text chunks into a dict.
+    If stop_after is given, returns as soon as that field is complete
+    (the caller should close the underlying stream).
+    """
+    parser = IncrementalJSONParser()
+    for chunk in chunks:
+        parser.feed(chunk)
+        if stop_after and stop_after in parser.fields:
+            break
+    return parser.result()
@@ -0,0 +1,96 @@
+# validators.py
+import re
+
+from schemas import Character
+
+# 総監督（LLM）に回す前のローカル検査。
+# 問題があればフィードバック文のリストを返し、空リストなら合格。
+
+# スキーマで必須の欄だけを検査する（background のように既定値のある欄は空でもよい）
+CHARACTER_FIELDS = tuple(name for name, field in Character.model_fields.items() if field.is_required())
+# 名前の一部として本文中の呼び方に認める最小の文字数
+MIN_NAME_PART_CHARS = 2
+MIN_WORLD_VIEW_CHARS = 40
+MIN_SUMMARY_CHARS = 80
+MAX_SUMMARY_CHARS = 800
+
+
+def _is_blank(value) -> bool:
+    return not isinstance(value, str) or not value.strip()
+
+
+def _name_variants(name: str) -> list[str]:
+    """
+    本文中で呼ばれうる形を返す。区切りで分けた各部分に加え、区切りの無い「佐藤ユウキ」でも
+    先頭・末尾からの部分（「佐藤」「ユウキ」など）を名字・名前だけの呼び方として認める。
+    """
+    parts = [p for p in re.split(r"[\s・=＝（）()]+", name) if len(p) >= MIN_NAME_PART_CHARS]
+    compact = "".join(parts) or name
+    affixes = {compact[:i] for i in range(MIN_NAME_PART_CHARS, len(compact))}
+    affixes |= {compact[-i:] for i in range(MIN_NAME_PART_CHARS, len(compact))}
+    return [name] + parts + sorted(affixes, key=len, reverse=True)
+
+
+def validate_settings(settings) -> list[str]:
+    if not isinstance(settings, dict) or not settings:
+        return ["出力が空、またはJSONとして解析できませんでした。指定のJSON形式で出力してください。"]
+
+    problems = []
+    world_view = settings.get("world_view")
+    if _is_blank(world_view):
+        problems.append("「world_view」がありません。世界観を記述してください。")
+    elif len(world_view.strip()) < MIN_WORLD_VIEW_CHARS:
+        problems.append(f"「world_view」が短すぎます（{len(world_view.strip())}文字）。年代、雰囲気、技術レベル、社会の機能を具体的に記述してください。")
+
+    characters = settings.get("characters")
+    if not isinstance(characters, list) or not characters:
+        problems.append("「characters」がありません。主要キャラクターを1人以上作成してください。")
+        return problems
+
+    seen = set()
+    for i, c in enumerate(characters, 1):
+        if not isinstance(c, dict):
+            problems.append(f"characters[{i}] がオブジェクトではありません。")
+            continue
+        missing = [f for f in CHARACTER_FIELDS if _is_blank(c.get(f))]
+        if missing:
+            problems.append(f"characters[{i}]（{c.get('name') or '名前なし'}）に {', '.join(missing)} がありません。")
+        name = (c.get("name") or "").strip()
+        if name:
+            if name in seen:
+                problems.append(f"キャラクター名「{name}」が重複しています。")
+            seen.add(name)
+    return problems
+
+
+def validate_outline_step(step_content, settings, previous_steps: dict) -> list[str]:
+    if not isinstance(step_content, dict) or not step_content:
+        return ["出力が空、またはJSONとして解析できませんでした。指定のJSON形式で出力してください。"]
+
+    problems = []
+    if _is_blank(step_content.get("title")):
+        problems.append("「title」がありません。")
+
+    summary = step_content.get("summary")
+    if _is_blank(summary):
+        problems.append("「summary」がありません。何が起こるかを記述してください。")
+        return problems
+
+    summary = summary.strip()
+    if len(summary) < MIN_SUMMARY_CHARS:
+        problems.append(f"「summary」が短すぎます（{len(summary)}文字）。約150〜300文字で記述してください。")
+    elif len(summary) > MAX_SUMMARY_CHARS:
+        problems.append(f"「summary」が長すぎます（{len(summary)}文字）。約150〜300文字に収めてください。")
+
+    names = [
+        c.get("name", "") for c in (settings or {}).get("characters", [])
+        if isinstance(c, dict) and not _is_blank(c.get("name"))
+    ]
+    if names and not any(v in summary for n in names for v in _name_variants(n.strip())):
+        problems.append(f"設定に登場するキャラクター（{', '.join(names)}）が一人も登場していません。設定のキャラクター名を使ってください。")
+
+    for prev_name, prev in (previous_steps or {}).items():
+        if isinstance(prev, dict) and prev.get("summary", "").strip() == summary:
+            problems.append(f"「{prev_name}」と同じ内容です。物語を先に進めてください。")
+
+    return problems
@@ -1,8 +1,16 @@
-import streamlit as st
+import hashlib
 import json
+import os
+
+import streamlit as st
 import streamlit.components.v1 as components
 from prompt import HP_model
 
+# 描画用の静的アセット（HTML/CSS/JS）はこのディレクトリから一度だけ配信し、
+# Python 側からは transform_data_for_vis のデータだけを送る
+_COMPONENT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "hp_vis_component")
+_hp_vis_component = components.declare_component("hp_visualization", path=_COMPONENT_DIR)
+
 # ==========================================
 # 1. 定義: ノード（対象）と矢印（プロセス）
 # ==========================================
@@ -85,291 +93,48 @@ def transform_data_for_vis(hp_json: dict) -> list:
         
     return vis_data
 
-def render_hp_visualization(hp_json: dict):
-    if not hp_json:
-        st.warning("可視化データがありません")
-        return
-
-    vis_data_list = transform_data_for_vis(hp_json)
-    json_str = json.dumps(vis_data_list, ensure_ascii=False)
-
-    html_content = f'''
-<!DOCTYPE html>
-<html lang="ja">
-<head>
-    <meta charset="UTF-8">
-    <style>
-        body {{ font-family: "Helvetica Neue", Arial, sans-serif; margin: 0; padding: 0; background: transparent; }}
-        
-        .vis-container {{
-            width: 100%; overflow-x: auto; background: #fff;
-            border: 1px solid #eee; border-radius: 8px; padding-bottom: 30px;
-        }}
-        
-        .visualization {{
-            position: relative;
-            width: 2600px; /* 3世代分 */
-            height: 650px;
-            background: #fff;
-            margin: 0;
-        }}
-
-        /* ノード (円) */
-        .node {{
-            position: absolute; width: 100px; height: 100px; border-radius: 50%;
-            display: flex; align-items: center; justify-content: center;
-            text-align: center; font-size: 12px; font-weight: bold; color: #333;
-            border: 3px solid #ccc; box-shadow: 0 3px 6px rgba(0,0,0,0.1);
-            z-index: 10; cursor: pointer; background: #f9f9f9;
-            transition: transform 0.2s; padding: 5px; box-sizing: border-box;
-            line-height: 1.2;
-        }}
-        .node:hover {{ transform: scale(1.1); z-index: 100; }}
-
-        /* 色分け */
-        .node-前衛的社会問題 {{ background: #ffcccc; border-color: #ff9999; }}
-        .node-社会問題 {{ background: #ffffcc; border-color: #e6e600; }}
-        .node-人々の価値観 {{ background: #ffebcc; border-color: #ffcc99; }}
-        .node-技術や資源 {{ background: #ccffcc; border-color: #66cc66; }}
-        .node-制度 {{ background: #e6ccff; border-color: #cc99ff; }}
-        .node-日常の空間とユーザー体験 {{ background: #ccebff; border-color: #66b3ff; }}
-
-        /* 矢印の線 */
-        .arrow-line {{
-            position: absolute; height: 2px; background: #999;
-            transform-origin: 0 50%; z-index: 1; pointer-events: none;
-        }}
-        .arrow-line::after {{
-            content: ""; position: absolute; right: 0; top: -4px;
-            border-left: 8px solid #999; border-top: 5px solid transparent; border-bottom: 5px solid transparent;
-        }}
-        /* 世代間接続の線（破線） */
-        .arrow-dashed {{ border-top: 2px dashed #999; background: transparent; height: 0; }}
-        .arrow-dashed::after {{ border-left-color: #999; top: -6px; }}
-
-        /* 矢印のラベル */
-        .arrow-label {{
-            position: absolute; background: #fff; padding: 2px 6px;
-            border: 1px solid #ddd; border-radius: 4px; font-size: 10px; color: #555;
-            z-index: 5; cursor: help; transform: translate(-50%, -50%);
-            white-space: nowrap;
-        }}
-        .arrow-label:hover {{ background: #eee; color: #000; z-index: 50; }}
-
-        .stage-label {{
-            position: absolute; bottom: 10px; font-size: 20px; font-weight: bold; color: #ddd;
-            border-bottom: 4px solid #f0f0f0; text-transform: uppercase;
-        }}
-
-        .tooltip {{
-            position: fixed; background: rgba(30,30,30,0.9); color: #fff;
-            padding: 10px; border-radius: 5px; font-size: 12px; max-width: 250px;
-            pointer-events: none; opacity: 0; z-index: 9999;
-        }}
-        .tooltip.show {{ opacity: 1; }}
-    </style>
-</head>
-<body>
-    <div class="vis-container">
-        <div class="visualization" id="vis"></div>
-    </div>
-    <div class="tooltip" id="tip"></div>
-
-    <script>
-        const container = document.getElementById('vis');
-        const tooltip = document.getElementById('tip');
-        const data = {json_str};
-        
-        // DOM要素キャッシュ key: s{{stage}}-n{{node_id}}
-        let nodeEls = {{}};
-
-        // --- 座標定義 (ダイヤモンド型) ---
-        function getNodeCoord(stageIdx, nodeId) {{
-            const W = 800; // 1世代の幅
-            const H_CENTER = 300;
-            const V_GAP = 200; // 垂直方向の広がり
-            
-            // 基準X (世代ごとにシフト)
-            const baseX = 50 + (stageIdx * W);
-
-            // ★【反転ロジック】: Stage 1 (Mt) の場合のみ上下を入れ替える
-            // invert = -1 (反転: 上が下に、下が上に), 1 (通常)
-            const invert = (stageIdx === 1) ? -1 : 1;
-            
-            // ID別配置:
-            // 5:UX(左端), 3:社会(中央) -> Yはセンター固定
-            // 1:前衛, 2:価値 -> 通常は上(Y小)、反転時は下(Y大)
-            // 6:制度, 4:技術 -> 通常は下(Y大)、反転時は上(Y小)
-            
-            switch(nodeId) {{
-                case 5: return {{ x: baseX,          y: H_CENTER }};
-                
-                // 1: 前衛的社会問題
-                // 通常: 300 - 200 = 100 (上)
-                // 反転: 300 - (-200) = 500 (下)
-                case 1: return {{ x: baseX + 200,    y: H_CENTER - (V_GAP * invert) }};
-                
-                // 6: 制度
-                // 通常: 300 + 200 = 500 (下)
-                // 反転: 300 + (-200) = 100 (上)
-                case 6: return {{ x: baseX + 200,    y: H_CENTER + (V_GAP * invert) }};
-                
-                case 3: return {{ x: baseX + 400,    y: H_CENTER }};
-                
-                // 2: 価値観 (同 1)
-                case 2: return {{ x: baseX + 600,    y: H_CENTER - (V_GAP * invert) }};
-                
-                // 4: 技術 (同 6)
-                case 4: return {{ x: baseX + 600,    y: H_CENTER + (V_GAP * invert) }};
-                
-                default: return {{ x: 0, y: 0 }};
-            }}
-        }}
-
-        function render() {{
-            container.innerHTML = '';
-            nodeEls = {{}};
-            
-            // 1. 世代ラベル
-            ['Mt-1: 過去', 'Mt: 現在 (上下反転)', 'Mt+1: 未来'].forEach((txt, i) => {{
-                const d = document.createElement('div');
-                d.className = 'stage-label';
-                d.innerText = txt;
-                d.style.left = (50 + i * 800) + 'px';
-                d.style.width = '700px';
-                container.appendChild(d);
-            }});
+def hp_json_digest(hp_json: dict) -> str:
+    """hp_json の内容ハッシュ（キー順に依存しない）"""
+    payload = json.dumps(hp_json, ensure_ascii=False, sort_keys=True)
+    return hashlib.sha1(payload.encode("utf-8")).hexdigest()
 
-            // 2. ノード描画 (全世代分)
-            data.forEach(d => {{
-                d.nodes.forEach(n => {{
-                    const pos = getNodeCoord(d.stage, n.id);
-                    
-                    const el = document.createElement('div');
-                    el.className = `node node-${{n.type}}`;
-                    el.textContent = n.type;
-                    el.dataset.desc = n.definition;
-                    
-                    // 中心合わせ
-                    el.style.left = (pos.x - 50) + 'px';
-                    el.style.top = (pos.y - 50) + 'px';
-                    
-                    el.onmouseenter = (e) => showTip(e, n.type, el.dataset.desc);
-                    el.onmousemove = moveTip;
-                    el.onmouseleave = hideTip;
-                    
-                    container.appendChild(el);
-                    nodeEls[`s${{d.stage}}-n${{n.id}}`] = el;
-                }});
-                
-                // 次の世代へつなぐための「右端のEnd UX」ポイントを作成
-                // これは次の世代のStart UXと同じ座標になる (x=baseX+800, y=300)
-                const endUxX = (50 + (d.stage * 800)) + 800;
-                const endUxY = 300;
-                
-                const dummy = document.createElement('div');
-                dummy.style.position = 'absolute';
-                dummy.style.left = (endUxX - 50) + 'px';
-                dummy.style.top = (endUxY - 50) + 'px';
-                dummy.style.width = '100px'; 
-                dummy.style.height = '100px';
-                // 描画はしないが、矢印のターゲットとしてDOMに追加しておく
-                container.appendChild(dummy);
-                
-                nodeEls[`s${{d.stage}}-endUX`] = dummy;
-            }});
 
-            // 3. 矢印描画
-            data.forEach(d => {{
-                d.arrows.forEach(a => {{
-                    let srcEl = nodeEls[`s${{d.stage}}-n${{a.src_node_id}}`];
-                    let tgtEl = null;
+@st.cache_data(show_spinner=False, max_entries=256)
+def _vis_payload(digest: str, _hp_json: dict) -> list:
+    # _hp_json はハッシュ対象外。キャッシュキーは digest のみ
+    return transform_data_for_vis(_hp_json)
 
-                    if (a.is_next) {{
-                        // 次世代への接続
-                        const nextStage = d.stage + 1;
-                        
-                        // UX(5)への接続の場合、それは「この世代のEnd UX」へつなぐ
-                        if (a.tgt_node_id === 5) {{
-                            tgtEl = nodeEls[`s${{d.stage}}-endUX`];
-                        }} else if (nextStage <= 2) {{
-                            // それ以外は次世代の通常のノードへ
-                            tgtEl = nodeEls[`s${{nextStage}}-n${{a.tgt_node_id}}`];
-                        }}
-                    }} else {{
-                        // 同世代内接続
-                        tgtEl = nodeEls[`s${{d.stage}}-n${{a.tgt_node_id}}`];
-                    }}
 
-                    if (srcEl && tgtEl) {{
-                        drawArrow(srcEl, tgtEl, a.label, a.definition, a.is_next);
-                    }}
-                }});
-            }});
-        }}
-
-        function drawArrow(el1, el2, label, desc, isDashed) {{
-            const x1 = parseFloat(el1.style.left) + 50;
-            const y1 = parseFloat(el1.style.top) + 50;
-            const x2 = parseFloat(el2.style.left) + 50;
-            const y2 = parseFloat(el2.style.top) + 50;
-            
-            const dx = x2 - x1;
-            const dy = y2 - y1;
-            const dist = Math.sqrt(dx*dx + dy*dy);
-            const angle = Math.atan2(dy, dx) * 180 / Math.PI;
-            
-            // 線 (Node半径50px分空ける)
-            const pad = 50; 
-            const realDist = Math.max(0, dist - (pad * 2));
-            
-            const line = document.createElement('div');
-            line.className = isDashed ? 'arrow-line arrow-dashed' : 'arrow-line';
-            line.style.width = realDist + 'px';
-            
-            const startX = x1 + (Math.cos(angle * Math.PI/180) * pad);
-            const startY = y1 + (Math.sin(angle * Math.PI/180) * pad);
-            
-            line.style.left = startX + 'px';
-            line.style.top = startY + 'px';
-            line.style.transform = `rotate(${{angle}}deg)`;
-            container.appendChild(line);
-            
-            // ラベル
-            const lbl = document.createElement('div');
-            lbl.className = 'arrow-label';
-            lbl.textContent = label;
-            lbl.dataset.desc = desc;
-            
-            const midX = (x1 + x2) / 2;
-            const midY = (y1 + y2) / 2;
-            lbl.style.left = midX + 'px';
-            lbl.style.top = midY + 'px';
-            
-            lbl.onmouseenter = (e) => showTip(e, label, lbl.dataset.desc);
-            lbl.onmousemove = moveTip;
-            lbl.onmouseleave = hideTip;
-            
-            container.appendChild(lbl);
-        }}
-
-        function showTip(e, title, desc) {{
-            if (!desc || desc === '...') return;
-            tooltip.innerHTML = `<strong>${{title}}</strong><br>${{desc.substring(0, 200)}}...`;
-            tooltip.classList.add('show');
-            moveTip(e);
-        }}
-        function moveTip(e) {{
-            tooltip.style.left = (e.clientX + 15) + 'px';
-            tooltip.style.top = (e.clientY + 15) + 'px';
-        }}
-        function hideTip() {{
-            tooltip.classList.remove('show');
-        }}
+def render_hp_visualization(hp_json: dict):
+    if not hp_json:
+        st.warning("可視化データがありません")
+        return
 
-        render();
-    </script>
-</body>
-</html>
-    '''
-    components.html(html_content, height=700, scrolling=True)
\ No newline at end of file
+    digest = hp_json_digest(hp_json)
+    # digest が変わらない限りフロントエンドは再描画しない
+    _hp_vis_component(data=_vis_payload(digest, hp_json), digest=digest, key="hp_vis", default=None)
+
+
+def render_hp_live(session, key: str = "hp_vis_live"):
+    """
+    バックグラウンド生成中の HP 図。前回送った以降のノード状態の差分だけを送り、
+    pending / in_progress / draft / done / error をフロントエンドで描き分ける。
+    """
+    cursor_key, resync_key = f"{key}_cursor", f"{key}_resync"
+    request = st.session_state.get(key)
+    if request and request.get("resync") != st.session_state.get(resync_key):
+        # iframe の作り直しなどでフロントエンドが差分を取りこぼしたので最初から送り直す
+        st.session_state[resync_key] = request.get("resync")
+        st.session_state[cursor_key] = 0
+
+    since = st.session_state.get(cursor_key, 0)
+    deltas = session.node_deltas(since)
+    if deltas:
+        st.session_state[cursor_key] = deltas[-1]["seq"]
+
+    digest = hp_json_digest({})
+    _hp_vis_component(
+        data=_vis_payload(digest, {}), digest=digest,
+        live=True, deltas=deltas, since=since,
+        key=key, default=None,
+    )
@@ -0,0 +1,132 @@
+# worker.py
+"""
+job_queue のジョブを実行する生成ワーカー。Streamlit サーバーとは別のプロセスで動かす。
+secrets.toml で [engine] mode = "queue" にすると app.py は操作をキューに投入する。
+
+    python worker.py                 # 1プロセス
+    python worker.py --processes 4   # 4プロセス（同じセッションのジョブは並列にならない）
+"""
+import argparse
+import multiprocessing
+import os
+import socket
+import time
+import traceback
+from contextlib import nullcontext
+
+import deadline
+import engine
+import job_queue
+import llm
+import session_store
+import similarity_index
+import transport
+from generate import HPGenerationSession
+
+# キューが空のときの待ち時間
+IDLE_SLEEP = 0.5
+# バックグラウンドのノード生成を待つ間、途中の状態を保存する間隔
+SAVE_INTERVAL = 2.0
+# requeue_stale を呼ぶ間隔
+REQUEUE_INTERVAL = 30.0
+
+
+def _load_session(session_id: str) -> HPGenerationSession:
+    snapshot = session_store.load_snapshot(session_id) or {}
+    if "session" in snapshot:
+        return HPGenerationSession.from_snapshot(snapshot["session"])
+    return HPGenerationSession()
+
+
+def _execute(session: HPGenerationSession, job: dict) -> bool:
+    """ジョブを1つ実行する。結果を返した後もバックグラウンドの生成が続くなら True"""
+    job_id, sid = job["id"], job["session_id"]
+
+    def progress(text):
+        job_queue.heartbeat(job_id, text)
+
+    left = None if job["deadline_at"] is None else job["deadline_at"] - time.time()
+    if left is not None and left <= 0:
+        # UI は既に時間切れとして先に進んでいる。残り時間0で実行すると時間切れのノードを書き込むだけになる
+        job_queue.fail(job_id, "deadline passed before start")
+        return False
+    try:
+        with deadline.scope(left) if left is not None else nullcontext():
+            result = engine.execute(session, job["kind"], job["payload"], progress)
+    except Exception:
+        session_store.update_snapshot(sid, session=session.to_snapshot())
+        job_queue.fail(job_id, traceback.format_exc(limit=5))
+        return False
+
+    session_store.update_snapshot(sid, session=session.to_snapshot())
+    if not session.has_pending_jobs():
+        job_queue.complete(job_id, result)
+        return False
+    job_queue.publish(job_id, result)
+    return True
+
+
+def run_job(job: dict, worker_id: str):
+    """
+    ジョブを実行する。結果を返した後もバックグラウンドの生成が終わるまで状態を保存し続け、
+    その間に届いた同じセッションのジョブはこのプロセスのセッション上で続けて実行する。
+    """
+    sid = job["session_id"]
+    session = _load_session(sid)
+    settling = []
+    last_save = time.monotonic()
+    while job is not None:
+        if _execute(session, job):
+            settling.append(job["id"])
+        job = None
+        while job is None and session.has_pending_jobs():
+            job = job_queue.claim_session(worker_id, sid)
+            if job is not None:
+                continue
+            time.sleep(IDLE_SLEEP)
+            if time.monotonic() - last_save >= SAVE_INTERVAL:
+                session_store.update_snapshot(sid, session=session.to_snapshot())
+                for job_id in settling:
+                    job_queue.heartbeat(job_id)
+                last_save = time.monotonic()
+    session_store.update_snapshot(sid, session=session.to_snapshot())
+    for job_id in settling:
+        job_queue.complete(job_id)
+
+
+def worker_loop(worker_id: str):
+    transport.warm_up_async(llm.endpoints())
+    similarity_index.refresh_async()
+    last_requeue = 0.0
+    while True:
+        if time.monotonic() - last_requeue > REQUEUE_INTERVAL:
+            job_queue.requeue_stale()
+            last_requeue = time.monotonic()
+        job = job_queue.claim(worker_id)
+        if job is None:
+            time.sleep(IDLE_SLEEP)
+            continue
+        run_job(job, worker_id)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--processes", type=int, default=1)
+    args = parser.parse_args()
+
+    prefix = f"{socket.gethostname()}:{os.getpid()}"
+    if args.processes <= 1:
+        worker_loop(f"{prefix}:0")
+        return
+    procs = [
+        multiprocessing.Process(target=worker_loop, args=(f"{prefix}:{i}",), daemon=True)
+        for i in range(args.processes)
+    ]
+    for p in procs:
+        p.start()
+    for p in procs:
+        p.join()
+
+
+if __name__ == "__main__":
+    main()